@@ -0,0 +1,358 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks for import, lookup and search.
+
+Runs against synthetic data from jblite.synthetic, so no copy of the
+real dictionaries is needed.  Results are written as JSON so runs from
+different commits can be compared:
+
+    python -m jblite.bench [options] <results.json>
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import os, sys, time, json, random, shutil, sqlite3, tempfile, subprocess
+import multiprocessing
+
+import synthetic
+import jmdict, kd2, fuzzy
+from helpers import peak_rss_kb
+from jblite import VERSION
+
+import gettext
+#t = gettext.translation("jblite")
+#_ = t.ugettext
+gettext.install("jblite")
+
+
+# Result count used for the paged search benchmarks.
+PAGE_SIZE = 20
+
+
+def timing_stats(samples):
+    """Summarizes a list of per-call durations (in seconds)."""
+    if len(samples) == 0:
+        return {"count": 0}
+    ordered = sorted(samples)
+    def percentile(p):
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+    total = sum(ordered)
+    return {
+        "count": len(ordered),
+        "total": total,
+        "mean": total / len(ordered),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "max": ordered[-1],
+        }
+
+
+def time_calls(fn, arg_list):
+    """Calls fn once per argument and returns timing stats.
+
+    The stats also include the total number of items returned, which
+    helps to tell a faster query apart from one returning less data.
+
+    """
+    samples = []
+    result_count = 0
+    for arg in arg_list:
+        start = time.time()
+        result = fn(arg)
+        samples.append(time.time() - start)
+        if isinstance(result, list):
+            result_count += len(result)
+        elif result is not None:
+            result_count += 1
+    stats = timing_stats(samples)
+    stats["results"] = result_count
+    return stats
+
+
+######################################################################
+# Import
+######################################################################
+
+
+def _import_worker(module_name, db_fname, src_fname, queue):
+    module = {"jmdict": jmdict, "kd2": kd2}[module_name]
+    start = time.time()
+    module.Database(db_fname, init_from_file=src_fname)
+    queue.put((time.time() - start, peak_rss_kb()))
+
+
+def bench_import(module_name, db_fname, src_fname, item_count):
+    """Imports src_fname in a child process.
+
+    A fresh process is used so the peak RSS reflects the import alone.
+
+    """
+    queue = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=_import_worker,
+        args=(module_name, db_fname, src_fname, queue))
+    proc.start()
+    seconds, rss = queue.get()
+    proc.join()
+    return {
+        "items": item_count,
+        "seconds": seconds,
+        "items_per_sec": item_count / seconds if seconds > 0 else None,
+        "input_bytes": os.path.getsize(src_fname),
+        "db_bytes": os.path.getsize(db_fname),
+        "peak_rss_kb": rss,
+        }
+
+
+######################################################################
+# Query samples
+######################################################################
+
+
+def _sample_column(cursor, query, rng, count, args=()):
+    cursor.execute(query, args)
+    values = [row[0] for row in cursor.fetchall() if row[0]]
+    if len(values) == 0:
+        return []
+    return [rng.choice(values) for i in xrange(count)]
+
+
+def jmdict_search_queries(db, rng, count):
+    """Picks search terms for each query shape from a JMdict database.
+
+    Returns a dictionary of shape name to list of query strings.
+
+    """
+    cursor = db.cursor
+    kebs = _sample_column(cursor, "SELECT value FROM k_ele", rng, count)
+    rebs = _sample_column(cursor, "SELECT value FROM r_ele", rng, count)
+    glosses = _sample_column(
+        cursor, "SELECT value FROM gloss WHERE lang = ?", rng, count,
+        (db.tables["gloss"].get_code("lang", "eng"),))
+    return {
+        "exact": kebs,
+        "prefix": [keb[0] for keb in kebs],
+        "substring": [keb[len(keb) // 2:len(keb) // 2 + 1] for keb in kebs],
+        "gloss": [rng.choice(gloss.split()) for gloss in glosses],
+        "kana": rebs,
+        }
+
+
+def kd2_search_queries(db, rng, count):
+    """Picks search terms for each query shape from a KANJIDIC2 database."""
+    cursor = db.cursor
+    kunyomi = _sample_column(
+        cursor, "SELECT reading FROM kunyomi_lookup", rng, count)
+    onyomi = _sample_column(
+        cursor, "SELECT value FROM reading WHERE type = ?", rng, count,
+        (db.tables["reading"].get_code("type", "ja_on"),))
+    meanings = _sample_column(
+        cursor, "SELECT value FROM meaning WHERE lang = ?", rng, count,
+        (db.tables["meaning"].get_code("lang", "en"),))
+    return {
+        "kunyomi": kunyomi,
+        "onyomi": onyomi,
+        "meaning": meanings,
+        }
+
+
+def _sample_ids(cursor, table, rng, count):
+    cursor.execute("SELECT MAX(id) FROM %s" % table)
+    max_id = cursor.fetchone()[0] or 0
+    if max_id == 0:
+        return []
+    return [rng.randint(1, max_id) for i in xrange(count)]
+
+
+######################################################################
+# Driver
+######################################################################
+
+
+def environment_info():
+    """Collects metadata identifying the benchmark run."""
+    info = {
+        "jblite_version": VERSION,
+        "python": sys.version.split()[0],
+        "sqlite": sqlite3.sqlite_version,
+        "platform": sys.platform,
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "git_commit": None,
+        }
+    try:
+        here = os.path.dirname(os.path.abspath(__file__))
+        commit = subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], cwd=here,
+            stderr=open(os.devnull, "w"))
+        info["git_commit"] = commit.strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    return info
+
+
+def run_benchmarks(workdir, entries, characters, lookups, searches,
+                   seed=0, verbose=False):
+    """Runs the full benchmark suite inside workdir.
+
+    Returns a JSON-serializable dictionary of results.
+
+    """
+    def log(msg):
+        if verbose:
+            print(msg, file=sys.stderr)
+
+    rng = random.Random(seed)
+    results = {
+        "environment": environment_info(),
+        "parameters": {
+            "entries": entries,
+            "characters": characters,
+            "lookups": lookups,
+            "searches": searches,
+            "seed": seed,
+            },
+        }
+
+    # Generate inputs.  The kanji pool of JMdict matches the KANJIDIC2
+    # literals, as it does in the real files.
+    jmdict_src = os.path.join(workdir, "JMdict.gz")
+    kd2_src = os.path.join(workdir, "kanjidic2.xml.gz")
+    log("Generating synthetic JMdict (%d entries)..." % entries)
+    synthetic.write_file(
+        jmdict_src,
+        synthetic.generate_jmdict(entries, seed=seed, char_count=characters),
+        compress=True)
+    log("Generating synthetic KANJIDIC2 (%d characters)..." % characters)
+    synthetic.write_file(
+        kd2_src, synthetic.generate_kanjidic2(characters, seed=seed),
+        compress=True)
+
+    jmdict_db = os.path.join(workdir, "jmdict.sqlite")
+    kd2_db = os.path.join(workdir, "kd2.sqlite")
+
+    log("Benchmarking imports...")
+    results["import"] = {
+        "jmdict": bench_import("jmdict", jmdict_db, jmdict_src, entries),
+        "kd2": bench_import("kd2", kd2_db, kd2_src, characters),
+        }
+
+    log("Benchmarking JMdict lookup/search...")
+    db = jmdict.Database(jmdict_db)
+    ids = _sample_ids(db.cursor, "entry", rng, lookups)
+    queries = jmdict_search_queries(db, rng, searches)
+    search_page = lambda term: db.search(term, limit=PAGE_SIZE)
+    summary_page = lambda term: db.search(term, limit=PAGE_SIZE,
+                                          projection="summary")
+    results["jmdict"] = {
+        "lookup": time_calls(db.lookup, ids),
+        "search": dict((shape, time_calls(db.search, terms))
+                       for shape, terms in sorted(queries.iteritems())),
+        "search_page": dict((shape, time_calls(search_page, terms))
+                            for shape, terms in sorted(queries.iteritems())),
+        "search_page_summary": dict(
+            (shape, time_calls(summary_page, terms))
+            for shape, terms in sorted(queries.iteritems())),
+        "search_many": time_calls(db.search_many, [queries["exact"]]),
+        "lookup_many": time_calls(db.lookup_many, [ids]),
+        "lookup_by_seq": time_calls(db.lookup_by_seq,
+                                    [db.seqs_for_ids(ids).values()]),
+        "headwords": time_calls(db.headwords, [ids]),
+        "find_headword": time_calls(db.find_headword, queries["exact"]),
+        "related": time_calls(db.related, [ids]),
+        "linked_from": time_calls(db.linked_from, [ids]),
+        }
+
+    log("Benchmarking JMdict fuzzy search...")
+    start = time.time()
+    fuzzy.build_fuzzy_index(jmdict_db)
+    results["jmdict"]["fuzzy_index_seconds"] = time.time() - start
+    # Drop one letter from the middle of each gloss word.
+    typos = [word[:len(word) // 2] + word[len(word) // 2 + 1:]
+             for word in queries["gloss"]]
+    results["jmdict"]["search_fuzzy"] = time_calls(
+        lambda term: db.search_fuzzy(term, limit=PAGE_SIZE), typos)
+
+    cache = db.enable_cache()
+    results["jmdict"]["search_cached"] = {
+        "cold": time_calls(search_page, queries["gloss"]),
+        "warm": time_calls(search_page, queries["gloss"]),
+        "cache": cache.stats(),
+        }
+    db.disable_cache()
+
+    log("Benchmarking KANJIDIC2 lookup/search...")
+    db = kd2.Database(kd2_db)
+    ids = _sample_ids(db.cursor, "character", rng, lookups)
+    literals = [unichr(synthetic.CJK_BASE + rng.randrange(characters))
+                for i in xrange(lookups)]
+    queries = kd2_search_queries(db, rng, searches)
+    results["kd2"] = {
+        "lookup": time_calls(db.lookup, ids),
+        "search_by_literal": time_calls(db.search_by_literal, literals),
+        "lookup_literals": time_calls(db.lookup_literals,
+                                      [u"".join(literals)]),
+        "search": dict((shape, time_calls(db.search, terms))
+                       for shape, terms in sorted(queries.iteritems())),
+        }
+
+    return results
+
+
+def parse_args():
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options] <results.json|->")
+    op.add_option("-e", "--entries", type="int", default=20000,
+                  help=_("Number of synthetic JMdict entries "
+                         "(default: %default)"))
+    op.add_option("-c", "--characters", type="int", default=6000,
+                  help=_("Number of synthetic KANJIDIC2 characters "
+                         "(default: %default)"))
+    op.add_option("-n", "--lookups", type="int", default=500,
+                  help=_("Number of lookup() calls per dictionary "
+                         "(default: %default)"))
+    op.add_option("-q", "--searches", type="int", default=50,
+                  help=_("Number of search() calls per query shape "
+                         "(default: %default)"))
+    op.add_option("-s", "--seed", type="int", default=0,
+                  help=_("Random seed (default: %default)"))
+    op.add_option("-w", "--workdir",
+                  help=_("Directory for generated files.  By default a "
+                         "temporary directory is used and removed "
+                         "afterwards."))
+    op.add_option("-v", "--verbose", action="store_true",
+                  help=_("Print progress to stderr"))
+    options, args = op.parse_args()
+    if len(args) < 1:
+        op.print_help()
+        exit(-1)
+    return (options, args)
+
+def main():
+    options, args = parse_args()
+    out_fname = args[0]
+
+    if options.workdir is not None:
+        workdir = options.workdir
+        if not os.path.exists(workdir):
+            os.makedirs(workdir)
+    else:
+        workdir = tempfile.mkdtemp(prefix="jblite-bench-")
+    try:
+        results = run_benchmarks(workdir, options.entries, options.characters,
+                                 options.lookups, options.searches,
+                                 seed=options.seed, verbose=options.verbose)
+    finally:
+        if options.workdir is None:
+            shutil.rmtree(workdir)
+
+    output = json.dumps(results, indent=2, sort_keys=True)
+    if out_fname == "-":
+        print(output)
+    else:
+        with open(out_fname, "w") as outfile:
+            outfile.write(output)
+            outfile.write("\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,301 @@
+# -*- coding: utf-8 -*-
+"""Builds the JMdict and KANJIDIC2 databases in one go.
+
+    python -m jblite.build -j JMdict.gz -J jmdict.db \
+                           -k kanjidic2.xml.gz -K kd2.db [options]
+
+Each dictionary is imported in its own process, so the two imports run
+concurrently.  Within a database SQLite allows only one writer, so the
+phases of each import (parse, populate, index, derived tables) run in
+order; indices are created after the bulk insert, using SQLite's
+multi-threaded sorter.  Follow-up jobs start as soon as their inputs
+are ready: the fuzzy search index right after JMdict, and the kanji
+to word cross index once both databases exist.  The tokenizer trie
+comes last, since it is checked against the finished JMdict file.
+
+With --swap, the databases are built in temporary sibling files and
+only replace the existing ones once everything has been built and
+validated, so programs using them keep working during the build.
+
+A report of the time spent in each phase, and the import telemetry
+(throughput, rows per table, peak memory) of each dictionary, is
+printed at the end.
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import sys, json, time, traceback, Queue
+import multiprocessing
+
+import jmdict, kd2, kanjiwords, tokenizer, fuzzy
+from db import get_build_filename, validate_build, replace_file
+from instrument import PhaseTimer, ImportTelemetry
+
+import gettext
+#t = gettext.translation("jblite")
+#_ = t.ugettext
+gettext.install("jblite")
+
+
+MODULES = {"jmdict": jmdict, "kd2": kd2}
+
+# Seconds between checks that the import workers are still alive.
+POLL_INTERVAL = 1.0
+
+
+def _build_worker(name, src_fname, db_fname, options, queue):
+    """Imports one dictionary and reports its phases and telemetry
+    through queue."""
+    phase_timer = PhaseTimer()
+    telemetry = ImportTelemetry()
+    try:
+        MODULES[name].Database(db_fname, init_from_file=src_fname,
+                               phase_timer=phase_timer, telemetry=telemetry,
+                               encode=options.get("encode", False),
+                               langs=options.get("langs"),
+                               resume=options.get("resume", False))
+        if name == "jmdict" and options.get("fuzzy"):
+            with phase_timer.phase("fuzzy"):
+                fuzzy.build_fuzzy_index(db_fname)
+        queue.put((name, phase_timer.phases, telemetry.summary(), None))
+    except Exception:
+        queue.put((name, phase_timer.phases, telemetry.summary(),
+                   traceback.format_exc()))
+
+
+def build(jmdict_files=None, kd2_files=None, encode=False, langs=None,
+          trie=False, kanji_words=False, fuzzy_index=False, resume=False,
+          swap=False, log=None):
+    """Builds the requested databases concurrently.
+
+    jmdict_files, kd2_files: (source file, database file) pairs, or
+        None to skip that dictionary.
+    encode, langs: passed to the Database importers.  langs applies
+        to both dictionaries, so it should list codes for both (for
+        example ["eng", "en"]).
+    trie: also build the tokenizer trie for JMdict.
+    kanji_words: also build the kanji to word cross index (requires
+        both dictionaries).
+    fuzzy_index: also build the JMdict fuzzy search index.
+    resume: continue interrupted imports where they left off.
+    swap: build in temporary files, then validate the databases and
+        rename them into place (see db.install_database()).  If
+        validation fails, RuntimeError is raised and no database is
+        replaced.
+    log: optional function called with progress messages.
+
+    Returns a dictionary with "phases" (list of (job, phase, seconds)),
+    "telemetry" (dictionary name to ImportTelemetry.summary()),
+    "row_counts" (with swap: dictionary name to table row counts) and
+    "wall_time".  Raises RuntimeError if any job failed.
+
+    """
+    def report(msg):
+        if log is not None:
+            log(msg)
+
+    options = {"encode": encode, "langs": langs, "fuzzy": fuzzy_index,
+               "resume": resume}
+    targets = {}
+    for name, files in (("jmdict", jmdict_files), ("kd2", kd2_files)):
+        if files is not None:
+            targets[name] = get_build_filename(files[1]) if swap \
+                else files[1]
+
+    start = time.time()
+    queue = multiprocessing.Queue()
+    processes = {}
+    for name, files in (("jmdict", jmdict_files), ("kd2", kd2_files)):
+        if files is None:
+            continue
+        report(_("Starting %s import...") % name)
+        proc = multiprocessing.Process(
+            target=_build_worker,
+            args=(name, files[0], targets[name], options, queue))
+        proc.start()
+        processes[name] = proc
+
+    phases = []
+    telemetry = {}
+    errors = []
+    pending = set(processes)
+    exited = set()
+    while pending:
+        try:
+            name, job_phases, summary, error = queue.get(
+                timeout=POLL_INTERVAL)
+        except Queue.Empty:
+            # A worker killed by a signal (for example by the OOM
+            # killer) never reports back.  One that exited right
+            # after reporting gets another poll for its result to
+            # arrive.
+            dead = [job for job in sorted(pending) if job in exited]
+            exited = set(job for job in pending
+                         if not processes[job].is_alive())
+            if dead:
+                for proc in processes.itervalues():
+                    if proc.is_alive():
+                        proc.terminate()
+                    proc.join()
+                raise RuntimeError("\n".join(
+                    _("%s build died (exit code %s)") %
+                    (job, processes[job].exitcode) for job in dead))
+            continue
+        pending.discard(name)
+        report(_("Finished %s import.") % name)
+        phases.extend((name, phase, seconds) for phase, seconds in job_phases)
+        telemetry[name] = summary
+        if error is not None:
+            errors.append((name, error))
+    for proc in processes.itervalues():
+        proc.join()
+    if len(errors) > 0:
+        raise RuntimeError("\n".join(_("%s build failed:\n%s") % error
+                                     for error in errors))
+
+    phase_timer = PhaseTimer()
+    if kanji_words and jmdict_files is not None and kd2_files is not None:
+        report(_("Building kanji to word cross index..."))
+        with phase_timer.phase("kanji_word"):
+            kanjiwords.build_kanji_word_index(targets["jmdict"],
+                                              targets["kd2"])
+    # The trie records the size and mtime of the database it was built
+    # from, so it is built after the last write to the file.  With
+    # swap, that happens once the database is validated.
+    if trie and jmdict_files is not None and not swap:
+        report(_("Building tokenizer trie..."))
+        with phase_timer.phase("trie"):
+            tokenizer.load_tokenizer(targets["jmdict"], rebuild=True)
+    phases.extend(("both", phase, seconds)
+                  for phase, seconds in phase_timer.phases)
+
+    row_counts = {}
+    if swap:
+        # Validate everything before replacing anything.
+        phase_timer = PhaseTimer()
+        with phase_timer.phase("validate"):
+            for name, files in (("jmdict", jmdict_files),
+                                ("kd2", kd2_files)):
+                if files is None:
+                    continue
+                try:
+                    row_counts[name] = validate_build(
+                        MODULES[name].Database, targets[name], files[1])
+                except ValueError as e:
+                    raise RuntimeError(_("%s build failed validation: %s")
+                                       % (name, e))
+        # The trie is built for the new file and moved in right after
+        # it; renaming keeps the size and mtime it was checked against.
+        if trie and jmdict_files is not None:
+            with phase_timer.phase("trie"):
+                tokenizer.load_tokenizer(targets["jmdict"], rebuild=True)
+        with phase_timer.phase("install"):
+            for name, files in (("jmdict", jmdict_files),
+                                ("kd2", kd2_files)):
+                if files is not None:
+                    report(_("Installing %s...") % files[1])
+                    replace_file(targets[name], files[1])
+                    if name == "jmdict" and trie:
+                        replace_file(
+                            tokenizer.get_trie_filename(targets[name]),
+                            tokenizer.get_trie_filename(files[1]))
+        phases.extend(("both", phase, seconds)
+                      for phase, seconds in phase_timer.phases)
+
+    return {"phases": phases, "telemetry": telemetry,
+            "row_counts": row_counts, "wall_time": time.time() - start}
+
+
+def format_report(result):
+    """Formats the result of build() as a table."""
+    lines = ["%-8s %-12s %10s" % (_("job"), _("phase"), _("seconds"))]
+    for job, phase, seconds in result["phases"]:
+        lines.append("%-8s %-12s %10.2f" % (job, phase, seconds))
+    serial = sum(seconds for job, phase, seconds in result["phases"])
+    lines.append(_("Sum of phases: %.2f s; wall time: %.2f s") %
+                 (serial, result["wall_time"]))
+    for name, summary in sorted(result.get("telemetry", {}).iteritems()):
+        times = summary["times"]
+        lines.append(_("%s: %d items (%.0f/s), %d rows, peak RSS %s KiB; "
+                       "parse %.2f s, shaping %.2f s, write %.2f s, "
+                       "index %.2f s") %
+                     (name, summary["items"], summary["items_per_sec"] or 0,
+                      sum(summary["rows"].itervalues()),
+                      summary["peak_rss_kb"], times["parse"],
+                      times["shaping"], times["write"], times["index"]))
+    return "\n".join(lines)
+
+
+######################################################################
+
+def parse_args():
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options]")
+    op.add_option("-j", "--jmdict-source", metavar="FILE",
+                  help=_("JMdict XML source (may be gzipped)."))
+    op.add_option("-J", "--jmdict-db", metavar="DB",
+                  help=_("JMdict database to create."))
+    op.add_option("-k", "--kd2-source", metavar="FILE",
+                  help=_("KANJIDIC2 XML source (may be gzipped)."))
+    op.add_option("-K", "--kd2-db", metavar="DB",
+                  help=_("KANJIDIC2 database to create."))
+    op.add_option("-E", "--encode", action="store_true",
+                  help=_("Store repetitive values as integer codes."))
+    op.add_option("--keep-lang", action="append", dest="langs",
+                  metavar="LANG",
+                  help=_("Import only glosses/meanings in this language "
+                         "(may be repeated)."))
+    op.add_option("-t", "--trie", action="store_true",
+                  help=_("Also build the JMdict tokenizer trie."))
+    op.add_option("-x", "--kanji-words", action="store_true",
+                  help=_("Also build the kanji to word cross index."))
+    op.add_option("-f", "--fuzzy", action="store_true",
+                  help=_("Also build the JMdict fuzzy search index."))
+    op.add_option("-R", "--resume", action="store_true",
+                  help=_("Continue interrupted imports where they "
+                         "left off."))
+    op.add_option("-S", "--swap", action="store_true",
+                  help=_("Build into temporary files and replace the "
+                         "databases only once they are built and "
+                         "validated."))
+    op.add_option("--json", action="store_true",
+                  help=_("Print the timing report as JSON."))
+    options, args = op.parse_args()
+    if (options.jmdict_source is None) != (options.jmdict_db is None) \
+            or (options.kd2_source is None) != (options.kd2_db is None) \
+            or (options.jmdict_source is None
+                and options.kd2_source is None):
+        op.print_help()
+        exit(-1)
+    return (options, args)
+
+def main():
+    options, args = parse_args()
+    jmdict_files = kd2_files = None
+    if options.jmdict_source is not None:
+        jmdict_files = (options.jmdict_source, options.jmdict_db)
+    if options.kd2_source is not None:
+        kd2_files = (options.kd2_source, options.kd2_db)
+
+    def log(msg):
+        print(msg, file=sys.stderr)
+    try:
+        result = build(jmdict_files, kd2_files, encode=options.encode,
+                       langs=options.langs, trie=options.trie,
+                       kanji_words=options.kanji_words,
+                       fuzzy_index=options.fuzzy,
+                       resume=options.resume, swap=options.swap,
+                       log=log)
+    except RuntimeError as e:
+        print(e, file=sys.stderr)
+        exit(1)
+
+    if options.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print(format_report(result))
+
+if __name__ == "__main__":
+    main()
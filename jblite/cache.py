@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""Persistent cache of search results.
+
+Popular searches repeat constantly, and each one re-runs the same
+scans over k_ele, r_ele and gloss.  A SearchCache keeps the ordered
+result IDs of recent searches in a sidecar SQLite file next to the
+database, keyed by (normalized query, language, search mode):
+
+    db = jmdict.Database("jmdict.db")
+    cache = db.enable_cache()          # uses jmdict.db.cache
+    db.search_ids(u"water", limit=20)  # computed and stored
+    db.search_ids(u"water", limit=20)  # read from the cache
+    print(cache.stats())
+
+The cache is tied to the content version recorded by the import (see
+Database.get_content_version()): when the database is rebuilt from
+different input, all cached results are dropped.  The number of
+cached searches is bounded; the least recently used ones are evicted
+first.
+
+"""
+
+from __future__ import with_statement
+
+import json, sqlite3
+from contextlib import contextmanager
+
+from helpers import pack_ids, unpack_ids
+from table import Table, MetadataTable
+
+
+class SearchCacheTable(Table):
+    """Maps a search key to its packed result IDs.
+
+    complete is 0 if the search stopped early (after filling a page),
+    in which case the IDs only answer requests for as many results.
+    used orders entries from least to most recently used.
+
+    """
+    create_query = ("CREATE TABLE IF NOT EXISTS %s "
+                    "(key TEXT PRIMARY KEY, ids BLOB, complete INTEGER, "
+                    "used INTEGER)")
+    insert_query = "INSERT OR REPLACE INTO %s VALUES (?, ?, ?, ?)"
+    index_queries = [
+        "CREATE INDEX IF NOT EXISTS %s_used ON %s (used)",
+        ]
+
+
+class SearchCache(object):
+
+    """LRU cache of search result IDs in its own SQLite file.
+
+    filename: the cache file; created if missing.
+    version: content version of the database the results come from.
+        Cached results for any other version are discarded.
+    max_entries: maximum number of cached searches.
+    hit_batch: number of hits whose recency is kept in memory before
+        being written to the file (see flush()).
+
+    Several processes may share the cache file: the number of entries
+    and the recency order are always read from the file, within the
+    transaction that changes them.  Losing the most recent writes on a
+    crash is harmless, so commits do not wait for the disk.
+
+    """
+
+    def __init__(self, filename, version, max_entries=10000, hit_batch=100):
+        self.filename = filename
+        self.max_entries = max_entries
+        self.hit_batch = hit_batch
+        # Transactions are managed explicitly, so that writes can take
+        # the lock before reading the state they depend on.
+        self.conn = sqlite3.connect(filename, timeout=10,
+                                    isolation_level=None)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute("PRAGMA journal_mode = WAL")
+        self.cursor.execute("PRAGMA synchronous = NORMAL")
+        self.table = SearchCacheTable(self.cursor, "search_cache")
+        self.metadata = MetadataTable(self.cursor, "metadata")
+        with self._write():
+            self.table.create()
+            self.metadata.create()
+        self.version = None
+        self.pending_hits = []
+        self.set_version(version)
+        self.reset_stats()
+
+    @contextmanager
+    def _write(self):
+        """Runs the with block in a write transaction.
+
+        The transaction is started with BEGIN IMMEDIATE, so no other
+        writer can interleave between reads and writes inside it.
+
+        """
+        self.cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except:
+            self.cursor.execute("ROLLBACK")
+            raise
+        self.cursor.execute("COMMIT")
+
+    def set_version(self, version):
+        """Switches to another content version, dropping the cached
+        results if it differs from the stored one."""
+        self.flush()
+        with self._write():
+            if self.metadata.get("version") != version:
+                self.cursor.execute("DELETE FROM %s" % self.table.name)
+                self.metadata.set("version", version)
+        self.version = version
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(query, lang, mode):
+        return json.dumps([query, lang, mode])
+
+    def get(self, key, needed=None):
+        """Returns the cached IDs for key, or None on a miss.
+
+        needed: number of results the caller needs (None for all).  A
+            partial result list with fewer IDs counts as a miss.
+
+        Hits are only recorded in memory; their recency is written in
+        batches.
+
+        """
+        self.cursor.execute("SELECT ids, complete FROM %s WHERE key = ?" %
+                            self.table.name, (key,))
+        row = self.cursor.fetchone()
+        if row is not None:
+            ids = unpack_ids(row[0])
+            if row[1] or (needed is not None and len(ids) >= needed):
+                self.hits += 1
+                self.pending_hits.append(key)
+                if len(self.pending_hits) >= self.hit_batch:
+                    self.flush()
+                return ids
+        self.misses += 1
+        return None
+
+    def put(self, key, ids, complete=True):
+        """Stores the result IDs of a search, evicting the least
+        recently used searches if the cache is full."""
+        with self._write():
+            self._write_hits()
+            self.table.insert(key, pack_ids(ids), int(complete),
+                              self._next_used())
+            self.cursor.execute("SELECT COUNT(*) FROM %s" % self.table.name)
+            excess = self.cursor.fetchone()[0] - self.max_entries
+            if excess > 0:
+                self.cursor.execute(
+                    "DELETE FROM %s WHERE key IN "
+                    "(SELECT key FROM %s ORDER BY used LIMIT ?)" %
+                    (self.table.name, self.table.name), (excess,))
+                self.evictions += excess
+
+    def flush(self):
+        """Writes the recency of the hits recorded since the last
+        flush."""
+        if len(self.pending_hits) > 0:
+            with self._write():
+                self._write_hits()
+
+    def _next_used(self):
+        self.cursor.execute("SELECT MAX(used) FROM %s" % self.table.name)
+        return (self.cursor.fetchone()[0] or 0) + 1
+
+    def _write_hits(self):
+        """Marks the pending hits as most recently used, in the order
+        they happened.  Must be called within a write transaction."""
+        if len(self.pending_hits) == 0:
+            return
+        used = self._next_used()
+        self.cursor.executemany(
+            "UPDATE %s SET used = ? WHERE key = ?" % self.table.name,
+            ((used + i, key) for i, key in enumerate(self.pending_hits)))
+        self.pending_hits = []
+
+    def clear(self):
+        self.pending_hits = []
+        with self._write():
+            self.cursor.execute("DELETE FROM %s" % self.table.name)
+
+    def count(self):
+        """Returns the number of cached searches."""
+        self.cursor.execute("SELECT COUNT(*) FROM %s" % self.table.name)
+        return self.cursor.fetchone()[0]
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups > 0 else None
+
+    def stats(self):
+        """Returns hit/miss counts since the last reset_stats() and the
+        current size of the cache."""
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "evictions": self.evictions,
+            "entries": self.count(),
+            "max_entries": self.max_entries,
+            }
+
+    def format_stats(self):
+        rate = self.hit_rate
+        return ("Search cache: %d hits, %d misses (hit rate %s), "
+                "%d/%d entries, %d evicted" %
+                (self.hits, self.misses,
+                 "%.1f%%" % (rate * 100) if rate is not None else "n/a",
+                 self.count(), self.max_entries, self.evictions))
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
@@ -0,0 +1,494 @@
+# -*- coding: utf-8 -*-
+"""Compact, memory-mappable export of JMdict and KANJIDIC2 databases.
+
+For deployments which cannot (or would rather not) use SQLite, a
+Database can be exported to a single read-only binary file:
+
+    python -m jblite.compact <source.db> <target.jbc>
+
+and read back with CompactDatabase, which returns the same Entry
+objects as Database.lookup().
+
+File layout (all integers little-endian):
+
+  - 8 byte magic, 4 byte directory length, UTF-8 JSON directory.
+    The directory lists every section below by offset (relative to
+    the start of the data area, which begins at the next multiple of
+    8 bytes).
+  - String pool: all TEXT values, deduplicated, stored once as UTF-8,
+    plus a uint32 offset table.  Columns refer to strings by index.
+  - One array of fixed-width records per table.  Each column uses
+    the narrowest of int8/int16/int32 which fits its values, so flags
+    and entity codes take a single byte.
+  - Per child table, a uint32 array indexed by parent ID giving the
+    first row of each parent's children (rows are sorted by fk).
+  - Sorted key arrays (string index, target ID) for headword or
+    literal lookups.
+
+Opening a file only parses the small directory; all other data is
+read in place from the memory map on demand.
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import os, json, mmap, struct, sqlite3
+
+from table import Record
+from helpers import get_encoding, convert_query_to_unicode
+import jmdict, kd2
+
+import gettext
+#t = gettext.translation("jblite")
+#_ = t.ugettext
+gettext.install("jblite")
+
+
+MAGIC = "JBLCMP\x00\x01"
+ALIGNMENT = 8
+
+# (typecode, min, max); the minimum is reserved for NULL.
+INT_TYPES = [("b", -2 ** 7, 2 ** 7 - 1),
+             ("h", -2 ** 15, 2 ** 15 - 1),
+             ("i", -2 ** 31, 2 ** 31 - 1)]
+
+# Per dictionary: database class, root table, tables outside of the
+# table map worth exporting, and key indices as (name, table, key
+# column, target column).
+KINDS = {
+    "jmdict": {
+        "database": jmdict.Database,
+        "root": "entry",
+        "extra_tables": ["entity"],
+        "key_indexes": [("headword", "k_ele", "value", "fk"),
+                        ("headword", "r_ele", "value", "fk")],
+        },
+    "kd2": {
+        "database": kd2.Database,
+        "root": "character",
+        "extra_tables": ["header"],
+        "key_indexes": [("literal", "character", "literal", "id")],
+        },
+    }
+
+
+def detect_kind(cursor):
+    """Returns "jmdict" or "kd2" depending on the tables present."""
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table'")
+    names = set(row[0] for row in cursor.fetchall())
+    for kind, info in KINDS.iteritems():
+        if info["root"] in names:
+            return kind
+    raise ValueError("Not a JMdict or KANJIDIC2 database")
+
+
+def _pick_int_type(values):
+    """Returns the narrowest typecode holding values plus a NULL marker."""
+    present = [v for v in values if v is not None]
+    low = min(present) if len(present) > 0 else 0
+    high = max(present) if len(present) > 0 else 0
+    for typecode, type_min, type_max in INT_TYPES:
+        if type_min < low and high <= type_max:
+            return typecode, type_min
+    raise ValueError("Integer column out of range: %d..%d" % (low, high))
+
+
+def _walk_table_map(table_map, parent=None):
+    """Yields (table, parent table) pairs, parents first."""
+    for table, children in table_map.iteritems():
+        yield table, parent
+        for pair in _walk_table_map(children, table):
+            yield pair
+
+
+class _Writer(object):
+
+    """Accumulates aligned binary sections."""
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+    def add(self, data):
+        """Appends data; returns its offset in the data area."""
+        offset = self.size
+        self.chunks.append(data)
+        self.size += len(data)
+        padding = -self.size % ALIGNMENT
+        if padding:
+            self.chunks.append("\x00" * padding)
+            self.size += padding
+        return offset
+
+    def add_array(self, typecode, values):
+        return self.add(struct.pack("<%d%s" % (len(values), typecode),
+                                    *values))
+
+
+class _StringPool(object):
+
+    def __init__(self):
+        self.index = {}
+        self.strings = []
+
+    def add(self, value):
+        if value is None:
+            return None
+        i = self.index.get(value)
+        if i is None:
+            i = self.index[value] = len(self.strings)
+            self.strings.append(value)
+        return i
+
+    def write(self, writer):
+        encoded = [s.encode("utf-8") for s in self.strings]
+        offsets = [0]
+        for data in encoded:
+            offsets.append(offsets[-1] + len(data))
+        return {"count": len(encoded),
+                "offsets": writer.add_array("I", offsets),
+                "data": writer.add("".join(encoded))}
+
+
+def export_database(db_fname, out_fname, kind=None):
+    """Writes a compact binary copy of a JMdict or KANJIDIC2 database.
+
+    kind: "jmdict" or "kd2"; detected from the database if None.
+
+    Returns the size of the written file in bytes.
+
+    """
+    conn = sqlite3.connect(db_fname)
+    cursor = conn.cursor()
+    db = None
+    try:
+        if kind is None:
+            kind = detect_kind(cursor)
+        info = KINDS[kind]
+        table_map = info["database"].table_map
+        # Used to decode dictionary-encoded columns, if any.
+        db = info["database"](db_fname)
+
+        writer = _Writer()
+        pool = _StringPool()
+        directory = {"kind": kind, "root": info["root"], "tables": {},
+                     "keys": {}}
+
+        tables = list(_walk_table_map(table_map))
+        tables += [(name, None) for name in info["extra_tables"]]
+        table_rows = {}
+        for table, parent in tables:
+            cursor.execute("PRAGMA table_info(%s)" % table)
+            columns = [(row[1], row[2].upper()) for row in cursor.fetchall()]
+            names = [name for name, decl_type in columns]
+            order = "fk, id" if "fk" in names else \
+                ("id" if "id" in names else "rowid")
+            cursor.execute("SELECT * FROM %s ORDER BY %s" % (table, order))
+            rows = cursor.fetchall()
+            table_obj = db.tables.get(table)
+            if table_obj is not None and table_obj.is_encoded():
+                rows = [table_obj.decode_row(names, row) for row in rows]
+                columns = [(name, "TEXT" if name in table_obj.encoded_columns
+                            else decl_type) for name, decl_type in columns]
+            table_rows[table] = (names, rows)
+
+            table_dir = {"rows": len(rows), "parent": parent, "columns": []}
+            encoded_columns = []
+            for position, (name, decl_type) in enumerate(columns):
+                values = [row[position] for row in rows]
+                if decl_type == "TEXT":
+                    values = [pool.add(value) for value in values]
+                    column_kind = "str"
+                else:
+                    column_kind = "int"
+                typecode, null = _pick_int_type(values)
+                nullable = None in values
+                encoded_columns.append([null if value is None else value
+                                        for value in values])
+                table_dir["columns"].append({
+                    "name": name, "kind": column_kind, "type": typecode,
+                    "null": null if nullable else None})
+            record = struct.Struct("<" + "".join(
+                column["type"] for column in table_dir["columns"]))
+            table_dir["offset"] = writer.add("".join(
+                record.pack(*values) for values in zip(*encoded_columns)))
+
+            if parent is not None:
+                # starts[p] .. starts[p + 1] are the rows with fk == p.
+                fk_position = names.index("fk")
+                max_fk = max([row[fk_position] for row in rows] or [0])
+                starts = [0] * (max_fk + 2)
+                for row in rows:
+                    starts[row[fk_position] + 1] += 1
+                for i in xrange(1, len(starts)):
+                    starts[i] += starts[i - 1]
+                table_dir["fk_count"] = len(starts)
+                table_dir["fk_index"] = writer.add_array("I", starts)
+            directory["tables"][table] = table_dir
+
+        key_entries = {}
+        for key_name, table, key_column, target_column in \
+                info["key_indexes"]:
+            names, rows = table_rows[table]
+            key_position = names.index(key_column)
+            target_position = names.index(target_column)
+            entries = key_entries.setdefault(key_name, set())
+            for row in rows:
+                if row[key_position] is not None:
+                    entries.add((row[key_position].encode("utf-8"),
+                                 pool.add(row[key_position]),
+                                 row[target_position]))
+        for key_name, entries in key_entries.iteritems():
+            entries = sorted(entries)
+            directory["keys"][key_name] = {
+                "count": len(entries),
+                "strings": writer.add_array("i", [e[1] for e in entries]),
+                "targets": writer.add_array("i", [e[2] for e in entries])}
+
+        directory["strings"] = pool.write(writer)
+    finally:
+        if db is not None:
+            db.conn.close()
+        cursor.close()
+        conn.close()
+
+    header = json.dumps(directory, sort_keys=True)
+    prefix = MAGIC + struct.pack("<I", len(header)) + header
+    prefix += "\x00" * (-len(prefix) % ALIGNMENT)
+    with open(out_fname, "wb") as outfile:
+        outfile.write(prefix)
+        for chunk in writer.chunks:
+            outfile.write(chunk)
+    return len(prefix) + writer.size
+
+
+######################################################################
+# Reader
+######################################################################
+
+
+class _Table(object):
+
+    """Reader for one table's fixed-width records."""
+
+    def __init__(self, mm, base, table_dir):
+        self.mm = mm
+        self.rows = table_dir["rows"]
+        self.parent = table_dir["parent"]
+        columns = table_dir["columns"]
+        self.names = [column["name"] for column in columns]
+        self.nullable = [(i, column["null"])
+                         for i, column in enumerate(columns)
+                         if column["null"] is not None]
+        self.str_columns = [i for i, column in enumerate(columns)
+                            if column["kind"] == "str"]
+        self.record = struct.Struct(
+            "<" + "".join(column["type"] for column in columns))
+        self.offset = base + table_dir["offset"]
+        self.id_position = (self.names.index("id") if "id" in self.names
+                            else None)
+        if "fk_index" in table_dir:
+            self.fk_count = table_dir["fk_count"]
+            self.fk_index = base + table_dir["fk_index"]
+
+    def get(self, row):
+        """Returns the raw values of a row as a list."""
+        return list(self.record.unpack_from(
+            self.mm, self.offset + row * self.record.size))
+
+
+class CompactDatabase(object):
+
+    """Read-only dictionary backed by a memory-mapped compact file.
+
+    Supports the lookup API of the SQLite-based Database classes:
+    lookup(id) returns the same Entry objects, built from the same
+    Record trees.
+
+    """
+
+    _uint32 = struct.Struct("<I")
+    _int32 = struct.Struct("<i")
+
+    def __init__(self, filename):
+        self._file = open(filename, "rb")
+        self._mm = mm = mmap.mmap(self._file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+        if mm[:len(MAGIC)] != MAGIC:
+            raise ValueError("Not a compact jblite file: %s" % filename)
+        header_len = self._uint32.unpack_from(mm, len(MAGIC))[0]
+        header_start = len(MAGIC) + 4
+        directory = json.loads(mm[header_start:header_start + header_len])
+        base = header_start + header_len
+        self._base = base = base + (-base % ALIGNMENT)
+
+        self.kind = directory["kind"]
+        info = KINDS[self.kind]
+        self.entry_class = info["database"].entry_class
+        self.table_map = info["database"].table_map
+        self.root = directory["root"]
+        self._string_bounds = struct.Struct("<II")
+        self._string_offsets = base + directory["strings"]["offsets"]
+        self._string_data = base + directory["strings"]["data"]
+
+        self._tables = dict((name, _Table(mm, base, table_dir))
+                            for name, table_dir
+                            in directory["tables"].iteritems())
+        self._keys = directory["keys"]
+
+    def close(self):
+        self._mm.close()
+        self._file.close()
+
+    def _string(self, index):
+        start, end = self._string_bounds.unpack_from(
+            self._mm, self._string_offsets + index * 4)
+        data = self._string_data
+        return self._mm[data + start:data + end].decode("utf-8")
+
+    def _row(self, table, row):
+        values = table.get(row)
+        for i, null in table.nullable:
+            if values[i] == null:
+                values[i] = None
+        string = self._string
+        for i in table.str_columns:
+            if values[i] is not None:
+                values[i] = string(values[i])
+        return dict(zip(table.names, values))
+
+    def _find_row_by_id(self, table, id):
+        """Finds the row holding an ID.  Returns None if not found."""
+        position = table.id_position
+        # IDs are usually dense, starting at 1.
+        if 0 < id <= table.rows and table.get(id - 1)[position] == id:
+            return id - 1
+        low, high = 0, table.rows
+        while low < high:
+            mid = (low + high) // 2
+            if table.get(mid)[position] < id:
+                low = mid + 1
+            else:
+                high = mid
+        if low < table.rows and table.get(low)[position] == id:
+            return low
+        return None
+
+    def _child_rows(self, table, fk):
+        if fk + 1 >= table.fk_count:
+            return xrange(0)
+        start, end = struct.unpack_from("<II", self._mm,
+                                        table.fk_index + fk * 4)
+        return xrange(start, end)
+
+    def _lookup_children(self, children_map, fk):
+        children = {}
+        for child_name, grandchild_map in children_map.iteritems():
+            table = self._tables[child_name]
+            records = []
+            for row in self._child_rows(table, fk):
+                data = self._row(table, row)
+                if len(grandchild_map) > 0:
+                    grandchildren = self._lookup_children(grandchild_map,
+                                                          data["id"])
+                else:
+                    grandchildren = {}
+                records.append(Record(data, grandchildren))
+            if len(records) > 0:
+                children[child_name] = records
+        return children
+
+    def lookup(self, id):
+        """Returns the Entry with the given root table ID, or None."""
+        table = self._tables[self.root]
+        row = self._find_row_by_id(table, id)
+        if row is None:
+            return None
+        data = self._row(table, row)
+        children = self._lookup_children(self.table_map[self.root], id)
+        return self.entry_class(Record(data, children))
+
+    def find_ids(self, key, index_name=None):
+        """Returns the root IDs for an exact key (headword or literal).
+
+        index_name defaults to the only key index of the file.
+
+        """
+        key = convert_query_to_unicode(key).encode("utf-8")
+        if index_name is None:
+            index_name = self._keys.keys()[0]
+        key_dir = self._keys[index_name]
+        strings = self._base + key_dir["strings"]
+        targets = self._base + key_dir["targets"]
+        def key_at(i):
+            string = self._int32.unpack_from(self._mm, strings + i * 4)[0]
+            return self._string(string).encode("utf-8")
+
+        low, high = 0, key_dir["count"]
+        while low < high:
+            mid = (low + high) // 2
+            if key_at(mid) < key:
+                low = mid + 1
+            else:
+                high = mid
+        ids = []
+        while low < key_dir["count"] and key_at(low) == key:
+            target = self._int32.unpack_from(self._mm, targets + low * 4)[0]
+            if target not in ids:
+                ids.append(target)
+            low += 1
+        return ids
+
+    def find(self, key, index_name=None):
+        """Like find_ids(), but returns Entry objects."""
+        return [self.lookup(id) for id in self.find_ids(key, index_name)]
+
+    def rows(self, table):
+        """Yields every row of a table as a dictionary."""
+        table = self._tables[table]
+        for row in xrange(table.rows):
+            yield self._row(table, row)
+
+
+######################################################################
+
+def parse_args():
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options] <source_db> <target_file>\n"
+                      "       %prog --lookup=KEY <compact_file>")
+    op.add_option("-t", "--type", dest="kind", choices=KINDS.keys(),
+                  help=_("Dictionary type (jmdict or kd2); detected "
+                         "automatically if omitted."))
+    op.add_option("-l", "--lookup", metavar="KEY",
+                  help=_("Look up a headword or literal in an exported "
+                         "file."))
+    options, args = op.parse_args()
+    if len(args) < (1 if options.lookup is not None else 2):
+        op.print_help()
+        exit(-1)
+    return (options, args)
+
+def main():
+    options, args = parse_args()
+    encoding = get_encoding()
+    if options.lookup is not None:
+        db = CompactDatabase(args[0])
+        results = db.find(options.lookup.decode(encoding))
+        if len(results) > 0:
+            for index, result in enumerate(results):
+                index += 1
+                print(_("[Entry %d]") % index)
+
+                print(unicode(result).encode(encoding))
+                print()
+        else:
+            print(_("No results found."))
+        return
+
+    size = export_database(args[0], args[1], options.kind)
+    print(_("Wrote %d bytes (source: %d bytes).") %
+          (size, os.path.getsize(args[0])))
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,480 @@
 """Base database object support."""
 
-from table import Record
+import os, json, sqlite3, hashlib, functools, multiprocessing
+from timeit import default_timer as timer
+
+from helpers import file_digest
+from table import Record, CodeTable, Codebook, MetadataTable
+from instrument import QueryProfiler, ProfilingCursor, TelemetryCursor
+from cache import SearchCache
+
+
+def _get_file_id(filename):
+    """Returns (device, inode) of filename, or None if it is missing."""
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    return (stat.st_dev, stat.st_ino)
+
+
+def prune_table_map(children_map, spec):
+    """Returns the part of children_map selected by spec.
+
+    spec is either a nested dictionary shaped like the table_map
+    (table name to the spec for its children: {} for the table alone,
+    None for the table with all its descendants), or a list of dotted
+    paths such as ["k_ele", "sense.gloss"], where a path implies its
+    parent tables.
+
+    Raises ValueError for tables not in children_map.
+
+    """
+    if not isinstance(spec, dict):
+        paths = spec
+        spec = {}
+        for path in paths:
+            node = spec
+            for table in path.split("."):
+                node = node.setdefault(table, {})
+    result = {}
+    for table, child_spec in spec.iteritems():
+        if table not in children_map:
+            raise ValueError("Unknown table in projection: %r" % table)
+        if child_spec is None:
+            result[table] = children_map[table]
+        else:
+            result[table] = prune_table_map(children_map[table], child_spec)
+    return result
+
+
+def request(method):
+    """Decorator for public query methods.
+
+    Before a request starts, the database is reopened if its file has
+    been replaced (see Database.refresh()).  Calls made from within a
+    request do not check, so a request never mixes data from two
+    files.
+
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._request_depth == 0:
+            self.refresh()
+        self._request_depth += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self._request_depth -= 1
+    return wrapper
 
 
 class Database(object):
 
     entry_class = None
     table_map = None
+    profiler = None
+    codebook = None
+    metadata = None
+    filename = None
+    search_cache = None
+
+    # Version of the table layout, stored in the metadata table by
+    # imports and checked by validate().
+    schema_version = None
+
+    # Named projections for lookups: preset name to a spec for
+    # prune_table_map().  "full" (the whole table_map) is implied.
+    projections = {}
+
+    # Imports commit (and record how far they got) every this many
+    # entries/characters.
+    checkpoint_interval = 5000
+
+    # Tables and metadata keys built from the imported data by other
+    # modules.  A fresh import drops them, since they would refer to
+    # the old rows.
+    derived_tables = ()
+    derived_metadata = ()
+
+    _file_id = None
+    _request_depth = 0
 
     def __init__(self):
         self.tables = {}
 
-    def lookup(self, root_table_name, entry_id):
+    def _connect(self, filename):
+        """Opens the connection and cursor for filename."""
+        self.filename = filename
+        self._file_id = _get_file_id(filename)
+        self.conn = sqlite3.connect(filename)
+        self.conn.row_factory = sqlite3.Row  # keyword accessors for rows
+        self.cursor = self.conn.cursor()
+
+    def reopen(self):
+        """Reopens the database file and reloads cached data."""
+        profiler = self.disable_profiling()
+        self.conn.close()
+        self._connect(self.filename)
+        self._set_cursor(self.cursor)
+        self._setup_codebook()
+        self._load_caches()
+        if profiler is not None:
+            self.enable_profiling(profiler)
+        if self.search_cache is not None:
+            self.search_cache.set_version(self.get_content_version())
+
+    def refresh(self):
+        """Reopens the database if its file has been replaced.
+
+        A file built elsewhere and renamed into place (see
+        install_database()) is detected by its inode.  Connections
+        keep reading the old file until this is called, which query
+        methods do before each request.
+
+        Returns True if the database was reopened.
+
+        """
+        if self.filename is None:
+            return False
+        file_id = _get_file_id(self.filename)
+        if file_id is None or file_id == self._file_id:
+            return False
+        self.reopen()
+        return True
+
+    def _load_caches(self):
+        """Reloads in-memory data derived from the database."""
+        pass
+
+    def enable_profiling(self, profiler=None):
+        """Routes all queries through a QueryProfiler.
+
+        If profiler is None, a new QueryProfiler is created.  Returns
+        the profiler in use.
+
+        """
+        if profiler is None:
+            profiler = QueryProfiler()
+        self.disable_profiling()
+        self.profiler = profiler
+        self._set_cursor(ProfilingCursor(self.cursor, profiler))
+        return profiler
+
+    def disable_profiling(self):
+        """Restores the raw cursor.  Returns the previous profiler."""
+        profiler = self.profiler
+        if isinstance(self.cursor, ProfilingCursor):
+            self.cursor.finish()
+            self._set_cursor(self.cursor.cursor)
+        self.profiler = None
+        return profiler
+
+    def _set_cursor(self, cursor):
+        self.cursor = cursor
+        for table in self.tables.itervalues():
+            table.cursor = cursor
+        if self.codebook is not None:
+            self.codebook.table.cursor = cursor
+        if self.metadata is not None:
+            self.metadata.cursor = cursor
+
+    def enable_cache(self, filename=None, max_entries=10000):
+        """Caches search results in a sidecar file (see SearchCache).
+
+        filename defaults to the database file name plus ".cache".
+        Returns the SearchCache in use.
+
+        """
+        if filename is None:
+            filename = self.filename + ".cache"
+        self.disable_cache()
+        self.search_cache = SearchCache(filename, self.get_content_version(),
+                                        max_entries)
+        return self.search_cache
+
+    def disable_cache(self):
+        """Stops caching search results.  Returns the previous cache."""
+        cache = self.search_cache
+        self.search_cache = None
+        if cache is not None:
+            cache.flush()
+        return cache
+
+    def get_content_version(self):
+        """Returns a string identifying the database contents.
+
+        Imports record a hash of the source file, the import options
+        and the schema version.  For databases without one, the size
+        and modification time of the file are used instead.
+
+        """
+        version = self._get_metadata().get("content_version")
+        if version is None:
+            stat = os.stat(self.filename)
+            version = "file:%d:%d" % (stat.st_size, stat.st_mtime)
+        return version
+
+    def _cached_search(self, search, query, lang, mode, needed=None):
+        """Returns search(), through the search cache if enabled.
+
+        search() must return the ordered result IDs for (query, lang)
+        in the given mode, at least the first needed ones (None for
+        all).  Results are stored as complete unless the list is long
+        enough that the search may have stopped early.
+
+        """
+        if self.search_cache is None:
+            return search()
+        key = self.search_cache.make_key(query, lang, mode)
+        ids = self.search_cache.get(key, needed)
+        if ids is None:
+            ids = search()
+            self.search_cache.put(key, ids,
+                                  needed is None or len(ids) < needed)
+        return ids
+
+    def _get_metadata(self):
+        """Returns the MetadataTable (which may not exist yet)."""
+        if self.metadata is None:
+            self.metadata = MetadataTable(self.cursor, "metadata")
+        return self.metadata
+
+    def _setup_codebook(self, encode=None):
+        """Sets up dictionary encoding of repetitive TEXT columns.
+
+        encode: True to (re)create the code table for a new import,
+            False to drop it, or None to use encoding only if the
+            database already has a code table.
+
+        Must be called before tables are created, since encoded
+        columns are declared as INTEGER.
+
+        """
+        table = CodeTable(self.cursor, "code")
+        if encode is None:
+            self.cursor.execute("SELECT 1 FROM sqlite_master "
+                                "WHERE type = 'table' AND name = 'code'")
+            encode = self.cursor.fetchone() is not None
+        else:
+            self.cursor.execute("DROP TABLE IF EXISTS code")
+            if encode:
+                table.create()
+
+        if encode:
+            self.codebook = Codebook(table)
+            self.codebook.load()
+        else:
+            self.codebook = None
+        for tbl in self.tables.itervalues():
+            tbl.codebook = self.codebook
+
+    def _create_indexes(self, table_names=None):
+        """Creates the indices of tables created with indexes=False.
+
+        SQLite builds one index at a time per database, but may use
+        several threads to sort the keys of each.
+
+        """
+        if table_names is None:
+            table_names = self.tables.keys()
+        try:
+            threads = multiprocessing.cpu_count()
+        except NotImplementedError:
+            threads = 1
+        self.cursor.execute("PRAGMA threads = %d" % threads)
+        for name in sorted(table_names):
+            self.tables[name].create_indexes()
+
+    def _begin_import(self, fname, options, resume=False):
+        """Finds or starts the import state of fname.
+
+        An import records its progress under the "import_state"
+        metadata key until it completes.  With resume, the state of an
+        interrupted import of the same file (same path, size and mtime)
+        with the same options is returned, and the caller should carry
+        on from there.  Otherwise, any old state and derived data (see
+        derived_tables) are cleared and a fresh state is returned,
+        which the caller should save with _save_import_state() once
+        the tables are created.
+
+        Returns (state, resumed).
+
+        The state is a dictionary: "stage" ("populate" or "index"),
+        "items" (number of elements fully written) and "key" (the key
+        of the last of them).
+
+        """
+        stat = os.stat(fname)
+        signature = {"source": os.path.abspath(fname), "size": stat.st_size,
+                     "mtime": stat.st_mtime, "options": options}
+        # Normalize to what a JSON round trip returns.
+        signature = json.loads(json.dumps(signature))
+        metadata = self._get_metadata()
+        state = metadata.get("import_state")
+        if resume and state is not None and state["signature"] == signature:
+            return state, True
+        metadata.delete("import_state")
+        for key in self.derived_metadata:
+            metadata.delete(key)
+        for name in self.derived_tables:
+            self.cursor.execute("DROP TABLE IF EXISTS %s" % name)
+        self.conn.commit()
+        return ({"signature": signature, "stage": "populate", "items": 0,
+                 "key": None}, False)
+
+    def _save_import_state(self, state):
+        """Records state and commits everything written so far."""
+        metadata = self._get_metadata()
+        metadata.create()
+        metadata.set("import_state", state)
+        self.conn.commit()
+
+    def _finish_import(self, state):
+        """Marks the import as complete and records the schema and
+        content versions."""
+        signature = state["signature"]
+        content = hashlib.sha1(json.dumps(
+            [file_digest(signature["source"]), signature["options"],
+             self.schema_version], sort_keys=True))
+        metadata = self._get_metadata()
+        metadata.delete("import_state")
+        metadata.set("schema_version", self.schema_version)
+        metadata.set("content_version", content.hexdigest())
+        self.conn.commit()
+
+    def _checkpointed(self, elements, state, get_key, telemetry=None):
+        """Yields the elements an import still has to write.
+
+        The first state["items"] elements were written by an earlier
+        run and are skipped.  Every checkpoint_interval elements, the
+        state is saved and committed; since this happens when the
+        caller asks for the next element, the previous ones have been
+        written completely.  get_key(element) returns the key recorded
+        with a checkpoint, which must match when skipping.
+
+        """
+        skip = state["items"]
+        items = 0
+        key = None
+        for elem in elements:
+            if items < skip:
+                items += 1
+                key = get_key(elem)
+                if telemetry is not None:
+                    telemetry.skip()
+                if items == skip and key != state["key"]:
+                    raise ValueError(
+                        "Cannot resume import: expected %r at position %d, "
+                        "found %r" % (state["key"], skip, key))
+                continue
+            if items > skip and items % self.checkpoint_interval == 0:
+                state["items"] = items
+                state["key"] = key
+                self._save_import_state(state)
+            key = get_key(elem)
+            yield elem
+            items += 1
+        if items < skip:
+            raise ValueError("Cannot resume import: input has only %d of %d "
+                             "imported elements" % (items, skip))
+        state["items"] = items
+        state["key"] = key
+
+    def _drop_indexes(self):
+        """Drops the indices of all tables (for example, ones left by an
+        interrupted index phase)."""
+        for name in self.tables:
+            self.cursor.execute("SELECT name FROM sqlite_master "
+                                "WHERE type = 'index' AND tbl_name = ? "
+                                "AND sql IS NOT NULL", (name,))
+            for row in self.cursor.fetchall():
+                self.cursor.execute("DROP INDEX %s" % row[0])
+
+    def _populate_with_telemetry(self, telemetry, populate, *args):
+        """Calls populate(*args), reporting writes to telemetry.
+
+        Time not accounted for by parsing or writing is counted as
+        row shaping.
+
+        """
+        start = timer()
+        parse_time = telemetry.times["parse"]
+        write_time = telemetry.times["write"]
+        cursor = self.cursor
+        self._set_cursor(TelemetryCursor(cursor, telemetry))
+        try:
+            populate(*args)
+        finally:
+            self._set_cursor(cursor)
+        elapsed = timer() - start
+        telemetry.add_time("shaping", elapsed
+                           - (telemetry.times["parse"] - parse_time)
+                           - (telemetry.times["write"] - write_time))
+
+    def count_rows(self):
+        """Returns a dictionary of table name to row count."""
+        counts = {}
+        for name in sorted(self.tables):
+            try:
+                self.cursor.execute("SELECT COUNT(*) FROM %s" % name)
+            except sqlite3.OperationalError:
+                raise ValueError("Missing table: %s" % name)
+            counts[name] = self.cursor.fetchone()[0]
+        return counts
+
+    def validate(self, previous_count=None, min_ratio=0.9):
+        """Checks that a newly built database is fit for use.
+
+        The import must have completed with the current
+        schema_version, SQLite's integrity check must pass, all tables
+        must exist and the root table must not be empty.  If
+        previous_count (root table rows of the database being
+        replaced) is given, the new one must have at least min_ratio
+        times as many, to catch truncated input.
+
+        Returns the row counts (see count_rows()).  Raises ValueError
+        if a check fails.
+
+        """
+        metadata = self._get_metadata()
+        if metadata.get("import_state") is not None:
+            raise ValueError("Import did not complete")
+        version = metadata.get("schema_version")
+        if version != self.schema_version:
+            raise ValueError("Schema version is %r, expected %r" %
+                             (version, self.schema_version))
+        self.cursor.execute("PRAGMA integrity_check")
+        problems = [row[0] for row in self.cursor.fetchall()]
+        if problems != ["ok"]:
+            raise ValueError("Integrity check failed: %s" %
+                             "; ".join(problems[:10]))
+        counts = self.count_rows()
+        root = self.table_map.keys()[0]
+        if counts[root] == 0:
+            raise ValueError("No rows in %s" % root)
+        if previous_count and counts[root] < previous_count * min_ratio:
+            raise ValueError("Only %d rows in %s, previously %d" %
+                             (counts[root], root, previous_count))
+        return counts
+
+    def get_children_map(self, root_table_name, projection=None):
+        """Returns the table_map subtree of the root table to load.
+
+        projection: None or "full" for everything, the name of a
+            preset in projections, or a spec for prune_table_map().
+
+        """
+        children_map = self.table_map[root_table_name]
+        if projection is None or projection == "full":
+            return children_map
+        if isinstance(projection, basestring):
+            if projection not in self.projections:
+                raise ValueError("Unknown projection: %r" % projection)
+            projection = self.projections[projection]
+        return prune_table_map(children_map, projection)
+
+    def lookup(self, root_table_name, entry_id, projection=None):
         """Creates an entry object.
 
         Finds a record based upon the root table.  (This contains all
@@ -19,15 +482,62 @@ class Database(object):
         which provides logic for displaying or otherwise using the
         data.
 
+        projection: which child tables to load; see
+            get_children_map().  Tables left out are never queried
+            and appear empty in the record.
+
         """
         # Lookup data in root table.
         data = self.tables[root_table_name].lookup_by_id(entry_id)
         # Lookup child data using the entry id as a foreign key.
-        children = self._lookup_children(self.table_map[root_table_name],
-                                         data['id'])
+        children = self._lookup_children(
+            self.get_children_map(root_table_name, projection), data['id'])
         record = Record(data, children)
         return self.entry_class(record)
 
+    def lookup_many(self, root_table_name, entry_ids, projection=None):
+        """Creates entry objects for a list of IDs.
+
+        Equivalent to calling lookup() for each ID, but each table is
+        queried once per batch of IDs rather than once per row, so
+        the number of queries does not depend on the number of
+        entries.
+
+        Returns a list of entry objects in the order of entry_ids.
+        IDs not found in the database are skipped.
+
+        """
+        entry_ids = list(entry_ids)
+        rows_by_id = self.tables[root_table_name].lookup_by_ids(
+            set(entry_ids))
+        children_by_id = self._lookup_children_many(
+            self.get_children_map(root_table_name, projection),
+            rows_by_id.keys())
+        return [self.entry_class(Record(rows_by_id[entry_id],
+                                        children_by_id.get(entry_id, {})))
+                for entry_id in entry_ids if entry_id in rows_by_id]
+
+    def _lookup_children_many(self, children_map, fks):
+        """Batched version of _lookup_children().
+
+        Returns a dictionary of foreign key to children dictionary.
+
+        """
+        results = {}
+        if len(fks) == 0:
+            return results
+        for child_table, grandchild_map in children_map.iteritems():
+            rows_by_fk = self.tables[child_table].lookup_by_fks(fks)
+            row_ids = [row["id"] for rows in rows_by_fk.itervalues()
+                       for row in rows]
+            grandchildren = self._lookup_children_many(grandchild_map,
+                                                       row_ids)
+            for fk, rows in rows_by_fk.iteritems():
+                results.setdefault(fk, {})[child_table] = [
+                    Record(row, grandchildren.get(row["id"], {}))
+                    for row in rows]
+        return results
+
     def _lookup_children(self, children_map, fk):
         children = {}
         for child_table in children_map:
@@ -54,3 +564,166 @@ class Database(object):
             record = Record(row, children)
             results.append(record)
         return results
+
+    def iter_dicts(self, batch_size=1000):
+        """Yields every entry of the database as a dictionary.
+
+        The dictionaries match Record.as_dict() of the corresponding
+        lookup() result, but are built in a single ordered pass over
+        each table: child rows are read sorted by fk and merged with
+        their parents, so memory use does not grow with the size of
+        the database.  Entries are yielded in ID order.
+
+        This relies on IDs increasing with the parent's ID, which is
+        always the case for databases built by the importers.
+
+        """
+        root_table_name = self.table_map.keys()[0]
+        root = self.conn.cursor()
+        root.row_factory = None
+        root.execute("SELECT * FROM %s ORDER BY id" % root_table_name)
+        root_names = [d[0] for d in root.description]
+        root_table = self.tables[root_table_name]
+        streams = self._open_fk_streams(self.table_map[root_table_name],
+                                        batch_size)
+        while True:
+            rows = root.fetchmany(batch_size)
+            if len(rows) == 0:
+                break
+            for row in rows:
+                data = dict(zip(root_names,
+                                root_table.decode_row(root_names, row)))
+                yield self._merge_children(
+                    data, self.table_map[root_table_name], streams)
+
+    def _open_fk_streams(self, children_map, batch_size):
+        streams = {}
+        for table_name, grandchild_map in children_map.iteritems():
+            streams[table_name] = FkStream(self.conn,
+                                           self.tables[table_name],
+                                           batch_size)
+            streams.update(self._open_fk_streams(grandchild_map,
+                                                 batch_size))
+        return streams
+
+    def _merge_children(self, data, children_map, streams):
+        children = {}
+        for table_name, grandchild_map in children_map.iteritems():
+            rows = streams[table_name].take(data["id"])
+            if len(rows) > 0:
+                children[table_name] = [
+                    self._merge_children(row, grandchild_map, streams)
+                    for row in rows]
+        result = {}
+        if len(data) > 0:
+            result[u"data"] = data
+        if len(children) > 0:
+            result[u"children"] = children
+        return result
+
+
+class FkStream(object):
+
+    """Reads a child table in foreign key order, one parent at a time."""
+
+    def __init__(self, conn, table, batch_size=1000):
+        self.table = table
+        self.cursor = conn.cursor()
+        self.cursor.row_factory = None
+        self.cursor.execute("SELECT * FROM %s ORDER BY fk, id" % table.name)
+        self.names = [d[0] for d in self.cursor.description]
+        self.fk_position = self.names.index("fk")
+        self.batch_size = batch_size
+        self.buffer = []
+        self.position = 0
+
+    def _peek(self):
+        if self.position >= len(self.buffer):
+            self.buffer = self.cursor.fetchmany(self.batch_size)
+            self.position = 0
+            if len(self.buffer) == 0:
+                return None
+        return self.buffer[self.position]
+
+    def take(self, fk):
+        """Returns the rows (as dictionaries) with the given fk.
+
+        Rows with lower foreign keys, which have no parent, are
+        skipped.
+
+        """
+        results = []
+        while True:
+            row = self._peek()
+            if row is None or row[self.fk_position] > fk:
+                break
+            if row[self.fk_position] == fk:
+                results.append(dict(zip(self.names,
+                                        self.table.decode_row(self.names,
+                                                              row))))
+            self.position += 1
+        return results
+
+
+
+######################################################################
+# Atomic rebuilds
+######################################################################
+
+
+def get_build_filename(filename):
+    """Returns the sibling file a database is built in before being
+    installed as filename."""
+    return filename + ".new"
+
+
+def validate_build(database_class, build_fname, filename, min_ratio=0.9):
+    """Validates a database built to replace filename.
+
+    See Database.validate() for the checks and min_ratio.  Returns the
+    row counts of the new database; raises ValueError if a check
+    fails.
+
+    """
+    previous_count = None
+    if os.path.exists(filename):
+        root = database_class.table_map.keys()[0]
+        conn = sqlite3.connect(filename)
+        try:
+            previous_count = conn.execute(
+                "SELECT COUNT(*) FROM %s" % root).fetchone()[0]
+        except sqlite3.OperationalError:
+            pass  # No usable old database to compare with.
+        finally:
+            conn.close()
+
+    db = database_class(build_fname)
+    try:
+        return db.validate(previous_count, min_ratio)
+    finally:
+        db.conn.close()
+
+
+def replace_file(build_fname, filename):
+    """Renames build_fname to filename.
+
+    The rename is atomic (except on Windows, where the old file must
+    be removed first), so readers see either the old or the new
+    database; open Database objects switch over at their next request.
+
+    """
+    if os.name == "nt" and os.path.exists(filename):
+        os.remove(filename)
+    os.rename(build_fname, filename)
+
+
+def install_database(database_class, build_fname, filename, min_ratio=0.9):
+    """Validates a newly built database and renames it into place.
+
+    Returns the row counts of the new database.  Raises ValueError
+    (leaving both files alone) if validation fails.
+
+    """
+    counts = validate_build(database_class, build_fname, filename, min_ratio)
+    replace_file(build_fname, filename)
+    return counts
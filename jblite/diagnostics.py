@@ -0,0 +1,428 @@
+# -*- coding: utf-8 -*-
+"""Query plan audit for JMdict and KANJIDIC2 databases.
+
+Runs the public search/lookup methods of each database with a query
+recorder attached, so every statement they can produce is captured
+exactly as issued (including dynamically built SQL).  Each distinct
+statement is then run through EXPLAIN QUERY PLAN, and any full scan
+of a large table is reported along with a suggested covering index.
+
+    python -m jblite.diagnostics [-j jmdict.db] [-k kd2.db]
+
+The exit status is nonzero if any unexpected scan was found, so this
+can be used to gate schema changes.  Scans which no index can avoid
+(leading-wildcard LIKE searches) are expected by default; --strict
+reports them too.
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import re, sys
+
+import jmdict, kd2
+from instrument import QueryProfiler, normalize_sql
+
+import gettext
+#t = gettext.translation("jblite")
+#_ = t.ugettext
+gettext.install("jblite")
+
+
+# Tables with fewer rows than this are not worth indexing.
+DEFAULT_MIN_ROWS = 1000
+
+_scan_re = re.compile(r"^SCAN (?:TABLE )?(\w+)(?: AS (\w+))?(.*)$")
+_from_re = re.compile(
+    r"\bFROM\s+(.+?)(?=\s+WHERE\b|\s+ORDER\b|\s+GROUP\b|\s+LIMIT\b|\)|$)",
+    re.IGNORECASE)
+_select_re = re.compile(r"^\s*SELECT\s+(.+?)\s+FROM\b", re.IGNORECASE)
+_condition_re = re.compile(
+    r"(?:\b(\w+)\.)?\b(\w+)\s*(=|<=|>=|<|>|\bLIKE\b|\bIN\b|\bBETWEEN\b)",
+    re.IGNORECASE)
+_compound_re = re.compile(r"[()]|\b(?:UNION(?:\s+ALL)?|INTERSECT|EXCEPT)\b",
+                          re.IGNORECASE)
+
+# Scans which are expected, by probe name: leading-wildcard LIKE
+# patterns (the substring tier of JMdict's search and all of
+# KANJIDIC2's search) cannot use an index.  Any other scan, including
+# one of another table in these probes, is reported.
+_KD2_SUBSTRING_TABLES = ("reading", "meaning", "nanori", "kunyomi_lookup")
+JMDICT_EXPECTED_SCANS = {
+    "search:substring": ("k_ele", "r_ele", "gloss"),
+    "search:substring:lang": ("k_ele", "r_ele", "gloss"),
+    }
+KD2_EXPECTED_SCANS = {
+    "search": _KD2_SUBSTRING_TABLES,
+    "search:lang": _KD2_SUBSTRING_TABLES,
+    }
+
+
+class StatementRecorder(QueryProfiler):
+
+    """Profiler which remembers one set of arguments per statement."""
+
+    def __init__(self):
+        QueryProfiler.__init__(self)
+        self.statements = {}  # normalized sql -> (sql, args)
+        self.order = []
+
+    def record_finish(self, stats, sql, args, elapsed, rows):
+        key = normalize_sql(sql)
+        if key not in self.statements:
+            self.statements[key] = (sql, args)
+            self.order.append(key)
+
+
+class Finding(object):
+
+    """A full scan of a large table found in a query plan."""
+
+    def __init__(self, probe, sql, table, alias, detail, rows, suggestion):
+        self.probes = [probe]
+        self.sql = sql
+        self.table = table
+        self.alias = alias
+        self.detail = detail
+        self.rows = rows
+        self.suggestion = suggestion
+
+    def __unicode__(self):
+        lines = [_(u"SCAN of %s (%d rows) in probe(s) %s:") %
+                 (self.table, self.rows, u", ".join(self.probes)),
+                 u"  %s" % self.sql,
+                 _(u"  plan: %s") % self.detail]
+        if self.suggestion is not None:
+            lines.append(_(u"  suggestion: %s") % self.suggestion)
+        return u"\n".join(lines)
+
+
+def table_aliases(sql):
+    """Maps the aliases used in FROM clauses to table names.
+
+    Unaliased tables map to themselves.
+
+    """
+    aliases = {}
+    for match in _from_re.finditer(sql):
+        for item in match.group(1).split(","):
+            words = [w for w in item.split() if w.upper() != "AS"]
+            if len(words) == 0 or not re.match(r"^\w+$", words[0]):
+                continue
+            table = words[0]
+            aliases[table] = table
+            if len(words) > 1:
+                aliases[words[1]] = table
+    return aliases
+
+
+def get_select_for_table(sql, table):
+    """Returns the simple SELECT of a statement reading from table.
+
+    The statement is split at parentheses and compound operators
+    (UNION, INTERSECT, EXCEPT), so sub-selects such as "id IN (SELECT
+    fk FROM t WHERE ... UNION SELECT ...)" are analyzed on their own.
+    Returns the whole statement if no part reads from table alone.
+
+    """
+    for part in _compound_re.split(sql):
+        part = part.strip()
+        if re.match(r"SELECT\b", part, re.IGNORECASE) \
+                and table in table_aliases(part).values():
+            return part
+    return sql
+
+
+def suggest_index(sql, table, alias, existing_indexes):
+    """Suggests a covering index for a scanned table.
+
+    The index leads with the columns the statement filters the table
+    on, followed by the other columns it reads, so the query can be
+    answered from the index alone.  Returns None if an existing index
+    already does as well (for a leading-wildcard LIKE, any index
+    holding all the columns).
+
+    """
+    sql = get_select_for_table(sql, table)
+    aliases = table_aliases(sql)
+    single_table = len(set(aliases.values())) == 1
+    name = alias or table
+
+    filter_cols = []
+    leading_wildcard = False
+    where = re.split(r"\bWHERE\b", sql, 1, re.IGNORECASE)
+    if len(where) > 1:
+        for qualifier, column, op in _condition_re.findall(where[1]):
+            if column.upper() in ("AND", "OR", "NOT", "SELECT"):
+                continue
+            if qualifier == name or (qualifier == "" and single_table):
+                if column not in filter_cols and column != "id":
+                    filter_cols.append(column)
+                if op.upper() == "LIKE":
+                    leading_wildcard = True
+
+    selected_cols = []
+    match = _select_re.match(sql)
+    if match is not None:
+        for item in match.group(1).split(","):
+            item = item.strip()
+            if "." in item:
+                qualifier, column = item.split(".", 1)
+                if qualifier != name:
+                    continue
+            elif single_table:
+                column = item
+            else:
+                continue
+            if column not in ("*", "id") and column not in filter_cols:
+                selected_cols.append(column)
+
+    columns = tuple(filter_cols + selected_cols)
+    if len(columns) == 0:
+        return None
+    for index_columns in existing_indexes:
+        if not set(columns) <= set(index_columns):
+            continue
+        if leading_wildcard or \
+                set(index_columns[:len(filter_cols)]) == set(filter_cols):
+            return None
+    suggestion = u"CREATE INDEX %s_%s ON %s (%s)" % (
+        table, u"_".join(columns), table, u", ".join(columns))
+    if leading_wildcard:
+        suggestion += _(u" (LIKE patterns with a leading wildcard cannot "
+                        u"seek; the index only narrows the scan)")
+    return suggestion
+
+
+def _existing_indexes(cursor, table):
+    """Returns a dict of column tuples to index names for a table."""
+    indexes = {}
+    cursor.execute("PRAGMA index_list(%s)" % table)
+    for row in cursor.fetchall():
+        index_name = row[1]
+        cursor.execute("PRAGMA index_info(%s)" % index_name)
+        columns = [info[2] for info in cursor.fetchall()]
+        indexes[tuple(columns)] = index_name
+    return indexes
+
+
+def audit_database(db, probes, min_rows=DEFAULT_MIN_ROWS, allow=(),
+                   expected=None, verbose=False, out=None):
+    """Audits the query plans of all statements issued by probes.
+
+    db: a jmdict.Database or kd2.Database.
+    probes: list of (name, callable) pairs.  Each callable takes the
+        database and exercises one query path.
+    min_rows: tables with fewer rows are not reported.
+    allow: probe names whose scans are expected and not reported.
+    expected: dictionary of probe name to the tables it is expected
+        to scan (such as JMDICT_EXPECTED_SCANS); those scans are not
+        reported.
+
+    Returns a list of Finding objects.
+
+    """
+    if out is None:
+        out = sys.stdout
+    if expected is None:
+        expected = {}
+    raw_cursor = db.cursor
+    raw_cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                       "UNION SELECT name FROM sqlite_temp_master "
+                       "WHERE type = 'table'")
+    known_tables = set(row[0] for row in raw_cursor.fetchall())
+    row_counts = {}
+    index_cache = {}
+    findings = []
+    findings_by_key = {}
+
+    for probe_name, probe in probes:
+        recorder = StatementRecorder()
+        db.enable_profiling(recorder)
+        try:
+            probe(db)
+        finally:
+            db.disable_profiling()
+
+        for key in recorder.order:
+            sql, args = recorder.statements[key]
+            if not sql.lstrip().upper().startswith("SELECT"):
+                continue
+            raw_cursor.execute("EXPLAIN QUERY PLAN " + sql, args)
+            plan = [row[3] for row in raw_cursor.fetchall()]
+            if verbose:
+                print(u"[%s] %s" % (probe_name, key), file=out)
+                for detail in plan:
+                    print(u"    %s" % detail, file=out)
+            aliases = table_aliases(sql)
+            for detail in plan:
+                match = _scan_re.match(detail)
+                if match is None:
+                    continue
+                name, as_alias = match.group(1), match.group(2)
+                table = aliases.get(name, name)
+                alias = as_alias or (name if name != table else None)
+                if table not in known_tables:
+                    continue  # Sub-select or view; not indexable.
+                if table not in row_counts:
+                    raw_cursor.execute("SELECT COUNT(*) FROM %s" % table)
+                    row_counts[table] = raw_cursor.fetchone()[0]
+                if row_counts[table] < min_rows or probe_name in allow \
+                        or table in expected.get(probe_name, ()):
+                    continue
+                finding = findings_by_key.get((key, detail))
+                if finding is not None:
+                    if probe_name not in finding.probes:
+                        finding.probes.append(probe_name)
+                    continue
+                if table not in index_cache:
+                    index_cache[table] = _existing_indexes(raw_cursor, table)
+                suggestion = suggest_index(sql, table, alias,
+                                           index_cache[table])
+                finding = Finding(probe_name, key, table, alias, detail,
+                                  row_counts[table], suggestion)
+                findings_by_key[(key, detail)] = finding
+                findings.append(finding)
+    return findings
+
+
+######################################################################
+# Probes: one per query shape of each Database class
+######################################################################
+
+
+def _first_value(db, query, args=()):
+    db.cursor.execute(query, args)
+    row = db.cursor.fetchone()
+    return row[0] if row is not None else u"x"
+
+
+def _sample_ids(db, table, count=20):
+    db.cursor.execute("SELECT id FROM %s ORDER BY id LIMIT ?" % table,
+                      (count,))
+    return [row[0] for row in db.cursor.fetchall()]
+
+
+def jmdict_probes(db):
+    """Returns (name, callable) pairs covering jmdict.Database queries."""
+    keb = _first_value(db, "SELECT value FROM k_ele")
+    reb = _first_value(db, "SELECT value FROM r_ele")
+    ids = _sample_ids(db, "entry")
+    # search() falls through to the substring tier whenever the
+    # better tiers do not fill the page, so each tier is probed on
+    # its own; only the substring tier is expected to scan.
+    probes = [
+        ("lookup", lambda db: [db.lookup(i) for i in ids]),
+        ("search:exact", lambda db: [db._exact_match_tier(keb, None, -1),
+                                     db._exact_match_tier(reb, None, -1)]),
+        ("search:prefix",
+         lambda db: db._prefix_match_tier(keb[:1], None, 20)),
+        ("search:prefix:lang",
+         lambda db: db._prefix_match_tier(u"a", "eng", 20)),
+        ("search:substring",
+         lambda db: db._substring_match_tier(keb, None, -1)),
+        ("search:substring:lang",
+         lambda db: db._substring_match_tier(u"a", "eng", -1)),
+        ("search_many", lambda db: db.search_many([keb, reb])),
+        ("search_many:prefix",
+         lambda db: db.search_many([keb[:1]], mode="prefix", lang="eng")),
+        ("lookup_many", lambda db: db.lookup_many(ids)),
+        ("lookup_by_seq", lambda db: db.lookup_by_seq(
+            db.seqs_for_ids(ids).values())),
+        ("seqs_for_ids", lambda db: db.seqs_for_ids(ids)),
+        ("headwords", lambda db: db.headwords(ids)),
+        ("find_headword", lambda db: [db.find_headword(keb),
+                                      db.find_headword(reb)]),
+        ("related", lambda db: db.related(ids)),
+        ("linked_from", lambda db: db.linked_from(ids)),
+        ]
+    # The fuzzy index is optional (see jblite.fuzzy).
+    if db._get_metadata().get("fuzzy_index") is not None:
+        probes.append(("search_fuzzy",
+                       lambda db: db.search_fuzzy(reb, limit=20)))
+    return probes
+
+
+def kd2_probes(db):
+    """Returns (name, callable) pairs covering kd2.Database queries."""
+    literal = _first_value(db, "SELECT literal FROM character")
+    reading = _first_value(db, "SELECT value FROM reading")
+    skip_code = _first_value(
+        db, "SELECT value FROM query_code WHERE type = ?",
+        (db.tables["query_code"].get_code("type", "skip"),))
+    ids = _sample_ids(db, "character")
+    return [
+        ("lookup", lambda db: [db.lookup(i) for i in ids]),
+        ("search_by_literal", lambda db: db.search_by_literal(literal)),
+        ("lookup_literals", lambda db: db.lookup_literals(literal * 2)),
+        ("search", lambda db: db.search(reading)),
+        ("search:lang", lambda db: db.search(u"a", lang="en")),
+        ("query_code_search",
+         lambda db: db.query_code_search("skip", skip_code)),
+        ("query_code_search:nomisclass",
+         lambda db: db.query_code_search("skip", skip_code, False)),
+        ("skip_search", lambda db: db.skip_search(1)),
+        ("skip_search:range",
+         lambda db: db.skip_search(1, (3, 4), 2, tolerance=1,
+                                   allow_misclass=False)),
+        ]
+
+
+######################################################################
+
+
+def parse_args():
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options]")
+    op.add_option("-j", "--jmdict", metavar="DB",
+                  help=_("JMdict database to audit."))
+    op.add_option("-k", "--kd2", metavar="DB",
+                  help=_("KANJIDIC2 database to audit."))
+    op.add_option("-m", "--min-rows", type="int", default=DEFAULT_MIN_ROWS,
+                  help=_("Ignore scans of tables smaller than this "
+                         "(default: %default)"))
+    op.add_option("-a", "--allow", action="append", default=[],
+                  metavar="PROBE",
+                  help=_("Accept scans in the named probe (may be "
+                         "repeated)."))
+    op.add_option("--strict", action="store_true",
+                  help=_("Also report the expected scans of "
+                         "leading-wildcard LIKE searches."))
+    op.add_option("-v", "--verbose", action="store_true",
+                  help=_("Print the plan of every statement."))
+    options, args = op.parse_args()
+    if options.jmdict is None and options.kd2 is None:
+        op.print_help()
+        exit(-1)
+    return (options, args)
+
+def main():
+    options, args = parse_args()
+    targets = []
+    if options.jmdict is not None:
+        targets.append((_("JMdict"), jmdict.Database(options.jmdict),
+                        jmdict_probes, JMDICT_EXPECTED_SCANS))
+    if options.kd2 is not None:
+        targets.append((_("KANJIDIC2"), kd2.Database(options.kd2),
+                        kd2_probes, KD2_EXPECTED_SCANS))
+
+    encoding = sys.getfilesystemencoding() or "utf-8"
+    total = 0
+    for label, db, get_probes, expected in targets:
+        findings = audit_database(db, get_probes(db),
+                                  min_rows=options.min_rows,
+                                  allow=options.allow,
+                                  expected=None if options.strict
+                                  else expected,
+                                  verbose=options.verbose)
+        print(_("%s: %d problem(s) found.") % (label, len(findings)))
+        for finding in findings:
+            print(unicode(finding).encode(encoding))
+        total += len(findings)
+
+    if total > 0:
+        exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Streaming JSON lines dump of a JMdict or KANJIDIC2 database.
+
+Writes one JSON object per entry, in the format of Record.as_dict():
+
+    python -m jblite.dump <db_filename> [output.jsonl]
+
+Output goes to stdout if no output file is given.
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import sys, json, sqlite3
+
+from compact import KINDS, detect_kind
+
+import gettext
+#t = gettext.translation("jblite")
+#_ = t.ugettext
+gettext.install("jblite")
+
+
+def dump_jsonl(db, outfile):
+    """Writes every entry of db to outfile as JSON lines.
+
+    Returns the number of entries written.
+
+    """
+    count = 0
+    for entry in db.iter_dicts():
+        outfile.write(json.dumps(entry, ensure_ascii=False).encode("utf-8"))
+        outfile.write("\n")
+        count += 1
+    return count
+
+
+def open_database(db_fname):
+    """Opens a JMdict or KANJIDIC2 database, detecting which it is."""
+    conn = sqlite3.connect(db_fname)
+    try:
+        kind = detect_kind(conn.cursor())
+    finally:
+        conn.close()
+    return KINDS[kind]["database"](db_fname)
+
+
+######################################################################
+
+def parse_args():
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options] <db_filename> [output.jsonl]")
+    options, args = op.parse_args()
+    if len(args) < 1:
+        op.print_help()
+        exit(-1)
+    return (options, args)
+
+def main():
+    options, args = parse_args()
+    db = open_database(args[0])
+    if len(args) > 1:
+        with open(args[1], "wb") as outfile:
+            count = dump_jsonl(db, outfile)
+    else:
+        count = dump_jsonl(db, sys.stdout)
+    print(_("Wrote %d entries.") % count, file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""Fuzzy search index for JMdict glosses and readings.
+
+Misspelled queries ("accomodate", or a slipped kana) find nothing with
+the exact, prefix and substring matching of search().  This module
+builds a symmetric-deletion index over the distinct gloss words (per
+language) and readings of a JMdict database, and stores it in the
+database itself:
+
+    python -m jblite.fuzzy [-d MAX_DISTANCE] <jmdict.db>
+
+Every term is indexed under the strings obtained by deleting up to
+its allowed number of characters (see allowed_distance()) from its
+first PREFIX_LENGTH characters.  A query generates its own deletions
+the same way; terms sharing one are candidates, and the true edit
+distance is only computed for those.  jmdict.Database.search_fuzzy()
+ranks the matching entries by distance, then by priority.
+
+Re-importing the database drops the index; it must then be rebuilt.
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import re, zlib, uuid, sqlite3
+
+from helpers import pack_ids
+from table import Table, MetadataTable
+from kanjiwords import get_entry_priorities
+
+import gettext
+#t = gettext.translation("jblite")
+#_ = t.ugettext
+gettext.install("jblite")
+
+
+# Default largest edit distance the index supports.
+MAX_DISTANCE = 2
+
+# Deletions are only generated within this many leading characters,
+# which bounds the number of variants per term.
+PREFIX_LENGTH = 7
+
+# Kinds of indexed terms.
+GLOSS = "gloss"
+READING = "reading"
+
+_word_re = re.compile(r"\w+", re.UNICODE)
+
+
+class FuzzyTermTable(Table):
+    """A distinct gloss word or reading, with the packed IDs of the
+    entries using it (most common first).  lang is the gloss.lang
+    value of gloss words and NULL for readings."""
+    create_query = ("CREATE TABLE %s "
+                    "(id INTEGER PRIMARY KEY, kind TEXT, lang, term TEXT, "
+                    "entry_ids BLOB)")
+    insert_query = "INSERT INTO %s VALUES (?, ?, ?, ?, ?)"
+
+
+class FuzzyVariantTable(Table):
+    """Maps the hash of a deletion variant to the terms producing it.
+
+    Hash collisions only add candidates, which are checked against
+    the query anyway.
+
+    """
+    create_query = ("CREATE TABLE %s "
+                    "(variant INTEGER, term_id INTEGER, "
+                    "PRIMARY KEY (variant, term_id)) WITHOUT ROWID")
+    insert_query = "INSERT OR IGNORE INTO %s VALUES (?, ?)"
+
+
+def split_words(text):
+    """Returns the lowercased words of a gloss or query."""
+    return _word_re.findall(text.lower())
+
+
+def allowed_distance(term, max_distance=MAX_DISTANCE):
+    """Returns the edit distance allowed for a term: one per three
+    characters, up to max_distance."""
+    return min(max_distance, len(term) // 3)
+
+
+def get_deletes(term, distance, prefix_length=PREFIX_LENGTH):
+    """Returns the set of strings made by deleting up to distance
+    characters from the first prefix_length characters of term."""
+    term = term[:prefix_length]
+    result = set([term])
+    level = [term]
+    for i in xrange(distance):
+        next_level = []
+        for variant in level:
+            for pos in xrange(len(variant)):
+                deleted = variant[:pos] + variant[pos + 1:]
+                if deleted not in result:
+                    result.add(deleted)
+                    next_level.append(deleted)
+        level = next_level
+    return result
+
+
+def hash_variant(variant):
+    return zlib.crc32(variant.encode("utf-8")) & 0xffffffff
+
+
+def edit_distance(a, b, max_distance):
+    """Returns the edit distance between two strings.
+
+    Insertions, deletions, substitutions and transpositions of
+    adjacent characters each count as one edit (optimal string
+    alignment).  Any distance over max_distance is returned as
+    max_distance + 1, which lets the computation stop early.
+
+    """
+    over = max_distance + 1
+    if abs(len(a) - len(b)) > max_distance:
+        return over
+    if a == b:
+        return 0
+    # Cells further than max_distance from the diagonal cannot be
+    # within the distance, so only a band of each row is computed.
+    before = None
+    previous = [j if j <= max_distance else over
+                for j in xrange(len(b) + 1)]
+    for i in xrange(1, len(a) + 1):
+        current = [over] * (len(b) + 1)
+        if i <= max_distance:
+            current[0] = i
+        row_min = current[0]
+        char = a[i - 1]
+        for j in xrange(max(1, i - max_distance),
+                        min(len(b), i + max_distance) + 1):
+            value = previous[j - 1] + (char != b[j - 1])
+            if previous[j] + 1 < value:
+                value = previous[j] + 1
+            if current[j - 1] + 1 < value:
+                value = current[j - 1] + 1
+            if i > 1 and j > 1 and char == b[j - 2] \
+                    and a[i - 2] == b[j - 1] and before[j - 2] + 1 < value:
+                value = before[j - 2] + 1
+            current[j] = value
+            if value < row_min:
+                row_min = value
+        if row_min > max_distance:
+            return over
+        before, previous = previous, current
+    return min(previous[-1], over)
+
+
+def build_fuzzy_index(jmdict_fname, max_distance=MAX_DISTANCE,
+                      prefix_length=PREFIX_LENGTH):
+    """Builds the fuzzy_term and fuzzy_variant tables.
+
+    The settings are recorded under the "fuzzy_index" metadata key,
+    where search_fuzzy() finds them, along with an ID for this build
+    which keys its cached results.
+
+    Returns the number of indexed terms.
+
+    """
+    conn = sqlite3.connect(jmdict_fname)
+    cursor = conn.cursor()
+    try:
+        # Variants arrive in hash order, so keep the whole table in
+        # the page cache while inserting (up to 256 MiB).
+        cursor.execute("PRAGMA cache_size = -262144")
+        entries_by_term = {}
+        cursor.execute("SELECT s.fk, g.lang, g.value "
+                       "FROM gloss g JOIN sense s ON s.id = g.fk")
+        for entry_id, lang, value in cursor:
+            for word in split_words(value):
+                entries_by_term.setdefault((GLOSS, lang, word),
+                                           set()).add(entry_id)
+        cursor.execute("SELECT fk, value FROM r_ele")
+        for entry_id, reb in cursor:
+            entries_by_term.setdefault((READING, None, reb),
+                                       set()).add(entry_id)
+
+        priorities = get_entry_priorities(cursor)
+        def sort_key(entry_id):
+            return (-priorities.get(entry_id, 0), entry_id)
+        terms = sorted(entries_by_term)
+
+        for name in ("fuzzy_variant", "fuzzy_term"):
+            cursor.execute("DROP TABLE IF EXISTS %s" % name)
+        term_table = FuzzyTermTable(cursor, "fuzzy_term")
+        term_table.create()
+        term_table.insertmany(
+            (term_id, kind, lang, term,
+             pack_ids(sorted(entries_by_term[(kind, lang, term)],
+                             key=sort_key)))
+            for term_id, (kind, lang, term) in enumerate(terms))
+
+        def iter_variants():
+            for term_id, (kind, lang, term) in enumerate(terms):
+                distance = allowed_distance(term, max_distance)
+                for variant in get_deletes(term, distance, prefix_length):
+                    yield (hash_variant(variant), term_id)
+        variant_table = FuzzyVariantTable(cursor, "fuzzy_variant")
+        variant_table.create()
+        variant_table.insertmany(iter_variants())
+
+        metadata = MetadataTable(cursor, "metadata")
+        metadata.create()
+        metadata.set("fuzzy_index", {"max_distance": max_distance,
+                                     "prefix_length": prefix_length,
+                                     "build": uuid.uuid4().hex})
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    return len(terms)
+
+
+######################################################################
+
+def parse_args():
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options] <jmdict_db>")
+    op.add_option("-d", "--max-distance", type="int", default=MAX_DISTANCE,
+                  help=_("Largest edit distance to support "
+                         "(default: %default)"))
+    options, args = op.parse_args()
+    if len(args) < 1:
+        op.print_help()
+        exit(-1)
+    return (options, args)
+
+def main():
+    options, args = parse_args()
+    count = build_fuzzy_index(args[0], options.max_distance)
+    print(_("Indexed %d terms.") % count)
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,13 @@
 # -*- coding:utf-8 -*-
-import time, sqlite3, gzip
+import re, sys, time, sqlite3, gzip, hashlib, unicodedata
+from array import array
+from timeit import default_timer as timer
+from xml.etree.cElementTree import iterparse
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
 
 
 def with_db(db_fname, fn, *args, **kwargs):
@@ -28,6 +36,95 @@ def gzread(fname):
     return data
 
 
+def open_input(fname):
+    """Opens a possibly gzipped input file for streaming.
+
+    Returns (stream, raw): stream yields the uncompressed data, and
+    raw is the file on disk, whose tell() gives the number of (possibly
+    compressed) bytes consumed so far.
+
+    """
+    raw = open(fname, "rb")
+    magic = raw.read(2)
+    raw.seek(0)
+    if magic == "\x1f\x8b":
+        return gzip.GzipFile(fileobj=raw, mode="rb"), raw
+    return raw, raw
+
+
+class PrefixedFile(object):
+
+    """File-like object returning prefix, then the rest of infile.
+
+    Lets a parser start over on data which was partly read already
+    (for example, to inspect a DTD).
+
+    """
+
+    def __init__(self, prefix, infile):
+        self.prefix = prefix
+        self.infile = infile
+
+    def read(self, size=-1):
+        if len(self.prefix) == 0:
+            return self.infile.read(size)
+        if size < 0:
+            data = self.prefix + self.infile.read()
+            self.prefix = ""
+        else:
+            data = self.prefix[:size]
+            self.prefix = self.prefix[size:]
+        return data
+
+
+def read_until(infile, marker, chunk_size=65536):
+    """Reads from infile until marker has been seen (or EOF)."""
+    data = ""
+    while marker not in data:
+        chunk = infile.read(chunk_size)
+        if len(chunk) == 0:
+            break
+        data += chunk
+    return data
+
+
+def iter_elements(infile, tags, telemetry=None):
+    """Yields the complete elements with the given tags from XML.
+
+    The document is parsed incrementally, and each element is cleared
+    once the caller is done with it, so memory use does not grow with
+    the size of the document.  Time spent parsing is reported to
+    telemetry (an ImportTelemetry), if given.
+
+    """
+    root = None
+    last = timer()
+    for event, elem in iterparse(infile, events=("start", "end")):
+        if root is None:
+            root = elem
+        if event == "end" and elem.tag in tags:
+            if telemetry is not None:
+                telemetry.add_time("parse", timer() - last)
+            yield elem
+            elem.clear()
+            root.clear()
+            last = timer()
+
+
+def peak_rss_kb():
+    """Returns the peak resident set size of this process in KiB.
+
+    Returns None where the resource module is unavailable.
+
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        rss //= 1024  # Reported in bytes rather than KiB.
+    return rss
+
+
 def do_time(fn, *args, **kwargs):
     """Wraps a function call and prints the result.
 
@@ -41,6 +138,22 @@ def do_time(fn, *args, **kwargs):
     print("do_time: Fn=%s, Time=%f" % (repr(fn), end-start))
     return result
 
+def pack_ids(ids):
+    """Packs a list of integer IDs into a compact little-endian blob."""
+    arr = array("i", ids)
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return buffer(arr.tostring())
+
+
+def unpack_ids(blob):
+    """Reverses pack_ids.  Returns a list of integers."""
+    arr = array("i")
+    arr.fromstring(str(blob))
+    if sys.byteorder == "big":
+        arr.byteswap()
+    return arr.tolist()
+
 # This method of getting the encoding might not be the best...
 # but it works for now, and avoids hacks with
 # setdefaultencoding.
@@ -56,3 +169,23 @@ def convert_query_to_unicode(query):
     encoding = get_encoding()
     return query.decode(encoding)
     wrapped_query = "%%%s%%" % query  # Wrap in wildcards
+
+_space_re = re.compile(r"\s+", re.UNICODE)
+
+def normalize_query(query):
+    """Converts a query to unicode in NFC form, with runs of whitespace
+    collapsed and leading/trailing whitespace removed."""
+    query = unicodedata.normalize("NFC", convert_query_to_unicode(query))
+    return _space_re.sub(u" ", query).strip()
+
+
+def file_digest(fname, block_size=1 << 20):
+    """Returns the SHA-1 hex digest of a file's contents."""
+    digest = hashlib.sha1()
+    with open(fname, "rb") as infile:
+        while True:
+            block = infile.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+    return digest.hexdigest()
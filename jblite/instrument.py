@@ -0,0 +1,434 @@
+# -*- coding: utf-8 -*-
+"""Query instrumentation.
+
+A ProfilingCursor wraps an sqlite3 cursor and reports every statement
+to a QueryProfiler, which keeps per-statement call counts, cumulative
+time and rows returned, and optionally logs slow queries.
+
+Profiling is off by default: databases use the raw sqlite3 cursor
+until Database.enable_profiling() swaps in a ProfilingCursor, so the
+normal code path pays nothing for this.
+
+Imports are instrumented separately, by an ImportTelemetry object
+passed to the Database constructor.
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import re, sys, json
+from contextlib import contextmanager
+from timeit import default_timer as timer
+
+from helpers import peak_rss_kb
+
+
+_whitespace_re = re.compile(r"\s+")
+_in_list_re = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_string_literal_re = re.compile(r"'(?:[^']|'')*'")
+_number_literal_re = re.compile(r"\b\d+\b")
+_insert_re = re.compile(r"^\s*INSERT\s+INTO\s+(\S+)", re.IGNORECASE)
+
+
+def normalize_sql(sql):
+    """Reduces an SQL statement to a canonical form for grouping.
+
+    Whitespace is collapsed, literals become ?, and parameter lists
+    of any length like (?, ?, ?) become (?, ...).
+
+    """
+    sql = _whitespace_re.sub(" ", sql.strip())
+    sql = _string_literal_re.sub("?", sql)
+    sql = _number_literal_re.sub("?", sql)
+    sql = _in_list_re.sub("(?, ...)", sql)
+    return sql
+
+
+class StatementStats(object):
+
+    """Accumulated statistics for one normalized statement."""
+
+    __slots__ = ("calls", "total_time", "max_time", "rows")
+
+    def __init__(self):
+        self.calls = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.rows = 0
+
+    def as_dict(self):
+        return {"calls": self.calls,
+                "total_time": self.total_time,
+                "max_time": self.max_time,
+                "rows": self.rows}
+
+
+class QueryProfiler(object):
+
+    """Collects statement statistics and logs slow queries.
+
+    slow_threshold: time in seconds above which a statement (execute
+        plus fetching its rows) is considered slow.  None disables the
+        slow-query log.
+    slow_log: file-like object slow queries are written to.  Defaults
+        to sys.stderr.  Regardless of this setting, the most recent
+        slow queries are kept in the slow_queries attribute.
+
+    """
+
+    max_slow_queries = 100
+
+    def __init__(self, slow_threshold=None, slow_log=None):
+        self.slow_threshold = slow_threshold
+        self.slow_log = slow_log
+        self.reset()
+        self._normalized = {}
+
+    def reset(self):
+        """Clears all collected statistics."""
+        self.stats = {}
+        self.statement_count = 0
+        self.slow_queries = []
+
+    def _get_stats(self, sql):
+        key = self._normalized.get(sql)
+        if key is None:
+            key = self._normalized[sql] = normalize_sql(sql)
+        stats = self.stats.get(key)
+        if stats is None:
+            stats = self.stats[key] = StatementStats()
+        return stats
+
+    def record_execute(self, sql, elapsed, calls=1):
+        """Records execution of a statement.
+
+        calls is greater than one for executemany().
+
+        """
+        self.statement_count += calls
+        stats = self._get_stats(sql)
+        stats.calls += calls
+        stats.total_time += elapsed
+        return stats
+
+    def record_fetch(self, stats, elapsed, rows):
+        """Adds fetch time and returned rows to a statement."""
+        stats.total_time += elapsed
+        stats.rows += rows
+
+    def record_finish(self, stats, sql, args, elapsed, rows):
+        """Called once a single statement has been fully consumed."""
+        if elapsed > stats.max_time:
+            stats.max_time = elapsed
+        if self.slow_threshold is not None and elapsed >= self.slow_threshold:
+            self.slow_queries.append((elapsed, rows, sql, args))
+            del self.slow_queries[:-self.max_slow_queries]
+            slow_log = self.slow_log if self.slow_log is not None \
+                else sys.stderr
+            print("Slow query (%.3f ms, %d rows): %s; args=%r" %
+                  (elapsed * 1000, rows, _whitespace_re.sub(" ", sql),
+                   args), file=slow_log)
+
+    @property
+    def total_time(self):
+        return sum(stats.total_time for stats in self.stats.itervalues())
+
+    def summary(self):
+        """Returns the collected statistics as a dictionary."""
+        return {
+            "statement_count": self.statement_count,
+            "total_time": self.total_time,
+            "statements": dict((sql, stats.as_dict())
+                               for sql, stats in self.stats.iteritems()),
+            }
+
+    def format_summary(self, limit=20):
+        """Returns a human-readable table of the most costly statements."""
+        lines = ["Statements: %d, total time: %.3f ms" %
+                 (self.statement_count, self.total_time * 1000)]
+        ordered = sorted(self.stats.iteritems(),
+                         key=lambda item: item[1].total_time, reverse=True)
+        if len(ordered) > 0:
+            lines.append("%8s %10s %10s %8s  %s" %
+                         ("calls", "total ms", "max ms", "rows", "statement"))
+        for sql, stats in ordered[:limit]:
+            lines.append("%8d %10.3f %10.3f %8d  %s" %
+                         (stats.calls, stats.total_time * 1000,
+                          stats.max_time * 1000, stats.rows, sql))
+        if len(ordered) > limit:
+            lines.append("(%d more statements not shown)" %
+                         (len(ordered) - limit))
+        return "\n".join(lines)
+
+
+class PhaseTimer(object):
+
+    """Records the wall-clock time of named phases of a job.
+
+        phases = PhaseTimer()
+        with phases.phase("parse"):
+            ...
+
+    """
+
+    def __init__(self):
+        self.phases = []  # (name, seconds), in order of completion
+
+    @contextmanager
+    def phase(self, name):
+        start = timer()
+        try:
+            yield
+        finally:
+            self.phases.append((name, timer() - start))
+
+    def total_time(self):
+        return sum(seconds for name, seconds in self.phases)
+
+
+class ImportTelemetry(object):
+
+    """Progress and throughput figures for a dictionary import.
+
+    Importers report parsed items, rows written per table and the time
+    spent in each activity:
+
+      parse:   XML parsing, including decompression
+      shaping: converting elements into rows
+      write:   SQLite statements while populating
+      index:   creating indices and derived tables
+
+    progress: optional function called with this object at most every
+        interval seconds during the import, and once when it ends.
+
+    """
+
+    def __init__(self, progress=None, interval=1.0):
+        self.progress = progress
+        self.interval = interval
+        self.items = 0
+        self.skipped = 0
+        self.rows = {}
+        self.times = {"parse": 0.0, "shaping": 0.0, "write": 0.0,
+                      "index": 0.0}
+        self.input_file = None
+        self.input_bytes = None
+        self.start_time = None
+        self.end_time = None
+        self._last_report = None
+        self._table_names = {}
+
+    def start(self, input_file, input_bytes):
+        """Starts timing.
+
+        input_file: the input as read from disk; its tell() is the
+            number of bytes consumed.
+        input_bytes: the size of the input on disk.
+
+        """
+        self.input_file = input_file
+        self.input_bytes = input_bytes
+        self.start_time = self._last_report = timer()
+
+    def finish(self):
+        self.end_time = timer()
+        if self.progress is not None:
+            self.progress(self)
+
+    def add_time(self, activity, seconds):
+        self.times[activity] += seconds
+
+    def add_write(self, sql, seconds, rows):
+        """Records one executed statement."""
+        self.times["write"] += seconds
+        table = self._table_names.get(sql)
+        if table is None:
+            match = _insert_re.match(sql)
+            table = self._table_names[sql] = \
+                match.group(1) if match is not None else ""
+        if table:
+            self.rows[table] = self.rows.get(table, 0) + rows
+
+    def item(self):
+        """Counts one imported entry or character."""
+        self.items += 1
+        if self.progress is not None:
+            now = timer()
+            if now - self._last_report >= self.interval:
+                self._last_report = now
+                self.progress(self)
+
+    def skip(self):
+        """Counts one entry or character skipped by a resumed import."""
+        self.skipped += 1
+
+    @property
+    def bytes_read(self):
+        if self.end_time is not None:
+            return self.input_bytes
+        if self.input_file is None or self.input_file.closed:
+            return 0
+        return self.input_file.tell()
+
+    @property
+    def elapsed(self):
+        if self.start_time is None:
+            return 0.0
+        end = self.end_time if self.end_time is not None else timer()
+        return end - self.start_time
+
+    def summary(self):
+        """Returns the collected figures as a dictionary."""
+        elapsed = self.elapsed
+        return {
+            "items": self.items,
+            "skipped": self.skipped,
+            "items_per_sec": self.items / elapsed if elapsed > 0 else None,
+            "rows": dict(self.rows),
+            "input_bytes": self.input_bytes,
+            "bytes_read": self.bytes_read,
+            "elapsed": elapsed,
+            "times": dict(self.times),
+            "peak_rss_kb": peak_rss_kb(),
+            }
+
+    def write_json(self, fname):
+        """Writes summary() to a file as JSON."""
+        with open(fname, "w") as outfile:
+            json.dump(self.summary(), outfile, indent=2, sort_keys=True)
+            outfile.write("\n")
+
+    def format_progress(self):
+        """Returns a one-line progress report."""
+        elapsed = self.elapsed
+        rate = self.items / elapsed if elapsed > 0 else 0.0
+        if self.input_bytes:
+            percent = "%5.1f%%" % (100.0 * self.bytes_read /
+                                   self.input_bytes)
+        else:
+            percent = "  ?  "
+        return "%s %7.1f/%.1f MB %8d items %7.0f/s %6.1f s" % (
+            percent, self.bytes_read / 1e6, (self.input_bytes or 0) / 1e6,
+            self.items, rate, elapsed)
+
+
+def print_progress(telemetry):
+    """ImportTelemetry progress function showing a status line."""
+    sys.stderr.write("\r" + telemetry.format_progress())
+    if telemetry.end_time is not None:
+        sys.stderr.write("\n")
+    sys.stderr.flush()
+
+
+class TelemetryCursor(object):
+
+    """sqlite3 cursor proxy reporting statements to an ImportTelemetry."""
+
+    def __init__(self, cursor, telemetry):
+        self.cursor = cursor
+        self.telemetry = telemetry
+
+    def execute(self, sql, args=()):
+        start = timer()
+        self.cursor.execute(sql, args)
+        self.telemetry.add_write(sql, timer() - start, 1)
+        return self
+
+    def executemany(self, sql, seq_of_args):
+        start = timer()
+        self.cursor.executemany(sql, seq_of_args)
+        self.telemetry.add_write(sql, timer() - start,
+                                 max(self.cursor.rowcount, 0))
+        return self
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class ProfilingCursor(object):
+
+    """sqlite3 cursor proxy reporting all statements to a profiler.
+
+    Since SQLite produces rows lazily, time spent fetching is counted
+    towards the statement which produced the rows.  Attributes not
+    defined here (lastrowid, description, ...) are passed through to
+    the wrapped cursor.
+
+    """
+
+    def __init__(self, cursor, profiler):
+        self.cursor = cursor
+        self.profiler = profiler
+        self._current = None  # [stats, sql, args, elapsed, rows]
+
+    def execute(self, sql, args=()):
+        self.finish()
+        start = timer()
+        self.cursor.execute(sql, args)
+        elapsed = timer() - start
+        stats = self.profiler.record_execute(sql, elapsed)
+        self._current = [stats, sql, args, elapsed, 0]
+        return self
+
+    def executemany(self, sql, seq_of_args):
+        self.finish()
+        start = timer()
+        self.cursor.executemany(sql, seq_of_args)
+        elapsed = timer() - start
+        calls = max(self.cursor.rowcount, 1)
+        stats = self.profiler.record_execute(sql, elapsed, calls)
+        self.profiler.record_finish(stats, sql, (), elapsed, 0)
+        return self
+
+    def _fetched(self, elapsed, rows, exhausted):
+        current = self._current
+        if current is None:
+            return
+        current[3] += elapsed
+        current[4] += rows
+        self.profiler.record_fetch(current[0], elapsed, rows)
+        if exhausted:
+            self.finish()
+
+    def fetchone(self):
+        start = timer()
+        row = self.cursor.fetchone()
+        if row is None:
+            self._fetched(timer() - start, 0, True)
+        else:
+            self._fetched(timer() - start, 1, False)
+        return row
+
+    def fetchmany(self, *args):
+        start = timer()
+        rows = self.cursor.fetchmany(*args)
+        self._fetched(timer() - start, len(rows), len(rows) == 0)
+        return rows
+
+    def fetchall(self):
+        start = timer()
+        rows = self.cursor.fetchall()
+        self._fetched(timer() - start, len(rows), True)
+        return rows
+
+    def __iter__(self):
+        while True:
+            row = self.fetchone()
+            if row is None:
+                return
+            yield row
+
+    def finish(self):
+        """Closes out statistics for the statement in progress, if any."""
+        current = self._current
+        if current is not None:
+            self._current = None
+            stats, sql, args, elapsed, rows = current
+            self.profiler.record_finish(stats, sql, args, elapsed, rows)
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
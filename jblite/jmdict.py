@@ -10,12 +10,21 @@
 from __future__ import print_function
 from __future__ import with_statement
 
-import os, re, sqlite3
-from cStringIO import StringIO
-from xml.etree.cElementTree import ElementTree
-from helpers import gzread, get_encoding, convert_query_to_unicode
-from db import Database as BaseDatabase
-from table import Table, ChildTable, KeyValueTable
+import os, sys, re, sqlite3
+from collections import namedtuple
+from timeit import default_timer as timer
+from helpers import get_encoding, convert_query_to_unicode, unpack_ids
+from helpers import normalize_query
+from fuzzy import GLOSS, READING, split_words, allowed_distance
+from fuzzy import get_deletes, hash_variant, edit_distance
+from kanjiwords import check_kanji_word_index
+from helpers import open_input, read_until, iter_elements, PrefixedFile
+from db import Database as BaseDatabase, request
+from db import get_build_filename, install_database
+from instrument import QueryProfiler, PhaseTimer, ImportTelemetry
+from instrument import print_progress
+from table import Table, ChildTable, KeyValueTable, iter_chunks
+from table import MAX_IN_ARGS
 
 import gettext
 #t = gettext.translation("jblite")
@@ -26,6 +35,138 @@ gettext.install("jblite")
 XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
 
 
+# Weights of the ke_pri/re_pri/pri priority markers.  nfXX markers
+# (frequency ranking in sets of 500 words) are scored separately.
+PRIORITY_WEIGHTS = {
+    "news1": 30, "ichi1": 30, "spec1": 25, "gai1": 20,
+    "news2": 10, "ichi2": 10, "spec2": 8, "gai2": 5,
+    }
+
+
+# Tables of sense-level references to other entries.
+CROSS_REF_KINDS = ("xref", "ant")
+
+# Separator of the parts of an xref/ant ("keb・reb・sense").
+CROSS_REF_SEPARATOR = u"\u30fb"
+
+# A resolved xref/ant.  sense and target_sense are 1-based sense
+# numbers; target_sense is None if the reference names no sense.
+CrossRef = namedtuple("CrossRef",
+                      "kind entry_id sense target_id target_sense")
+
+
+def parse_cross_ref(text):
+    """Splits the text of an <xref> or <ant> into its parts.
+
+    References have the forms "keb・reb・sense", "keb・reb", "keb・sense",
+    "reb・sense" or just "keb" or "reb".
+
+    Returns (forms, sense): forms is a tuple of one headword (keb or
+    reb) or two (keb and reb), and sense a number or None.
+
+    """
+    parts = text.split(CROSS_REF_SEPARATOR)
+    sense = None
+    if len(parts) > 1 and parts[-1].isdigit():
+        sense = int(parts.pop())
+    return tuple(parts[:2]), sense
+
+
+# One row of the headword table: a kanji form (None for readings used
+# without kanji) with a reading valid for it.  rank is the priority
+# score of the pair's ke_pri/re_pri markers (higher is more common);
+# is_primary marks the entry's main headword.
+Headword = namedtuple("Headword",
+                      "entry_id kanji reading rank is_primary")
+
+
+def get_headwords(entry):
+    """Pairs the kanji forms of an <entry> with their valid readings.
+
+    A reading goes with every kanji form, unless it has re_restr
+    elements (then only those) or re_nokanji (then none).  Readings
+    without any kanji form are listed on their own, and so are kanji
+    forms left without a reading (with reading None).
+
+    Returns a list of (kanji, reading, rank) tuples, the main
+    headword (first kanji with its first reading) first.
+
+    >>> from xml.etree.cElementTree import fromstring
+    >>> entry = fromstring(
+    ...     "<entry><k_ele><keb>k</keb></k_ele>"
+    ...     "<r_ele><reb>r1</reb></r_ele>"
+    ...     "<r_ele><reb>r2</reb><re_nokanji/></r_ele></entry>")
+    >>> [(keb, reb) for keb, reb, rank in get_headwords(entry)]
+    [('k', 'r1'), (None, 'r2')]
+
+    """
+    kebs = [(k_ele.findtext("keb"),
+             [pri.text for pri in k_ele.findall("ke_pri")])
+            for k_ele in entry.findall("k_ele")]
+    rebs = []
+    for r_ele in entry.findall("r_ele"):
+        restr = set(re_restr.text for re_restr in r_ele.findall("re_restr"))
+        if r_ele.find("re_nokanji") is not None:
+            restr = set([None])  # Matches no kanji form.
+        rebs.append((r_ele.findtext("reb"), restr,
+                     [pri.text for pri in r_ele.findall("re_pri")]))
+
+    headwords = []
+    paired = set()
+    for keb, ke_markers in kebs:
+        count = len(headwords)
+        for reb, restr, re_markers in rebs:
+            if len(restr) == 0 or keb in restr:
+                headwords.append(
+                    (keb, reb, get_priority_score(ke_markers + re_markers)))
+                paired.add(reb)
+        if len(headwords) == count:
+            headwords.append((keb, None, get_priority_score(ke_markers)))
+    for reb, restr, re_markers in rebs:
+        if reb not in paired:
+            headwords.append((None, reb, get_priority_score(re_markers)))
+    return headwords
+
+
+def format_headword(kanji, reading):
+    """Formats a headword as "kanji【reading】" (or just one form)."""
+    if kanji is None:
+        return reading
+    if reading is None:
+        return kanji
+    return u"%s\u3010%s\u3011" % (kanji, reading)
+
+
+def get_prefix_upper_bound(prefix):
+    """Returns the smallest string sorting after all strings with prefix.
+
+    Together with prefix, this gives an index-friendly range
+    (prefix <= value < bound) matching every string starting with
+    prefix.
+
+    """
+    return prefix[:-1] + unichr(ord(prefix[-1]) + 1)
+
+
+def get_priority_score(markers):
+    """Converts a list of priority markers to a numeric score.
+
+    Higher scores indicate more common words; 0 means no priority
+    information.
+
+    """
+    score = 0
+    for marker in markers:
+        if marker in PRIORITY_WEIGHTS:
+            score += PRIORITY_WEIGHTS[marker]
+        elif marker.startswith("nf"):
+            try:
+                score += max(0, 49 - int(marker[2:]))
+            except ValueError:
+                pass
+    return score
+
+
 # FORMAT OF TABLE MAP:
 # dictionary entry: table: (children | None)
 # table: table_name | (table_name, table_type, *args, **kwargs)
@@ -111,6 +252,16 @@ class Database(BaseDatabase):
     """Top level object for SQLite 3-based JMdict database."""
 
     entry_class = Entry
+    schema_version = 3
+    derived_tables = ("fuzzy_variant", "fuzzy_term", "kanji_word")
+    derived_metadata = ("fuzzy_index", "kanji_word")
+    projections = {
+        # Enough for "kanji【reading】" lines.
+        "headwords": {u"k_ele": {}, u"r_ele": {}},
+        # Enough for result lists and Entry.__unicode__.
+        "summary": {u"k_ele": {}, u"r_ele": {},
+                    u"sense": {u"pos": {}, u"misc": {}, u"gloss": {}}},
+        }
     table_map = {
         u"entry": {
             u"k_ele": {
@@ -145,153 +296,609 @@ class Database(BaseDatabase):
             }
         }
 
-    def __init__(self, filename, init_from_file=None):
-        self.conn = sqlite3.connect(filename)
-        self.conn.row_factory = sqlite3.Row  # keyword accessors for rows
-        self.cursor = self.conn.cursor()
+    def __init__(self, filename, init_from_file=None, profiler=None,
+                 encode=False, langs=None, phase_timer=None,
+                 telemetry=None, resume=False):
+        """Opens (and optionally imports) a database.
+
+        encode: when importing, store priority markers and language
+            codes as integer codes (see Table.encoded_columns).
+            Existing databases are detected automatically.
+        langs: when importing, keep only glosses in these
+            languages (for example ["eng"]).  None keeps all.
+        phase_timer: a PhaseTimer to record import phases in.
+        telemetry: an ImportTelemetry to report import progress to.
+        resume: continue an interrupted import of the same file, if
+            the database has one, instead of starting over.
+
+        """
+        self._connect(filename)
         self.tables = self._create_table_objects()
+        if profiler is not None:
+            self.enable_profiling(profiler)
         if init_from_file is not None:
-            raw_data = gzread(init_from_file)
+            self._import_file(init_from_file, encode, langs, phase_timer,
+                              telemetry, resume)
+        else:
+            self._setup_codebook()
 
-            entities = self._get_entities(raw_data)
-            infile = StringIO(raw_data)
-            etree = ElementTree(file=infile)
-            infile.close()
+    def _import_file(self, fname, encode=False, langs=None,
+                     phase_timer=None, telemetry=None, resume=False):
+        """Imports JMdict in two phases: populate, index.
 
-            self._create_new_tables()
-            self._populate_database(etree, entities)
+        The XML is parsed while populating, one entry at a time.
+        Progress is committed every checkpoint_interval entries, so
+        an interrupted import can be resumed.
+
+        """
+        if phase_timer is None:
+            phase_timer = PhaseTimer()
+        if telemetry is None:
+            telemetry = ImportTelemetry()
+        state, resumed = self._begin_import(
+            fname, {"encode": bool(encode), "langs": langs}, resume)
+        stream, raw = open_input(fname)
+        telemetry.start(raw, os.path.getsize(fname))
+        try:
+            with phase_timer.phase("populate"):
+                start = timer()
+                head = read_until(stream, "]>")
+                entities = self._get_entities(head)
+                entries = iter_elements(PrefixedFile(head, stream),
+                                        ("entry",), telemetry)
+                telemetry.add_time("parse", timer() - start)
+
+                if resumed:
+                    self._setup_codebook()
+                else:
+                    self._setup_codebook(encode)
+                    self._create_new_tables(indexes=False)
+                    self._populate_entities(entities)
+                    self._save_import_state(state)
+                if state["stage"] == "populate":
+                    entries = self._checkpointed(
+                        entries, state,
+                        lambda entry: entry.findtext("ent_seq"), telemetry)
+                    self._populate_with_telemetry(
+                        telemetry, self._populate_database,
+                        entries, langs, telemetry)
+                    state["stage"] = "index"
+                    self._save_import_state(state)
+        finally:
+            stream.close()
+            raw.close()
+
+        start = timer()
+        with phase_timer.phase("index"):
+            if resumed:
+                self._drop_indexes()
+            self._create_indexes()
             self.conn.commit()
 
-    def search(self, query, lang=None):
-        # Search
-        # Two main methods: to and from Japanese.
-        # 1. Guess which direction we're searching.
-        # 2. Search preferred method.
-        # 3. Search remaining method.
-        query = convert_query_to_unicode(query)
-        query = "%%%s%%" % query  # Wrap in wildcards
+        with phase_timer.phase("resolve"):
+            self._resolve_cross_refs()
+            self._finish_import(state)
+        telemetry.add_time("index", timer() - start)
+        telemetry.finish()
+
+    @request
+    def search(self, query, lang=None, limit=None, offset=0,
+               projection=None, fuzzy=False):
+        """Searches Japanese headwords and foreign language glosses.
+
+        Results are ranked; see search_ids() for details.  Only the
+        requested page of entries is loaded, and of each only the
+        tables selected by projection ("headwords", "summary", "full"
+        or a spec; see BaseDatabase.get_children_map()).
+
+        fuzzy: search with search_fuzzy() instead, tolerating typos.
+
+        Returns a list of Entry objects.
+
+        """
+        search_ids = self.search_fuzzy if fuzzy else self.search_ids
+        entry_ids = search_ids(query, lang=lang, limit=limit, offset=offset)
+        results = self.lookup_many(entry_ids, projection)
+        return results
+
+    @request
+    def search_ids(self, query, lang=None, limit=None, offset=0):
+        """Searches Japanese headwords and foreign language glosses.
 
-        entries_from = self._search_from_japanese(query)
-        entries_to = self._search_to_japanese(query, lang=lang)
+        Kanji elements, reading elements and glosses (restricted to
+        lang, if given) are searched together.  Results are ranked
+        first by match tier:
 
-        entry_ids = entries_from + entries_to
-        results = [self.lookup(entry_id) for entry_id in entry_ids]
+          1. Exact match
+          2. Begins with
+          3. Anywhere
+
+        and then by entry priority (common words first).  Tiers are
+        searched in order and the search stops as soon as the
+        requested page is full, so the costly substring scan is
+        skipped whenever the better tiers suffice.
+
+        The query is normalized first (see normalize_query()).  If a
+        search cache is enabled, ranked ID lists are served from it.
+
+        limit: maximum number of IDs to return, or None for all.
+        offset: number of ranked results to skip.
+
+        Returns a list of entry IDs.
+
+        """
+        query = normalize_query(query)
+        needed = None if limit is None else offset + limit
+        results = self._cached_search(
+            lambda: self._search_ranked(query, lang, needed),
+            query, lang, "ranked", needed)
+
+        if limit is None:
+            return results[offset:]
+        return results[offset:offset + limit]
+
+    @request
+    def search_seqs(self, query, lang=None, limit=None, offset=0):
+        """Like search_ids(), but returns the ranked ent_seq values,
+        which remain valid across rebuilds."""
+        entry_ids = self.search_ids(query, lang=lang, limit=limit,
+                                    offset=offset)
+        seqs = self.seqs_for_ids(entry_ids)
+        return [seqs[entry_id] for entry_id in entry_ids]
+
+    @request
+    def search_fuzzy(self, query, lang=None, limit=None, offset=0,
+                     max_distance=None):
+        """Searches gloss words and readings, tolerating typos.
+
+        Requires the index built by jblite.fuzzy.  Each word of the
+        query must be within the allowed edit distance of a gloss
+        word (restricted to lang, if given) of an entry, or the whole
+        query within the distance of one of its readings.  Longer
+        words allow more edits (see fuzzy.allowed_distance()), up to
+        max_distance or the largest distance indexed.
+
+        Returns a list of entry IDs, ranked by total edit distance and
+        then by priority.
+
+        """
+        settings = self._get_metadata().get("fuzzy_index")
+        if settings is None:
+            raise ValueError("No fuzzy index; build it with jblite.fuzzy")
+        if max_distance is None or max_distance > settings["max_distance"]:
+            max_distance = settings["max_distance"]
+        query = normalize_query(query)
+        needed = None if limit is None else offset + limit
+        # Rebuilding the index does not change the content version, so
+        # the build is part of the cache key.
+        results = self._cached_search(
+            lambda: self._search_fuzzy(query, lang, max_distance,
+                                       settings["prefix_length"], needed),
+            query, lang,
+            "fuzzy:%d:%s" % (max_distance, settings.get("build")), needed)
+        if limit is None:
+            return results[offset:]
+        return results[offset:offset + limit]
+
+    def _search_fuzzy(self, query, lang, max_distance, prefix_length,
+                      needed=None):
+        """Returns at least the first needed ranked IDs (all if None).
+
+        Priorities are only read for the distances needed to fill the
+        page.
+
+        """
+        if lang is not None:
+            lang = self.tables["gloss"].get_code("lang", lang)
+            if lang is None:
+                # No gloss uses this language.
+                return []
+        distances = None
+        for word in split_words(query):
+            matches = self._match_fuzzy_terms(word, GLOSS, lang,
+                                              max_distance, prefix_length)
+            if distances is None:
+                distances = matches
+            else:
+                distances = dict((entry_id, distance + matches[entry_id])
+                                 for entry_id, distance
+                                 in distances.iteritems()
+                                 if entry_id in matches)
+        if distances is None:
+            distances = {}
+        matches = self._match_fuzzy_terms(query, READING, None,
+                                          max_distance, prefix_length)
+        for entry_id, distance in matches.iteritems():
+            if distance < distances.get(entry_id, distance + 1):
+                distances[entry_id] = distance
+
+        by_distance = {}
+        for entry_id, distance in distances.iteritems():
+            by_distance.setdefault(distance, []).append(entry_id)
+        results = []
+        for distance in sorted(by_distance):
+            if needed is not None and len(results) >= needed:
+                break
+            priorities = {}
+            for chunk in iter_chunks(sorted(by_distance[distance])):
+                self.cursor.execute(
+                    "SELECT id, priority FROM entry WHERE id IN (%s)" %
+                    ", ".join("?" * len(chunk)), chunk)
+                priorities.update(self.cursor.fetchall())
+            results.extend(sorted(priorities, key=lambda entry_id: (
+                -priorities[entry_id], entry_id)))
         return results
 
-    def _search_from_japanese(self, query):
-        # Japanese search locations:
-        # 1. Kanji elements
-        # 2. Reading elements
-        # 3. Any indices (none yet)
-        #
-        # Preferred orderings
-        # 1. Location of query in result
-        #    1. Exact match
-        #    2. Begins with
-        #    3. Anywhere
-        # 2. Ranking of usage (the (P) option in EDICT, for example)
-        #
-        # FOR NOW: just get the searching working.
-        # This puts us on roughly the same level as J-Ben 1.2.x.
-        entries_by_keb = self._search_keb(query)
-        entries_by_reb = self._search_reb(query)
-        #entries_by_indices = self._search_indices_from_ja(unicode_query)
-
-        # Merge results into one list and return.
+    def _match_fuzzy_terms(self, term, kind, lang, max_distance,
+                           prefix_length):
+        """Returns a dictionary of entry ID to the smallest edit
+        distance between term and an indexed term of the entry."""
+        distance = allowed_distance(term, max_distance)
+        variants = [hash_variant(variant) for variant
+                    in get_deletes(term, distance, prefix_length)]
+        conditions = ["kind = ?"]
+        args = [kind]
+        if lang is not None:
+            conditions.append("lang = ?")
+            args.append(lang)
+        result = {}
+        for chunk in iter_chunks(variants):
+            self.cursor.execute(
+                "SELECT term, entry_ids FROM fuzzy_term "
+                "WHERE id IN (SELECT term_id FROM fuzzy_variant "
+                "WHERE variant IN (%s)) AND %s" %
+                (", ".join("?" * len(chunk)), " AND ".join(conditions)),
+                chunk + args)
+            for candidate, entry_ids in self.cursor.fetchall():
+                found = edit_distance(term, candidate, distance)
+                if found > distance:
+                    continue
+                for entry_id in unpack_ids(entry_ids):
+                    if found < result.get(entry_id, found + 1):
+                        result[entry_id] = found
+        return result
+
+    def _search_ranked(self, query, lang, needed):
+        """Returns at least the first needed ranked IDs (all if None)."""
         results = []
-        for lst in (entries_by_keb, entries_by_reb):
-            for o in lst:
-                if o not in results:
-                    results.append(o)
+        seen = set()
+        for tier in (self._exact_match_tier, self._prefix_match_tier,
+                     self._substring_match_tier):
+            if needed is not None and len(results) >= needed:
+                break
+            tier_limit = -1 if needed is None else needed + len(seen)
+            for entry_id in tier(query, lang, tier_limit):
+                if entry_id not in seen:
+                    seen.add(entry_id)
+                    results.append(entry_id)
         return results
 
-    def _search_keb(self, unicode_query):
-        """Searches kanji elements (Japanese readings with kanji).
+    def _exact_match_tier(self, query, lang, limit):
+        return self._search_tier("%(value)s = ?", [query], lang, limit)
 
-        Returns a list of entry IDs.
+    def _prefix_match_tier(self, query, lang, limit):
+        if len(query) == 0:
+            return []
+        # A range rather than LIKE "query%", so the value indices
+        # can be used.
+        bound = get_prefix_upper_bound(query)
+        return self._search_tier("%(value)s >= ? AND %(value)s < ?",
+                                 [query, bound], lang, limit)
+
+    def _substring_match_tier(self, query, lang, limit):
+        pattern = "%%%s%%" % query  # Wrap in wildcards
+        return self._search_tier("%(value)s LIKE ?", [pattern], lang, limit)
+
+    def _search_tier(self, condition, condition_args, lang, limit):
+        """Finds entries matching a condition on keb, reb or gloss.
+
+        condition is an SQL template; %(value)s is replaced with the
+        value column of each searched table.
+
+        Returns up to limit entry IDs (-1 for no limit), ordered by
+        priority.
 
         """
         # keb: entry.id -> k_ele.fk, k_ele.value
-        query = "SELECT fk FROM k_ele WHERE value LIKE ?"
-        args = (unicode_query,)
+        # reb: entry.id -> r_ele.fk, r_ele.value
+        # gloss: entry.id -> sense.fk, sense.id -> gloss.fk
+        subqueries = [
+            "SELECT fk FROM k_ele WHERE %s" % (condition % {"value": "value"}),
+            "SELECT fk FROM r_ele WHERE %s" % (condition % {"value": "value"}),
+            ]
+        args = condition_args + condition_args
+
+        gloss_conditions = []
+        if lang is not None:
+            gloss_conditions.append("g.lang = ?")
+            args.append(self.tables["gloss"].get_code("lang", lang))
+        gloss_conditions.append(condition % {"value": "g.value"})
+        args.extend(condition_args)
+        gloss_conditions.append("g.fk = s.id")
+        subqueries.append("SELECT s.fk FROM gloss g, sense s WHERE %s" %
+                          " AND ".join(gloss_conditions))
+
+        query = ("SELECT id FROM entry WHERE id IN (%s) "
+                 "ORDER BY priority DESC, id LIMIT ?" %
+                 " UNION ".join(subqueries))
+        args.append(limit)
         self.cursor.execute(query, args)
         rows = self.cursor.fetchall()
         return [row[0] for row in rows]
 
-    def _search_reb(self, unicode_query):
-        """Searches reading elements (Japanese readings without kanji).
+    @request
+    def search_many(self, terms, mode="exact", lang=None, glosses=True):
+        """Resolves many search terms at once.
 
-        Returns a list of entry IDs.
+        The terms are bound as a VALUES list and joined against the
+        keb, reb and (if glosses is True) gloss indices, a few hundred
+        terms per query, which is far cheaper than one search() per
+        term.  Nothing is written, so any transaction the caller has
+        open is left alone.
+
+        mode: "exact" matches whole values; "prefix" matches values
+            beginning with a term.
+        lang: restricts gloss matches to one language.
+
+        Terms are normalized like search() queries (see
+        helpers.normalize_query()).  Returns a dictionary of term (as
+        given, in unicode) to list of entry IDs, most common entries
+        first.  Every term is present; terms without matches map to
+        an empty list.  The IDs can be passed straight to
+        lookup_many().
 
         """
-        # reb: entry.id -> r_ele.fk, r_ele.value
-        query = "SELECT fk FROM r_ele WHERE value LIKE ?"
-        args = (unicode_query,)
-        self.cursor.execute(query, args)
-        rows = self.cursor.fetchall()
-        return [row[0] for row in rows]
+        if mode == "exact":
+            condition = "%(value)s = t.term"
+        elif mode == "prefix":
+            condition = "%(value)s >= t.term AND %(value)s < t.bound"
+        else:
+            raise ValueError("Unknown search mode: %r" % mode)
+
+        normalized = dict((convert_query_to_unicode(term),
+                           normalize_query(term)) for term in terms)
+        matches = dict((term, []) for term in normalized.itervalues())
+        search_terms = sorted(term for term in matches if len(term) > 0)
+
+        gloss_args = []
+        if glosses and lang is not None:
+            gloss_args.append(self.tables["gloss"].get_code("lang", lang))
+
+        # Each term takes two parameters.
+        for chunk in iter_chunks(search_terms, MAX_IN_ARGS // 2):
+            args = []
+            for term in chunk:
+                args.extend((term, get_prefix_upper_bound(term)))
+            values = ("(SELECT column1 AS term, column2 AS bound "
+                      "FROM (VALUES %s))" %
+                      ", ".join(["(?, ?)"] * len(chunk)))
+            # CROSS JOIN keeps the (small) term list as the outer
+            # loop, so each term is a single index seek.
+            subqueries = [
+                "SELECT t.term, k.fk FROM %s t CROSS JOIN k_ele k "
+                "WHERE %s" % (values, condition % {"value": "k.value"}),
+                "SELECT t.term, r.fk FROM %s t CROSS JOIN r_ele r "
+                "WHERE %s" % (values, condition % {"value": "r.value"}),
+                ]
+            query_args = args + args
+            if glosses:
+                gloss_conditions = [condition % {"value": "g.value"},
+                                    "g.fk = s.id"]
+                if lang is not None:
+                    gloss_conditions.insert(0, "g.lang = ?")
+                subqueries.append(
+                    "SELECT t.term, s.fk FROM %s t "
+                    "CROSS JOIN gloss g CROSS JOIN sense s "
+                    "WHERE %s" % (values, " AND ".join(gloss_conditions)))
+                query_args += args + gloss_args
+
+            query = ("SELECT m.term, e.id FROM (%s) m, entry e "
+                     "WHERE e.id = m.fk "
+                     "ORDER BY m.term, e.priority DESC, e.id" %
+                     " UNION ".join(subqueries))
+            self.cursor.execute(query, query_args)
+            for term, entry_id in self.cursor.fetchall():
+                matches[term].append(entry_id)
+        return dict((term, list(matches[normalized_term]))
+                    for term, normalized_term in normalized.iteritems())
+
+    @request
+    def words_with_kanji(self, literal):
+        """Finds entries whose kanji elements contain a character.
+
+        Requires the cross index built by jblite.kanjiwords; raises
+        ValueError if it is missing or out of date.
+
+        Returns a list of entry IDs, most common words first.
 
-    def _search_indices_from_ja(self, unicode_query):
-        raise NotImplementedError
+        """
+        check_kanji_word_index(self, {"jmdict": self._get_metadata().get(
+            "content_version")})
+        literal = convert_query_to_unicode(literal)
+        self.cursor.execute(
+            "SELECT entry_ids FROM kanji_word WHERE literal = ?", (literal,))
+        row = self.cursor.fetchone()
+        return unpack_ids(row[0]) if row is not None else []
+
+    @request
+    def lookup(self, id, projection=None):
+        return BaseDatabase.lookup(self, "entry", id, projection)
+
+    @request
+    def lookup_many(self, ids, projection=None):
+        """Looks up several entries at once; see BaseDatabase.lookup_many."""
+        return BaseDatabase.lookup_many(self, "entry", ids, projection)
+
+    @request
+    def lookup_by_seq(self, seqs, projection=None):
+        """Looks up entries by ent_seq.
+
+        Entry IDs are assigned anew by every import, but JMdict's
+        ent_seq numbers are stable, so they are the ones to keep
+        outside the database.  The seqs are resolved with one indexed
+        query per few hundred values (see ids_for_seqs()), and the
+        entries loaded with lookup_many().
+
+        Returns a list of Entry objects in the order of seqs.  Unknown
+        seqs are skipped.
 
-    def _search_to_japanese(self, query, lang):
-        # Foreign language search locations:
-        # 1. Glosses
-        # 2. Any indices (none yet)
-        #
-        # For other considerations, see search_from_japanese().
-        entries_by_glosses = self._search_glosses(query, lang)
-        #entries_by_indices = self._search_indices_to_ja(unicode_query, lang)
+        """
+        seqs = [int(seq) for seq in seqs]
+        ids = self.ids_for_seqs(seqs)
+        return self.lookup_many([ids[seq] for seq in seqs if seq in ids],
+                                projection)
 
-        # Merge results into one list and return.
-        results = []
-        for lst in (entries_by_glosses,):
-            for o in lst:
-                if o not in results:
-                    results.append(o)
-        return results
+    @request
+    def ids_for_seqs(self, seqs):
+        """Returns a dictionary of ent_seq to entry ID.
 
+        Unknown seqs are left out.
 
-    def _search_glosses(self, unicode_query, lang):
-        """Searches foreign language glosses.
+        """
+        result = {}
+        for chunk in iter_chunks(sorted(set(int(seq) for seq in seqs))):
+            self.cursor.execute(
+                "SELECT ent_seq, id FROM entry WHERE ent_seq IN (%s)" %
+                ", ".join("?" * len(chunk)), chunk)
+            result.update(self.cursor.fetchall())
+        return result
 
-        If lang is not None, only entries which match the lang
-        parameter are returned.
+    @request
+    def seqs_for_ids(self, entry_ids):
+        """Returns a dictionary of entry ID to ent_seq."""
+        result = {}
+        for chunk in iter_chunks(sorted(set(entry_ids))):
+            self.cursor.execute(
+                "SELECT id, ent_seq FROM entry WHERE id IN (%s)" %
+                ", ".join("?" * len(chunk)), chunk)
+            result.update(self.cursor.fetchall())
+        return result
 
-        Returns a list of entry IDs.
+    @request
+    def headwords(self, entry_ids, primary_only=False):
+        """Returns the headwords of entries, without loading them.
+
+        primary_only: return only the main headword of each entry.
+
+        Returns a dictionary of entry ID to a list of Headword tuples,
+        the main headword first, then by rank.
 
         """
-        # entry.id -> sense.fk, sense.id -> gloss.fk
+        condition = " AND is_primary = 1" if primary_only else ""
+        result = {}
+        for chunk in iter_chunks(sorted(set(entry_ids))):
+            self.cursor.execute(
+                "SELECT fk, kanji, reading, rank, is_primary FROM headword "
+                "WHERE fk IN (%s)%s ORDER BY fk, is_primary DESC, rank DESC, id"
+                % (", ".join("?" * len(chunk)), condition), chunk)
+            for row in self.cursor.fetchall():
+                result.setdefault(row[0], []).append(Headword(*row))
+        return result
 
-        # FORMAT: SELECT e.id FROM gloss g, sense s, entry e
-        #         WHERE (g.lang = ? AND) g.value LIKE ?
-        #         AND g.fk = s.id AND s.fk = e.id
-        select_clause = "SELECT e.id"
-        from_clause = "FROM gloss g, sense s, entry e"
-        where_conditions = []
-        args = []
+    @request
+    def find_headword(self, form):
+        """Finds entries with form as kanji form or reading.
 
-        if lang is not None:
-            where_conditions.append("g.lang = ?")
-            args.append(lang)
+        Returns a list of the matching Headword tuples, most common
+        entries first.
 
-        where_conditions.append("g.value LIKE ?")
-        args.append(unicode_query)
+        """
+        form = convert_query_to_unicode(form)
+        self.cursor.execute(
+            "SELECT h.fk, h.kanji, h.reading, h.rank, h.is_primary "
+            "FROM headword h JOIN entry e ON e.id = h.fk "
+            "WHERE h.id IN (SELECT id FROM headword WHERE kanji = ?"
+            " UNION SELECT id FROM headword WHERE reading = ?) "
+            "ORDER BY e.priority DESC, h.fk, h.rank DESC, h.id",
+            (form, form))
+        return [Headword(*row) for row in self.cursor.fetchall()]
 
-        where_conditions.append("g.fk = s.id")
-        where_conditions.append("s.fk = e.id")
-        where_clause = "WHERE %s" % " AND ".join(where_conditions)
+    @request
+    def cross_refs(self, entry_ids, kinds=CROSS_REF_KINDS):
+        """Returns the resolved xrefs/ants of the given entries.
 
-        query = " ".join([select_clause, from_clause, where_clause])
-        self.cursor.execute(query, args)
-        rows = self.cursor.fetchall()
-        return [row[0] for row in rows]
+        kinds: which references to include ("xref", "ant").
 
-    def _search_indices_to_ja(self, unicode_query, lang):
-        raise NotImplementedError
+        Returns a list of CrossRef tuples, ordered by entry ID and
+        sense.  References which matched no entry are left out.
+
+        """
+        return self._get_cross_refs("s.fk", entry_ids, kinds)
 
-    def lookup(self, id):
-        return BaseDatabase.lookup(self, "entry", id)
+    @request
+    def cross_refs_to(self, entry_ids, kinds=CROSS_REF_KINDS):
+        """Returns the xrefs/ants pointing at the given entries
+        ("what links here"), as a list of CrossRef tuples."""
+        return self._get_cross_refs("x.target_entry", entry_ids, kinds)
+
+    @request
+    def related(self, entry_ids, kinds=CROSS_REF_KINDS, projection=None):
+        """Loads the entries referred to by the given entries.
+
+        Returns a dictionary of entry ID to a list of (CrossRef,
+        target Entry) pairs.  The targets of all entries are loaded
+        with a single lookup_many(), using projection.
+
+        """
+        refs = self._get_cross_refs("s.fk", entry_ids, kinds)
+        return self._pair_with_entries(refs, "entry_id", "target_id",
+                                       projection)
+
+    @request
+    def linked_from(self, entry_ids, kinds=CROSS_REF_KINDS,
+                    projection=None):
+        """Loads the entries referring to the given entries.
+
+        Returns a dictionary of entry ID to a list of (CrossRef,
+        referring Entry) pairs.
+
+        """
+        refs = self._get_cross_refs("x.target_entry", entry_ids, kinds)
+        return self._pair_with_entries(refs, "target_id", "entry_id",
+                                       projection)
+
+    def _get_cross_refs(self, column, entry_ids, kinds):
+        """Runs the cross reference query with column IN entry_ids."""
+        for kind in kinds:
+            if kind not in CROSS_REF_KINDS:
+                raise ValueError("Unknown cross reference kind: %r" % kind)
+        refs = []
+        for chunk in iter_chunks(sorted(set(entry_ids))):
+            in_list = ", ".join("?" * len(chunk))
+            parts = [
+                "SELECT '%s', x.id, s.fk,"
+                " s.id - (SELECT MIN(id) FROM sense WHERE fk = s.fk) + 1,"
+                " x.target_entry, x.target_sense "
+                "FROM %s x JOIN sense s ON s.id = x.fk "
+                "WHERE %s IN (%s) AND x.target_entry IS NOT NULL"
+                % (kind, kind, column, in_list)
+                for kind in kinds]
+            self.cursor.execute(" UNION ALL ".join(parts),
+                                chunk * len(kinds))
+            refs.extend(self.cursor.fetchall())
+        refs.sort(key=lambda row: (row[2], row[3], row[0], row[1]))
+        return [CrossRef(kind, entry_id, sense, target_id, target_sense)
+                for kind, ref_id, entry_id, sense, target_id, target_sense
+                in refs]
+
+    def _pair_with_entries(self, refs, key_field, other_field,
+                           projection=None):
+        """Groups refs by key_field and loads the other_field entries.
+
+        Refs whose other_field entry is not found are left out, like
+        the missing IDs of lookup_many().
+
+        """
+        other_ids = sorted(set(getattr(ref, other_field) for ref in refs))
+        entries = dict((entry._record.data["id"], entry) for entry
+                       in self.lookup_many(other_ids, projection))
+        result = {}
+        for ref in refs:
+            entry = entries.get(getattr(ref, other_field))
+            if entry is not None:
+                result.setdefault(getattr(ref, key_field), []).append(
+                    (ref, entry))
+        return result
 
     def query_db(self, *args, **kwargs):
         """Helper.  Wraps the execute/fetchall idiom on the DB cursor."""
@@ -323,7 +930,8 @@ class Database(BaseDatabase):
 
         """
         class_mappings = {
-            "entry": EntryTable,     # key->int ID
+            "entry": EntryTable,     # key->int ID, priority
+            "k_ele": KEleTable,      # key-value, value indexed
             "r_ele": REleTable,      # key-value plus nokanji flag
             "sense": SenseTable,     # one-many group mapping for sense info
             "audit": AuditTable,     # key->(update_date, update_details)
@@ -332,22 +940,26 @@ class Database(BaseDatabase):
             "links": LinksTable,     # key -> tag, desc, uri
             "bibl": BiblTable,       # key -> tag, txt
             "entity": EntityTable,   # Info from JMdict XML entities
+            "headword": HeadwordTable, # derived: kanji/reading pairs
+            "ke_pri": PriorityTable, # key-value, value may be encoded
+            "re_pri": PriorityTable,
+            "pri": PriorityTable,
             }
 
         # Set up key/value and key/entity tables
         kv_tables = [ # key-value tables (id -> text blob)
-            "k_ele",
-            "ke_pri",
-            "re_restr",
-            "re_pri",
             "etym",
+            "s_inf",
+            "example",
+            ]
+        restriction_tables = [ # key-value plus k_ele/r_ele id of value
+            "re_restr",
             "stagk",
             "stagr",
+            ]
+        cross_ref_tables = [ # key-value plus target entry/sense
             "xref",  # (#PCDATA)* - why the *?
             "ant",   # (#PCDATA)* - why the *?
-            "s_inf",
-            "example",
-            "pri",
             ]
         kv_entity_tables = [ # key-value tables where val == entity
             "ke_inf",
@@ -359,6 +971,10 @@ class Database(BaseDatabase):
             ]
         for tbl in kv_tables:
             class_mappings[tbl] = KeyValueTable
+        for tbl in restriction_tables:
+            class_mappings[tbl] = RestrictionTable
+        for tbl in cross_ref_tables:
+            class_mappings[tbl] = CrossRefTable
         for tbl in kv_entity_tables:
             class_mappings[tbl] = KeyEntityTable
 
@@ -369,42 +985,66 @@ class Database(BaseDatabase):
 
         return table_mappings
 
-    def _create_new_tables(self):
+    def _create_new_tables(self, indexes=True):
         """(Re)creates the database tables."""
         for tbl, tbl_obj in self.tables.iteritems():
             self.cursor.execute("DROP TABLE IF EXISTS %s" % tbl)
-            tbl_obj.create()
+            tbl_obj.create(indexes)
 
-    def _populate_database(self, etree, entities):
+    def _populate_entities(self, entities):
+        """Fills the entity table.
+
+        entities: entity name to description dictionary
+
+        """
+        tbl = self.tables['entity']
+        for entity, expansion in entities.iteritems():
+            tbl.insert(entity, expansion)
+
+    def _populate_database(self, entries, langs=None, telemetry=None):
         """Imports XML data into SQLite database.
 
         table_d: table to table_object dictionary
-        etree: ElementTree object for JMdict
-        entities: entity name to description dictionary
+        entries: iterable of JMdict <entry> elements
+        langs: languages of glosses to import, or None for all
+        telemetry: ImportTelemetry to count entries in
+
+        The entity table must be populated already.
 
         """
         # NOTE: this is waaay too long.  Should be broken up somehow.
         # For now this will work though...
 
-        # Populate entities table and get integer keys
+        # Get integer keys of entities
         # NOTE: we'll be mapping from *expanded* entities to ints.
-        entity_int_d = {}
-        tbl = self.tables['entity']
-        for entity, expansion in entities.iteritems():
-            i = tbl.insert(entity, expansion)
-            entity_int_d[expansion] = i
+        self.cursor.execute("SELECT id, expansion FROM entity")
+        entity_int_d = dict((expansion, i)
+                            for i, expansion in self.cursor.fetchall())
 
         # Iterate through each entry
-        for entry in etree.findall("entry"):
+        for entry in entries:
+            if telemetry is not None:
+                telemetry.item()
 
             # entry table
             ent_seq = entry.find("ent_seq")
-            entry_id = self.tables["entry"].insert(int(ent_seq.text))
+            markers = [pri.text for pri in entry.findall("k_ele/ke_pri")]
+            markers += [pri.text for pri in entry.findall("r_ele/re_pri")]
+            markers += [pri.text for pri in entry.findall("sense/gloss/pri")]
+            priority = get_priority_score(markers)
+            entry_id = self.tables["entry"].insert(int(ent_seq.text),
+                                                   priority)
+
+            # Row ids of this entry's kanji and readings, for resolving
+            # re_restr, stagk and stagr.
+            k_ele_ids = {}
+            r_ele_ids = {}
 
             for k_ele in entry.findall("k_ele"):
                 # k_ele
                 value = k_ele.find("keb").text
                 k_ele_id = self.tables["k_ele"].insert(entry_id, value)
+                k_ele_ids.setdefault(value, k_ele_id)
 
                 # ke_inf
                 for ke_inf in k_ele.findall("ke_inf"):
@@ -413,22 +1053,25 @@ class Database(BaseDatabase):
                     self.tables["ke_inf"].insert(k_ele_id, entity_id)
 
                 # ke_pri
+                table = self.tables["ke_pri"]
                 for ke_pri in k_ele.findall("ke_pri"):
-                    value = ke_pri.text
-                    self.tables["ke_pri"].insert(k_ele_id, value)
+                    value = table.encode("value", ke_pri.text)
+                    table.insert(k_ele_id, value)
 
             for r_ele in entry.findall("r_ele"):
                 # r_ele
                 value = r_ele.find("reb").text
                 # For nokanji: currently it's an empty tag, so
                 # treating it as true/false.
-                nokanji = 1 if r_ele.find("nokanji") is not None else 0
+                nokanji = 1 if r_ele.find("re_nokanji") is not None else 0
                 r_ele_id = self.tables["r_ele"].insert(entry_id, value, nokanji)
+                r_ele_ids.setdefault(value, r_ele_id)
 
                 # re_restr
                 for re_restr in r_ele.findall("re_restr"):
                     value = re_restr.text
-                    self.tables["re_restr"].insert(r_ele_id, value)
+                    self.tables["re_restr"].insert(r_ele_id, value,
+                                                   k_ele_ids.get(value))
 
                 # re_inf
                 for re_inf in r_ele.findall("re_inf"):
@@ -437,9 +1080,16 @@ class Database(BaseDatabase):
                     self.tables["re_inf"].insert(r_ele_id, entity_id)
 
                 # re_pri
+                table = self.tables["re_pri"]
                 for re_pri in r_ele.findall("re_pri"):
-                    value = re_pri.text
-                    self.tables["re_pri"].insert(r_ele_id, value)
+                    value = table.encode("value", re_pri.text)
+                    table.insert(r_ele_id, value)
+
+            # headword (derived)
+            table = self.tables["headword"]
+            for index, (keb, reb, rank) in enumerate(get_headwords(entry)):
+                table.insert(entry_id, keb, reb, rank,
+                             1 if index == 0 else 0)
 
             # info
             # (Although children of an info node, since there's only
@@ -467,7 +1117,8 @@ class Database(BaseDatabase):
 
             # sense
             key_entity_tables = ["pos", "field", "misc", "dial"]
-            key_value_tables = ["stagk", "stagr", "xref", "ant", "s_inf", "example"]
+            key_value_tables = ["xref", "ant", "s_inf", "example"]
+            restriction_tables = [("stagk", k_ele_ids), ("stagr", r_ele_ids)]
 
             for sense in entry.findall("sense"):
                 # Each sense gets its own ID, for grouping purposes
@@ -477,6 +1128,12 @@ class Database(BaseDatabase):
                     for element in sense.findall(elem_name):
                         self.tables[elem_name].insert(sense_id, element.text)
 
+                for elem_name, target_ids in restriction_tables:
+                    for element in sense.findall(elem_name):
+                        self.tables[elem_name].insert(
+                            sense_id, element.text,
+                            target_ids.get(element.text))
+
                 for elem_name in key_entity_tables:
                     for element in sense.findall(elem_name):
                         entity_id = entity_int_d[element.text.strip()]
@@ -497,21 +1154,94 @@ class Database(BaseDatabase):
                             'Only known valid ls_wasei attribute value '
                             'is "y", found:', ls_wasei.text)
 
+                    lang = self.tables["lsource"].encode("lang", lang)
                     self.tables["lsource"].insert(sense_id,
                                                   lang, partial, wasei)
                 for gloss in sense.findall("gloss"):
                     lang = gloss.get(XML_LANG, "eng")
+                    if langs is not None and lang not in langs:
+                        continue
+                    lang = self.tables["gloss"].encode("lang", lang)
                     g_gend = gloss.get("g_gend")
                     pri_list = gloss.getchildren()
                     if len(pri_list) > 1:
                         gloss_id = self.tables['gloss'].insert(
                             sense_id, lang, g_gend, gloss.text, 1)
                         for pri in pri_list:
-                            self.tables['pri'].insert(gloss_id, pri.text)
+                            value = self.tables['pri'].encode("value",
+                                                              pri.text)
+                            self.tables['pri'].insert(gloss_id, value)
                     else:
                         self.tables['gloss'].insert(sense_id, lang, g_gend,
                                                     gloss.text, 0)
 
+    def _resolve_cross_refs(self):
+        """Fills in the targets of xref and ant references.
+
+        A reference resolves to the entry having its keb and/or reb (a
+        lone form may be either).  If several entries qualify, the
+        most common (then the first) one is used.  Sense numbers
+        beyond the target's senses are dropped.
+
+        """
+        refs = []  # (table, id, forms, sense)
+        forms = set()
+        for kind in CROSS_REF_KINDS:
+            self.cursor.execute("SELECT id, value FROM %s" % kind)
+            for ref_id, value in self.cursor.fetchall():
+                ref_forms, sense = parse_cross_ref(value)
+                refs.append((kind, ref_id, ref_forms, sense))
+                forms.update(ref_forms)
+
+        # headword -> set of entry ids, for kanji and readings
+        kanji = {}
+        readings = {}
+        priorities = {}
+        forms = sorted(forms)
+        for table, by_form in (("k_ele", kanji), ("r_ele", readings)):
+            for chunk in iter_chunks(forms):
+                self.cursor.execute(
+                    "SELECT h.value, e.id, e.priority "
+                    "FROM %s h JOIN entry e ON e.id = h.fk "
+                    "WHERE h.value IN (%s)"
+                    % (table, ", ".join("?" * len(chunk))), chunk)
+                for value, entry_id, priority in self.cursor.fetchall():
+                    by_form.setdefault(value, set()).add(entry_id)
+                    priorities[entry_id] = priority
+
+        targets = {}  # (table, id) -> (entry id, sense)
+        for kind, ref_id, ref_forms, sense in refs:
+            if len(ref_forms) == 2:
+                candidates = kanji.get(ref_forms[0], set()) & \
+                    readings.get(ref_forms[1], set())
+            else:
+                candidates = kanji.get(ref_forms[0], set()) | \
+                    readings.get(ref_forms[0], set())
+            if len(candidates) > 0:
+                target = min(candidates,
+                             key=lambda i: (-priorities[i], i))
+                targets[(kind, ref_id)] = (target, sense)
+
+        sense_counts = {}
+        target_ids = sorted(set(t[0] for t in targets.itervalues()))
+        for chunk in iter_chunks(target_ids):
+            self.cursor.execute(
+                "SELECT fk, COUNT(*) FROM sense WHERE fk IN (%s) GROUP BY fk"
+                % ", ".join("?" * len(chunk)), chunk)
+            sense_counts.update(self.cursor.fetchall())
+
+        for kind in CROSS_REF_KINDS:
+            rows = []
+            for (table, ref_id), (target, sense) in targets.iteritems():
+                if table != kind:
+                    continue
+                if sense is not None and sense > sense_counts.get(target, 0):
+                    sense = None
+                rows.append((target, sense, ref_id))
+            self.cursor.executemany(
+                "UPDATE %s SET target_entry = ?, target_sense = ? "
+                "WHERE id = ?" % kind, rows)
+
     def _get_entities(self, xml_data):
         """Gets the ENTITY definitions from JMdict.
 
@@ -543,14 +1273,31 @@ class Database(BaseDatabase):
 
 
 class EntryTable(Table):
+    """Root table.  priority is a score derived from the entry's
+    ke_pri, re_pri and gloss pri markers; see get_priority_score()."""
     create_query = ("CREATE TABLE %s "
-                    "(id INTEGER PRIMARY KEY, ent_seq INTEGER)")
-    insert_query = "INSERT INTO %s VALUES (NULL, ?)"
+                    "(id INTEGER PRIMARY KEY, ent_seq INTEGER,"
+                    " priority INTEGER)")
+    insert_query = "INSERT INTO %s VALUES (NULL, ?, ?)"
     index_queries = [
         "CREATE INDEX %s_seq ON %s (ent_seq)",
+        "CREATE INDEX %s_priority ON %s (priority)",
         ]
 
 
+class KEleTable(KeyValueTable):
+    """Key/value table for <keb>, with the value indexed for searches."""
+    index_queries = [
+        "CREATE INDEX %s_fk ON %s (fk)",
+        "CREATE INDEX %s_value ON %s (value)",
+        ]
+
+
+class PriorityTable(KeyValueTable):
+    """Key/value table for ke_pri, re_pri and gloss pri markers."""
+    encoded_columns = {"value": "pri"}
+
+
 class KeyEntityTable(KeyValueTable):
     """Just like a KeyValueTable, but with 'entity' instead of 'value'."""
     create_query = ("CREATE TABLE %s "
@@ -564,6 +1311,7 @@ class REleTable(ChildTable):
     insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?)"
     index_queries = [
         "CREATE INDEX %s_fk ON %s (fk)",
+        "CREATE INDEX %s_value ON %s (value)",
         ]
 
 
@@ -576,6 +1324,51 @@ class SenseTable(ChildTable):
         ]
 
 
+class HeadwordTable(ChildTable):
+    """Kanji form/reading pairs of each entry, derived at import time
+    (see get_headwords()).  kanji is NULL for readings used on their
+    own.  Not part of the table_map: it duplicates data from k_ele,
+    r_ele and re_restr for listings and exact lookups."""
+    create_query = ("CREATE TABLE %s "
+                    "(id INTEGER PRIMARY KEY, fk INTEGER, kanji TEXT,"
+                    " reading TEXT, rank INTEGER, is_primary INTEGER)")
+    insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?, ?, ?)"
+    index_queries = [
+        "CREATE INDEX %s_fk ON %s (fk)",
+        "CREATE INDEX %s_kanji ON %s (kanji, fk)",
+        "CREATE INDEX %s_reading ON %s (reading, fk)",
+        ]
+
+
+class RestrictionTable(ChildTable):
+    """<re_restr>, <stagk> and <stagr>: the kanji or reading named,
+    plus the id of the k_ele (re_restr, stagk) or r_ele (stagr) row of
+    the same entry with that value."""
+    create_query = ("CREATE TABLE %s "
+                    "(id INTEGER PRIMARY KEY, fk INTEGER,"
+                    " value TEXT, target INTEGER)")
+    insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?)"
+    index_queries = [
+        "CREATE INDEX %s_fk ON %s (fk)",
+        "CREATE INDEX %s_target ON %s (target)",
+        ]
+
+
+class CrossRefTable(ChildTable):
+    """<xref> and <ant>: the reference as written ("keb・reb・sense"),
+    plus the entry id and sense number it refers to.  The targets are
+    resolved once all entries are imported (see _resolve_cross_refs()),
+    and stay NULL if the reference matches no entry."""
+    create_query = ("CREATE TABLE %s "
+                    "(id INTEGER PRIMARY KEY, fk INTEGER, value TEXT,"
+                    " target_entry INTEGER, target_sense INTEGER)")
+    insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, NULL, NULL)"
+    index_queries = [
+        "CREATE INDEX %s_fk ON %s (fk)",
+        "CREATE INDEX %s_target ON %s (target_entry, fk)",
+        ]
+
+
 class AuditTable(ChildTable):
     create_query = ("CREATE TABLE %s "
                     "(id INTEGER PRIMARY KEY, fk INTEGER,"
@@ -598,6 +1391,7 @@ class LSourceTable(ChildTable):
                     "(id INTEGER PRIMARY KEY, fk INTEGER,"
                     " lang TEXT, partial INTEGER, wasei INTEGER)")
     insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?, ?)"
+    encoded_columns = {"lang": "lang"}
     index_queries = [
         "CREATE INDEX %s_fk ON %s (fk)",
         ]
@@ -608,9 +1402,12 @@ class GlossTable(ChildTable):
                     "(id INTEGER PRIMARY KEY, fk INTEGER,"
                     " lang TEXT, g_gend TEXT, value TEXT, pri INTEGER)")
     insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?, ?, ?)"
+    encoded_columns = {"lang": "lang"}
+    # lang_value covers language-filtered searches, including
+    # substring scans, without touching the table itself.
     index_queries = [
         "CREATE INDEX %s_fk ON %s (fk)",
-        "CREATE INDEX %s_lang ON %s (lang)",
+        "CREATE INDEX %s_lang_value ON %s (lang, value, fk)",
         "CREATE INDEX %s_value ON %s (value)",
         ]
 
@@ -649,8 +1446,41 @@ def parse_args():
     op.add_option("-i", "--initialize",
                   dest="init_fname", metavar="XML_SOURCE",
                   help=_("Initialize database from file."))
+    op.add_option("-E", "--encode", action="store_true",
+                  help=_("When initializing, store repetitive values "
+                         "as integer codes (smaller database)."))
+    op.add_option("--keep-lang", action="append", dest="langs",
+                  metavar="LANG",
+                  help=_("When initializing, import only glosses in this "
+                         "language (may be repeated)."))
+    op.add_option("-S", "--swap", action="store_true",
+                  help=_("When initializing, build into a temporary file "
+                         "and replace the database only if the new one "
+                         "checks out."))
+    op.add_option("-R", "--resume", action="store_true",
+                  help=_("When initializing, continue an interrupted "
+                         "import of the same file if there is one."))
+    op.add_option("--progress", action="store_true",
+                  help=_("When initializing, show import progress."))
+    op.add_option("--telemetry", metavar="FILE",
+                  help=_("When initializing, write import statistics "
+                         "to FILE as JSON."))
     op.add_option("-L", "--lang",
                   help=_("Specify preferred language for searching."))
+    op.add_option("-n", "--limit", type="int",
+                  help=_("Show only the N best results."))
+    op.add_option("-z", "--fuzzy", action="store_true",
+                  help=_("Tolerate typos in the query (requires the "
+                         "index built by jblite.fuzzy)."))
+    op.add_option("-H", "--headwords", action="store_true",
+                  help=_("List only the headwords of the results."))
+    op.add_option("-q", "--seq", action="store_true",
+                  help=_("Look up entries by ent_seq (the remaining "
+                         "arguments) instead of searching."))
+    op.add_option("-C", "--cache", action="store_true",
+                  help=_("Cache search results in <db_filename>.cache."))
+    op.add_option("-P", "--profile", action="store_true",
+                  help=_("Print SQL statement (and cache) statistics when done."))
     options, args = op.parse_args()
     if len(args) < 1:
         op.print_help()
@@ -662,20 +1492,60 @@ def main():
     options, args = parse_args()
     db_fname = args[0]
 
+    profiler = QueryProfiler() if options.profile else None
     if options.init_fname is not None:
-        db = Database(db_fname, init_from_file=options.init_fname)
+        telemetry = ImportTelemetry(
+            print_progress if options.progress else None)
+        build_fname = get_build_filename(db_fname) if options.swap \
+            else db_fname
+        db = Database(build_fname, init_from_file=options.init_fname,
+                      profiler=profiler, encode=options.encode,
+                      langs=options.langs, telemetry=telemetry,
+                      resume=options.resume)
+        if options.telemetry is not None:
+            telemetry.write_json(options.telemetry)
+        if options.swap:
+            db.conn.close()
+            try:
+                install_database(Database, build_fname, db_fname)
+            except ValueError as e:
+                print(_("Not replacing %s: %s") % (db_fname, e),
+                      file=sys.stderr)
+                exit(1)
+            db = Database(db_fname, profiler=profiler)
     else:
-        db = Database(db_fname)
+        db = Database(db_fname, profiler=profiler)
+    if options.cache:
+        db.enable_cache()
 
     results = []
-    if len(args) > 1:
+    if len(args) > 1 and options.seq:
+        results = db.lookup_by_seq(args[1:])
+    elif len(args) > 1 and options.headwords:
+        # Listing from the headword table; no entries are loaded.
+        search_query = " ".join(args[1:])
+        search_ids = db.search_fuzzy if options.fuzzy else db.search_ids
+        ids = search_ids(search_query, lang=options.lang,
+                         limit=options.limit)
+        headwords = db.headwords(ids)
+        encoding = get_encoding()
+        for index, entry_id in enumerate(ids):
+            forms = [format_headword(h.kanji, h.reading)
+                     for h in headwords.get(entry_id, [])]
+            print((u"%d. %s" % (index + 1, u", ".join(forms)))
+                  .encode(encoding))
+        if len(ids) == 0:
+            print(_("No results found."))
+    elif len(args) > 1:
         # Do search
         # To be nice, we'll join all remaining args with spaces.
         search_query = " ".join(args[1:])
         if options.lang is not None:
-            results = db.search(search_query, lang=options.lang)
+            results = db.search(search_query, lang=options.lang,
+                                limit=options.limit, fuzzy=options.fuzzy)
         else:
-            results = db.search(search_query)
+            results = db.search(search_query, limit=options.limit,
+                                fuzzy=options.fuzzy)
 
     if len(results) > 0:
         encoding = get_encoding()
@@ -685,8 +1555,13 @@ def main():
 
             print(unicode(result).encode(encoding))
             print()
-    else:
+    elif not options.headwords:
         print(_("No results found."))
 
+    if profiler is not None:
+        print(profiler.format_summary(), file=sys.stderr)
+        if db.search_cache is not None:
+            print(db.search_cache.format_stats(), file=sys.stderr)
+
 if __name__ == "__main__":
     main()
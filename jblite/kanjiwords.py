@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Kanji to word cross index between KANJIDIC2 and JMdict.
+
+Builds a kanji_word table, mapping each KANJIDIC2 literal to the JMdict
+entries whose kanji elements contain it, and stores a copy in both
+databases.  Afterwards, jmdict.Database.words_with_kanji() and
+kd2.Database.words_with_kanji() answer "words using this kanji" with
+a single primary key read instead of a LIKE scan over k_ele.
+
+    python -m jblite.kanjiwords <jmdict.db> <kd2.db>
+
+The index records the content versions of both databases.
+Re-importing a database drops its copy, and words_with_kanji() raises
+ValueError if a copy no longer matches the databases it was built
+from; either way, the index must then be rebuilt.
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import json, sqlite3
+
+from helpers import pack_ids
+from table import Table, MetadataTable
+
+import gettext
+#t = gettext.translation("jblite")
+#_ = t.ugettext
+gettext.install("jblite")
+
+
+class KanjiWordTable(Table):
+    """Maps a kanji literal to a packed list of JMdict entry IDs."""
+    create_query = ("CREATE TABLE %s "
+                    "(literal TEXT PRIMARY KEY, entry_ids BLOB)")
+    insert_query = "INSERT INTO %s VALUES (?, ?)"
+
+
+def get_entry_priorities(cursor, schema="main"):
+    """Returns a dict of entry ID to priority score.
+
+    Entries without priority markers are not included.
+
+    """
+    cursor.execute("SELECT id, priority FROM %s.entry WHERE priority > 0" %
+                   schema)
+    return dict(cursor.fetchall())
+
+
+def get_content_version(cursor, schema="main"):
+    """Returns the content version recorded by the import of a
+    database, or None."""
+    cursor.execute("SELECT 1 FROM %s.sqlite_master "
+                   "WHERE type = 'table' AND name = 'metadata'" % schema)
+    if cursor.fetchone() is None:
+        return None
+    cursor.execute("SELECT value FROM %s.metadata "
+                   "WHERE key = 'content_version'" % schema)
+    row = cursor.fetchone()
+    return json.loads(row[0]) if row is not None else None
+
+
+def check_kanji_word_index(db, versions):
+    """Raises ValueError unless the kanji_word table of db exists and
+    was built from the given content versions.
+
+    versions: dictionary of "jmdict" and/or "kd2" to the current
+        content version of that database.
+
+    """
+    stamp = db._get_metadata().get("kanji_word")
+    if stamp is None:
+        raise ValueError("No kanji to word index; "
+                         "build it with jblite.kanjiwords")
+    for name, version in versions.iteritems():
+        if stamp.get(name) != version:
+            raise ValueError("The kanji to word index is out of date; "
+                             "rebuild it with jblite.kanjiwords")
+
+
+def build_kanji_word_index(jmdict_fname, kd2_fname):
+    """Builds the kanji_word table in both databases.
+
+    Both copies are stamped with the content versions of the two
+    databases, under the "kanji_word" metadata key.
+
+    Returns the number of kanji which appear in at least one entry.
+
+    """
+    conn = sqlite3.connect(kd2_fname)
+    cursor = conn.cursor()
+    try:
+        cursor.execute("ATTACH DATABASE ? AS jm", (jmdict_fname,))
+
+        cursor.execute("SELECT literal FROM character")
+        literals = set(row[0] for row in cursor.fetchall())
+
+        # One pass over all kanji elements, collecting entry IDs per
+        # kanji.
+        entries_by_literal = {}
+        cursor.execute("SELECT fk, value FROM jm.k_ele")
+        for entry_id, keb in cursor.fetchall():
+            for char in set(keb):
+                if char in literals:
+                    entries_by_literal.setdefault(char, set()).add(entry_id)
+
+        priorities = get_entry_priorities(cursor, "jm")
+        def sort_key(entry_id):
+            return (-priorities.get(entry_id, 0), entry_id)
+        rows = [(literal, pack_ids(sorted(entry_ids, key=sort_key)))
+                for literal, entry_ids
+                in sorted(entries_by_literal.iteritems())]
+
+        versions = {"jmdict": get_content_version(cursor, "jm"),
+                    "kd2": get_content_version(cursor)}
+        for schema in ("main", "jm"):
+            name = "%s.kanji_word" % schema
+            cursor.execute("DROP TABLE IF EXISTS %s" % name)
+            table = KanjiWordTable(cursor, name)
+            table.create()
+            table.insertmany(rows)
+            metadata = MetadataTable(cursor, "%s.metadata" % schema)
+            metadata.create()
+            metadata.set("kanji_word", versions)
+        conn.commit()
+    finally:
+        cursor.close()
+        conn.close()
+    return len(rows)
+
+
+######################################################################
+
+def parse_args():
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options] <jmdict_db> <kd2_db>")
+    options, args = op.parse_args()
+    if len(args) < 2:
+        op.print_help()
+        exit(-1)
+    return (options, args)
+
+def main():
+    options, args = parse_args()
+    count = build_kanji_word_index(args[0], args[1])
+    print(_("Indexed %d kanji.") % count)
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,17 @@ from __future__ import print_function
 from __future__ import with_statement
 
 import os, sys, re, sqlite3, time
-from cStringIO import StringIO
-from xml.etree.cElementTree import ElementTree
-from helpers import gzread, get_encoding, convert_query_to_unicode
-from db import Database as BaseDatabase
-from table import Table, ChildTable, KeyValueTable
+from array import array
+from timeit import default_timer as timer
+from helpers import get_encoding, convert_query_to_unicode, unpack_ids
+from helpers import normalize_query
+from helpers import open_input, iter_elements
+from kanjiwords import check_kanji_word_index
+from db import Database as BaseDatabase, request
+from db import get_build_filename, install_database
+from instrument import QueryProfiler, PhaseTimer, ImportTelemetry
+from instrument import print_progress
+from table import Table, ChildTable, KeyValueTable, iter_chunks
 
 import gettext
 #t = gettext.translation("jblite")
@@ -124,6 +130,16 @@ class Database(BaseDatabase):
     """Top level object for SQLite 3-based KANJIDIC2 database."""
 
     entry_class = Entry
+    schema_version = 1
+    derived_tables = ("kanji_word",)
+    derived_metadata = ("kanji_word",)
+    projections = {
+        # The character row only (literal, grade, freq, jlpt).
+        "headwords": {},
+        # Enough for result lists and Entry.__unicode__.
+        "summary": {u"rmgroup": {u"reading": {}, u"meaning": {}},
+                    u"nanori": {}, u"stroke_count": {}},
+        }
     table_map = {
         u"character": {
             u"codepoint": {},
@@ -141,29 +157,118 @@ class Database(BaseDatabase):
             }
         }
 
-    def __init__(self, filename, init_from_file=None):
-        self.conn = sqlite3.connect(filename)
-        self.conn.row_factory = sqlite3.Row  # keyword accessors for rows
-        self.cursor = self.conn.cursor()
+    def __init__(self, filename, init_from_file=None, profiler=None,
+                 encode=False, langs=None, phase_timer=None,
+                 telemetry=None, resume=False):
+        """Opens (and optionally imports) a database.
+
+        encode: when importing, store type attributes and language
+            codes as integer codes (see Table.encoded_columns).
+            Existing databases are detected automatically.
+        langs: when importing, keep only meanings in these
+            languages (for example ["en"]).  None keeps all.
+        phase_timer: a PhaseTimer to record import phases in.
+        telemetry: an ImportTelemetry to report import progress to.
+        resume: continue an interrupted import of the same file, if
+            the database has one, instead of starting over.
+
+        """
+        self._connect(filename)
         self.tables = self._create_table_objects()
+        if profiler is not None:
+            self.enable_profiling(profiler)
         if init_from_file is not None:
-            raw_data = gzread(init_from_file)
+            self._import_file(init_from_file, encode, langs, phase_timer,
+                              telemetry, resume)
+        else:
+            self._setup_codebook()
+
+        self._load_indices()
+
+    def _import_file(self, fname, encode=False, langs=None,
+                     phase_timer=None, telemetry=None, resume=False):
+        """Imports KANJIDIC2 in phases: populate, index, derived.
 
-            infile = StringIO(raw_data)
-            etree = ElementTree(file=infile)
-            infile.close()
+        The XML is parsed while populating, one character at a time.
+        Progress is committed every checkpoint_interval characters, so
+        an interrupted import can be resumed.
 
-            # Create the core database
-            self._create_new_tables()
-            self._populate_database(etree)
+        """
+        if phase_timer is None:
+            phase_timer = PhaseTimer()
+        if telemetry is None:
+            telemetry = ImportTelemetry()
+        state, resumed = self._begin_import(
+            fname, {"encode": bool(encode), "langs": langs}, resume)
+        stream, raw = open_input(fname)
+        telemetry.start(raw, os.path.getsize(fname))
+
+        # Create the core database
+        try:
+            with phase_timer.phase("populate"):
+                elements = iter_elements(stream, ("header", "character"),
+                                         telemetry)
+                if resumed:
+                    self._setup_codebook()
+                else:
+                    self._setup_codebook(encode)
+                    self._create_new_tables(indexes=False)
+                    self._save_import_state(state)
+                if state["stage"] == "populate":
+                    elements = self._checkpointed(
+                        elements, state,
+                        lambda elem: elem.findtext("literal"), telemetry)
+                    self._populate_with_telemetry(
+                        telemetry, self._populate_database,
+                        elements, langs, telemetry)
+                    state["stage"] = "index"
+                    self._save_import_state(state)
+        finally:
+            stream.close()
+            raw.close()
+
+        start = timer()
+        with phase_timer.phase("index"):
+            if resumed:
+                self._drop_indexes()
+            self._create_indexes()
             self.conn.commit()
 
-            # Create supplemental indices
+        # Create supplemental indices
+        with phase_timer.phase("derived"):
             self._create_index_tables()
-            self.conn.commit()
+            self._finish_import(state)
+        telemetry.add_time("index", timer() - start)
+        telemetry.finish()
 
-    def search(self, query, lang=None, options=None):
-        query = convert_query_to_unicode(query)
+    @request
+    def search(self, query, lang=None, options=None, projection=None):
+        """Finds characters by reading, meaning, nanori or index code.
+
+        projection: which tables of each character to load
+            ("headwords", "summary", "full" or a spec; see
+            BaseDatabase.get_children_map()).
+
+        """
+        char_ids = self.search_ids(query, lang, options)
+        results = self.lookup_many(char_ids, projection)
+        return results
+
+    @request
+    def search_ids(self, query, lang=None, options=None):
+        """Like search(), but returns the sorted character IDs.
+
+        The query is normalized first (see normalize_query()).  If a
+        search cache is enabled, results are served from it (and the
+        verbose output of a cached search is skipped).
+
+        """
+        query = normalize_query(query)
+        return self._cached_search(
+            lambda: self._search_character_ids(query, lang, options),
+            query, lang, "search")
+
+    def _search_character_ids(self, query, lang=None, options=None):
         query = "%%%s%%" % query  # Wrap in wildcards
 
         verbose = (options is not None) and (options.verbose == True)
@@ -229,9 +334,7 @@ class Database(BaseDatabase):
                 char_ids.append(char_id)
 
         char_ids = list(sorted(char_ids))
-
-        results = [self.lookup(char_id) for char_id in char_ids]
-        return results
+        return char_ids
 
     def _search_by_reading(self, query):
         # reading -> rmgroup -> character
@@ -258,6 +361,7 @@ class Database(BaseDatabase):
                 "(SELECT fk FROM rmgroup WHERE id IN "
                 "(SELECT fk FROM meaning WHERE value LIKE ?))", (query,))
         else:
+            lang = self.tables["meaning"].get_code("lang", lang)
             self.cursor.execute(
                 "SELECT id, literal FROM character WHERE id IN "
                 "(SELECT fk FROM rmgroup WHERE id IN "
@@ -275,7 +379,8 @@ class Database(BaseDatabase):
         rows = self.cursor.fetchall()
         return [row[0] for row in rows]
 
-    def search_by_literal(self, literal):
+    @request
+    def search_by_literal(self, literal, projection=None):
         # Not much of a "search", but avoids overlap with BaseDictionary.lookup.
         self.cursor.execute("SELECT id FROM character WHERE literal = ?",
                             (literal,))
@@ -284,10 +389,236 @@ class Database(BaseDatabase):
             return None
         else:
             char_id = rows[0][0]
-            return self.lookup(char_id)
+            return self.lookup(char_id, projection)
+
+    @request
+    def lookup_literals(self, text, projection=None):
+        """Looks up every distinct character of a string.
+
+        All characters are resolved with one indexed query per few
+        hundred characters, and their records are loaded in bulk
+        (only the tables selected by projection).
+
+        Returns a list of Entry objects in order of first appearance
+        in text.  Characters not in the database are skipped.
+
+        """
+        text = convert_query_to_unicode(text)
+        literals = []
+        seen = set()
+        for char in text:
+            if char not in seen:
+                seen.add(char)
+                literals.append(char)
+
+        ids_by_literal = {}
+        for chunk in iter_chunks(literals):
+            self.cursor.execute(
+                "SELECT literal, id FROM character WHERE literal IN (%s)" %
+                ", ".join(["?"] * len(chunk)), chunk)
+            ids_by_literal.update(self.cursor.fetchall())
+        return self.lookup_many([ids_by_literal[literal]
+                                 for literal in literals
+                                 if literal in ids_by_literal], projection)
+
+    @request
+    def stroke_count_search(self, count, allow_miscounts=False,
+                            error_margin=0, error_margin_type="plusminus"):
+        """Finds characters by stroke count.
+
+        allow_miscounts: also match common miscounts of characters.
+        error_margin: number of strokes by which count may be off.
+        error_margin_type: direction of the margin; "plus" (actual
+            count may be higher), "minus" (may be lower) or
+            "plusminus".
+
+        Returns a sorted list of character IDs.  No database queries
+        are made; the in-memory stroke count index is used instead.
+
+        """
+        low, high = get_stroke_count_range(count, error_margin,
+                                           error_margin_type)
+        return self.stroke_index.search(low, high, allow_miscounts)
+
+    @request
+    def stroke_count_filter(self, candidates, count, allow_miscounts=False,
+                            error_margin=0, error_margin_type="plusminus"):
+        """Filters candidates by stroke count.
+
+        candidates: list of character IDs or Entry objects.
+
+        Returns the matching candidates in their original order.  Other
+        arguments are like stroke_count_search().
+
+        """
+        low, high = get_stroke_count_range(count, error_margin,
+                                           error_margin_type)
+        index = self.stroke_index
+        results = []
+        for candidate in candidates:
+            if isinstance(candidate, Entry):
+                char_id = candidate._record.data["id"]
+            else:
+                char_id = candidate
+            if index.matches(char_id, low, high, allow_miscounts):
+                results.append(candidate)
+        return results
+
+    @request
+    def query_code_search(self, query_type, query, allow_misclass=True):
+        """Finds characters by a query code.
+
+        query_type: the KANJIDIC2 qc_type: "skip", "sh_desc",
+            "four_corner" or "deroo".
+        query: the code, exactly as written in KANJIDIC2 (for example
+            "1-4-3" for SKIP).
+        allow_misclass: also match codes listed as common SKIP
+            misclassifications.
+
+        Returns a sorted list of character IDs.
+
+        """
+        query = convert_query_to_unicode(query)
+        query_type = self.tables["query_code"].get_code("type", query_type)
+        sql = ("SELECT DISTINCT fk FROM query_code "
+               "WHERE type = ? AND value = ?")
+        if not allow_misclass:
+            sql += " AND skip_misclass IS NULL"
+        self.cursor.execute(sql + " ORDER BY fk", (query_type, query))
+        return [row[0] for row in self.cursor.fetchall()]
+
+    @request
+    def skip_search(self, pattern, part1=None, part2=None, tolerance=0,
+                    allow_misclass=True):
+        """Finds characters by SKIP code, allowing ranges.
+
+        pattern: SKIP pattern number (1-4).
+        part1, part2: the second and third parts of the code.  Each
+            may be an integer, a (low, high) tuple, or None for any.
+        tolerance: widens part1/part2 by this amount in both
+            directions, for off-by-some stroke counts.
+        allow_misclass: also match codes listed as common
+            misclassifications.
+
+        Example: skip_search(1, (3, 4)) finds left-right characters
+        whose left side has 3 or 4 strokes.
+
+        Returns a sorted list of character IDs.
+
+        """
+        conditions = ["pattern = ?"]
+        args = [pattern]
+        for column, part in (("part1", part1), ("part2", part2)):
+            if part is None:
+                continue
+            if isinstance(part, tuple):
+                low, high = part
+            else:
+                low = high = part
+            conditions.append("%s BETWEEN ? AND ?" % column)
+            args.extend([low - tolerance, high + tolerance])
+        if not allow_misclass:
+            conditions.append("misclass IS NULL")
+        query = ("SELECT DISTINCT character_id FROM skip_lookup "
+                 "WHERE %s ORDER BY character_id" % " AND ".join(conditions))
+        self.cursor.execute(query, args)
+        return [row[0] for row in self.cursor.fetchall()]
+
+    @request
+    def facet_filter(self, grade=None, jlpt=None, radical=None,
+                     strokes=None, limit=20, facets=True):
+        """Filters characters on several facets at once.
+
+        Each facet may be None (no filter), a single value, a list of
+        values, or a (low, high) tuple where either bound may be None.
+        radical is the classical radical number; strokes the accepted
+        stroke count.  For example, JLPT level 2 characters of grade
+        6 or below, using radical 85 and with 8-10 strokes:
+
+            db.facet_filter(jlpt=2, grade=(None, 6), radical=85,
+                            strokes=(8, 10))
+
+        limit: maximum number of IDs to return, or None for all.
+        facets: if True, also count matches per value of each facet.
+
+        Returns a dictionary with the keys "total" (number of
+        matches), "ids" (matching character IDs, most frequent
+        first; characters without frequency data come last) and, if
+        requested, "facets" (facet name -> {value: count}).
+
+        No database queries are made; the in-memory facet index is
+        used instead.
+
+        """
+        criteria = {"grade": grade, "jlpt": jlpt, "radical": radical,
+                    "strokes": strokes}
+        return self.facet_index.query(criteria, limit, facets)
+
+    @request
+    def words_with_kanji(self, literal, jmdict_db=None):
+        """Finds JMdict entries whose kanji elements contain a character.
+
+        Requires the cross index built by jblite.kanjiwords; raises
+        ValueError if it is missing or out of date.  Pass the
+        jmdict.Database the IDs are for as jmdict_db to also check
+        that it has not been re-imported since.
 
-    def lookup(self, id):
-        return BaseDatabase.lookup(self, "character", id)
+        Returns a list of JMdict entry IDs, most common words first.
+
+        """
+        versions = {"kd2": self._get_metadata().get("content_version")}
+        if jmdict_db is not None:
+            versions["jmdict"] = jmdict_db._get_metadata().get(
+                "content_version")
+        check_kanji_word_index(self, versions)
+        literal = convert_query_to_unicode(literal)
+        self.cursor.execute(
+            "SELECT entry_ids FROM kanji_word WHERE literal = ?", (literal,))
+        row = self.cursor.fetchone()
+        return unpack_ids(row[0]) if row is not None else []
+
+    @request
+    def lookup(self, id, projection=None):
+        return BaseDatabase.lookup(self, "character", id, projection)
+
+    @request
+    def lookup_many(self, ids, projection=None):
+        """Looks up several entries at once; see BaseDatabase.lookup_many."""
+        return BaseDatabase.lookup_many(self, "character", ids, projection)
+
+    def _table_exists(self, name):
+        self.cursor.execute("SELECT 1 FROM sqlite_master "
+                            "WHERE type = 'table' AND name = ?", (name,))
+        return self.cursor.fetchone() is not None
+
+    def _load_caches(self):
+        self._load_indices()
+
+    def _load_indices(self):
+        """Builds in-memory indices from the database."""
+        rows = []
+        if self._table_exists("stroke_count"):
+            # Stroke counts are stored in document order; the first
+            # per character is the accepted count, any others are
+            # common miscounts.
+            self.cursor.execute(
+                "SELECT fk, count FROM stroke_count ORDER BY fk, id")
+            rows = self.cursor.fetchall()
+        self.stroke_index = StrokeCountIndex(rows)
+
+        char_rows = []
+        radical_rows = []
+        if self._table_exists("character"):
+            self.cursor.execute(
+                "SELECT id, grade, freq, jlpt FROM character")
+            char_rows = self.cursor.fetchall()
+        if self._table_exists("radical"):
+            self.cursor.execute(
+                "SELECT fk, value FROM radical WHERE type = ?",
+                (self.tables["radical"].get_code("type", "classical"),))
+            radical_rows = self.cursor.fetchall()
+        self.facet_index = FacetIndex(char_rows, radical_rows,
+                                      self.stroke_index)
 
     def _create_table_objects(self):
         """Creates table objects.
@@ -318,28 +649,34 @@ class Database(BaseDatabase):
 
         return table_mappings
 
-    def _create_new_tables(self):
+    def _create_new_tables(self, indexes=True):
         """(Re)creates the database tables."""
         for tbl, tbl_obj in self.tables.iteritems():
             self._drop_table(tbl)
-            tbl_obj.create()
+            tbl_obj.create(indexes)
 
-    def _populate_database(self, etree):
+    def _populate_database(self, elements, langs=None, telemetry=None):
         """Imports XML data into SQLite database.
 
         table_d: table to table_object dictionary
-        etree: ElementTree object for KANJIDIC2
+        elements: iterable of the KANJIDIC2 <header> element followed
+            by the <character> elements
+        langs: languages of meanings to import, or None for all
+        telemetry: ImportTelemetry to count characters in
 
         """
-        # Grab header
-        header = etree.find("header")
-        file_ver = header.find("file_version").text
-        db_ver = header.find("database_version").text
-        date = header.find("date_of_creation").text
-        self.tables['header'].insert(file_ver, db_ver, date)
-
-        # Iterate through characters
-        for character in etree.findall("character"):
+        for character in elements:
+            if character.tag == "header":
+                # Grab header
+                header = character
+                file_ver = header.find("file_version").text
+                db_ver = header.find("database_version").text
+                date = header.find("date_of_creation").text
+                self.tables['header'].insert(file_ver, db_ver, date)
+                continue
+            if telemetry is not None:
+                telemetry.item()
+
             # Character table
             literal = character.find("literal").text
 
@@ -360,14 +697,14 @@ class Database(BaseDatabase):
             codepoint = character.find("codepoint")
             for cp_value in codepoint.findall("cp_value"):
                 value = cp_value.text
-                cp_type = cp_value.get("cp_type")
+                cp_type = table.encode("type", cp_value.get("cp_type"))
                 table.insert(char_id, cp_type, value)
 
             table = self.tables['radical']
             radical = character.find("radical")
             for rad_value in radical.findall("rad_value"):
                 value = rad_value.text
-                rad_type = rad_value.get("rad_type")
+                rad_type = table.encode("type", rad_value.get("rad_type"))
                 table.insert(char_id, rad_type, value)
 
             # Tables generated from <misc> begin here
@@ -379,7 +716,7 @@ class Database(BaseDatabase):
             table = self.tables['variant']
             for variant in misc.findall("variant"):
                 value = variant.text
-                var_type = variant.get("var_type")
+                var_type = table.encode("type", variant.get("var_type"))
                 table.insert(char_id, var_type, value)
 
             table = self.tables['rad_name']
@@ -392,7 +729,7 @@ class Database(BaseDatabase):
             if dic_number is not None:
                 table = self.tables['dic_number']
                 for dic_ref in dic_number.findall("dic_ref"):
-                    dr_type = dic_ref.get("dr_type")
+                    dr_type = table.encode("type", dic_ref.get("dr_type"))
                     m_vol = dic_ref.get("m_vol", None)
                     m_page = dic_ref.get("m_page", None)
                     value = dic_ref.text
@@ -402,7 +739,7 @@ class Database(BaseDatabase):
             if query_code is not None:
                 table = self.tables['query_code']
                 for q_code in query_code.findall("q_code"):
-                    qc_type = q_code.get("qc_type")
+                    qc_type = table.encode("type", q_code.get("qc_type"))
                     skip_misclass = q_code.get("skip_misclass", None)
                     value = q_code.text
                     table.insert(char_id, qc_type, skip_misclass, value)
@@ -414,14 +751,19 @@ class Database(BaseDatabase):
                     group_id = table.insert(char_id)
                     table = self.tables['reading']
                     for reading in rmgroup.findall("reading"):
-                        r_type = reading.get("r_type")
-                        on_type = reading.get("on_type")
-                        r_status = reading.get("r_status")
+                        r_type = table.encode("type", reading.get("r_type"))
+                        on_type = table.encode("on_type",
+                                               reading.get("on_type"))
+                        r_status = table.encode("r_status",
+                                                reading.get("r_status"))
                         value = reading.text
                         table.insert(group_id, r_type, on_type, r_status, value)
                     table = self.tables['meaning']
                     for meaning in rmgroup.findall("meaning"):
                         lang = meaning.get("m_lang", "en")
+                        if langs is not None and lang not in langs:
+                            continue
+                        lang = table.encode("lang", lang)
                         value = meaning.text
                         table.insert(group_id, lang, value)
                 table = self.tables['nanori']
@@ -439,8 +781,12 @@ class Database(BaseDatabase):
         1. Reading search table: kun-yomi to character ID.  Kun-yomi
            is modified for easier searching (no "." or "-" markers).
 
+        2. SKIP search table: SKIP codes split into integer parts, to
+           allow range searches.
+
         """
         self._create_reading_search_table()
+        self._create_skip_search_table()
 
     def _create_reading_search_table(self):
         """Creates "sanitized" reading to character ID search table."""
@@ -450,9 +796,10 @@ class Database(BaseDatabase):
         query = (
             "SELECT r.value, c.id "
             "FROM reading r, rmgroup rg, character c "
-            'WHERE r.type = "ja_kun" AND r.fk = rg.id AND rg.fk = c.id'
+            "WHERE r.type = ? AND r.fk = rg.id AND rg.fk = c.id"
             )
-        self.cursor.execute(query)
+        self.cursor.execute(
+            query, (self.tables["reading"].get_code("type", "ja_kun"),))
         rows = self.cursor.fetchall()
         values, ids = zip(*rows)  # unzip idiom (see zip doc)
 
@@ -464,11 +811,249 @@ class Database(BaseDatabase):
         tbl_name = "kunyomi_lookup"
         self.tables[tbl_name] = tbl = ReadingLookupTable(self.cursor, tbl_name)
         self._drop_table(tbl_name)
-        tbl.create()
+        tbl.create(indexes=False)
 
         # Store all sanitized strings and their keys in the table
         rows = zip(values, ids)
         tbl.insertmany(rows)
+        tbl.create_indexes()
+
+    def _create_skip_search_table(self):
+        """Creates SKIP code search table with parsed code parts."""
+        self.cursor.execute(
+            "SELECT fk, skip_misclass, value FROM query_code "
+            "WHERE type = ?",
+            (self.tables["query_code"].get_code("type", "skip"),))
+        rows = []
+        for char_id, misclass, value in self.cursor.fetchall():
+            parts = parse_skip_code(value)
+            if parts is None:
+                continue
+            rows.append((char_id,) + parts + (misclass,))
+
+        tbl_name = "skip_lookup"
+        self.tables[tbl_name] = tbl = SkipLookupTable(self.cursor, tbl_name)
+        self._drop_table(tbl_name)
+        tbl.create(indexes=False)
+        tbl.insertmany(rows)
+        tbl.create_indexes()
+
+
+def parse_skip_code(code):
+    """Splits a SKIP code like "1-4-3" into a tuple of integers.
+
+    Returns None if the code is malformed.
+
+    """
+    pieces = code.split(u"-")
+    if len(pieces) != 3:
+        return None
+    try:
+        return tuple(int(piece) for piece in pieces)
+    except ValueError:
+        return None
+
+def get_stroke_count_range(count, error_margin=0,
+                           error_margin_type="plusminus"):
+    """Converts a count and error margin into a (low, high) range."""
+    if error_margin_type == "plusminus":
+        return (count - error_margin, count + error_margin)
+    elif error_margin_type == "plus":
+        return (count, count + error_margin)
+    elif error_margin_type == "minus":
+        return (count - error_margin, count)
+    raise ValueError("Unknown error_margin_type: %r" % error_margin_type)
+
+
+######################################################################
+# In-memory indices
+######################################################################
+
+
+class CountArrays(object):
+
+    """Character IDs grouped by an integer count.
+
+    IDs are stored in one array sorted by (count, id).  offsets[c] is
+    the position of the first ID with count c, so all IDs with counts
+    in a range form a single slice.
+
+    """
+
+    def __init__(self, pairs):
+        """pairs: list of (count, character id) tuples."""
+        pairs = sorted(pairs)
+        self.max_count = pairs[-1][0] if len(pairs) > 0 else 0
+        self.ids = array("i", [char_id for count, char_id in pairs])
+        self.offsets = array("i", [0]) * (self.max_count + 2)
+        position = 0
+        for count in xrange(self.max_count + 2):
+            while position < len(pairs) and pairs[position][0] < count:
+                position += 1
+            self.offsets[count] = position
+
+    def range(self, low, high):
+        """Returns the IDs with counts from low to high, inclusive."""
+        low = max(low, 0)
+        high = min(high, self.max_count)
+        if low > high:
+            return self.ids[0:0]
+        return self.ids[self.offsets[low]:self.offsets[high + 1]]
+
+
+class StrokeCountIndex(object):
+
+    """Stroke count to character ID index, including miscounts."""
+
+    def __init__(self, rows):
+        """rows: (character id, count) pairs in stroke_count order."""
+        primary = []
+        miscounts = []
+        self.miscounts_by_id = {}
+        last_id = None
+        for char_id, count in rows:
+            if char_id != last_id:
+                primary.append((count, char_id))
+                last_id = char_id
+            else:
+                miscounts.append((count, char_id))
+                self.miscounts_by_id.setdefault(char_id, []).append(count)
+        self.primary = CountArrays(primary)
+        self.miscounts = CountArrays(miscounts)
+
+        max_id = max([char_id for count, char_id in primary] or [0])
+        self.count_by_id = array("i", [0]) * (max_id + 1)
+        for count, char_id in primary:
+            self.count_by_id[char_id] = count
+
+    def search(self, low, high, allow_miscounts=False):
+        """Returns a sorted list of IDs with counts in [low, high]."""
+        ids = self.primary.range(low, high)
+        if allow_miscounts:
+            ids = ids + self.miscounts.range(low, high)
+        if low == high and not allow_miscounts:
+            return ids.tolist()  # Single slice; already sorted.
+        return sorted(set(ids))
+
+    def matches(self, char_id, low, high, allow_miscounts=False):
+        """Checks whether a character's stroke count is in [low, high]."""
+        if 0 < char_id < len(self.count_by_id):
+            if low <= self.count_by_id[char_id] <= high:
+                return True
+        if allow_miscounts:
+            for count in self.miscounts_by_id.get(char_id, ()):
+                if low <= count <= high:
+                    return True
+        return False
+
+
+def _positions_to_mask(positions, size):
+    """Builds an integer bitmask with the given bit positions set."""
+    bits = bytearray((size + 7) // 8)
+    for position in positions:
+        bits[position >> 3] |= 1 << (position & 7)
+    if len(bits) == 0:
+        return 0
+    bits.reverse()  # Most significant byte first, for hex conversion.
+    return int(str(bits).encode("hex"), 16)
+
+def _popcount(mask):
+    return bin(mask).count("1")
+
+
+class FacetIndex(object):
+
+    """Columnar facet index over all characters.
+
+    Every character is assigned a bit position, in order of
+    frequency.  For each value of each facet, an integer bitmask of
+    the characters having that value is precomputed.  A conjunctive
+    query is then an AND of masks, facet counts are popcounts, and
+    the top-k most frequent matches are simply the lowest set bits.
+
+    """
+
+    facet_names = ("grade", "jlpt", "radical", "strokes")
+
+    def __init__(self, char_rows, radical_rows, stroke_index):
+        """char_rows: (id, grade, freq, jlpt) rows from character.
+        radical_rows: (character id, classical radical) pairs.
+        stroke_index: a StrokeCountIndex.
+
+        """
+        ordered = sorted(char_rows,
+                         key=lambda row: (row[2] is None, row[2], row[0]))
+        size = len(ordered)
+        self.ids = array("i", [row[0] for row in ordered])
+        self.all_mask = (1 << size) - 1
+        position_by_id = dict((row[0], i) for i, row in enumerate(ordered))
+
+        columns = {"grade": {}, "jlpt": {}, "radical": {}, "strokes": {}}
+        for position, (char_id, grade, freq, jlpt) in enumerate(ordered):
+            if grade is not None:
+                columns["grade"].setdefault(grade, []).append(position)
+            if jlpt is not None:
+                columns["jlpt"].setdefault(jlpt, []).append(position)
+            if 0 < char_id < len(stroke_index.count_by_id):
+                count = stroke_index.count_by_id[char_id]
+                if count > 0:
+                    columns["strokes"].setdefault(count, []).append(position)
+        for char_id, value in radical_rows:
+            position = position_by_id.get(char_id)
+            if position is not None:
+                columns["radical"].setdefault(int(value), []).append(position)
+
+        self.masks = {}
+        for name, values in columns.iteritems():
+            self.masks[name] = dict(
+                (value, _positions_to_mask(positions, size))
+                for value, positions in values.iteritems())
+
+    def mask_for(self, name, spec):
+        """Returns the mask of characters matching one facet spec."""
+        masks = self.masks[name]
+        if isinstance(spec, tuple):
+            low, high = spec
+            values = [value for value in masks
+                      if (low is None or value >= low)
+                      and (high is None or value <= high)]
+        elif isinstance(spec, (list, set, frozenset)):
+            values = spec
+        else:
+            values = [spec]
+        mask = 0
+        for value in values:
+            mask |= masks.get(value, 0)
+        return mask
+
+    def counts(self, name, mask):
+        """Counts matches in mask for each value of a facet."""
+        result = {}
+        for value, value_mask in self.masks[name].iteritems():
+            count = _popcount(value_mask & mask)
+            if count > 0:
+                result[value] = count
+        return result
+
+    def query(self, criteria, limit=None, facets=True):
+        """Runs a conjunctive facet query.  See Database.facet_filter."""
+        mask = self.all_mask
+        for name, spec in criteria.iteritems():
+            if spec is not None:
+                mask &= self.mask_for(name, spec)
+
+        ids = []
+        remaining = mask
+        while remaining and (limit is None or len(ids) < limit):
+            lowest = remaining & -remaining
+            ids.append(self.ids[lowest.bit_length() - 1])
+            remaining ^= lowest
+
+        result = {"total": _popcount(mask), "ids": ids}
+        if facets:
+            result["facets"] = dict((name, self.counts(name, mask))
+                                    for name in self.facet_names)
+        return result
 
 
 ######################################################################
@@ -499,6 +1084,7 @@ class TypeValueTable(ChildTable):
                     "(id INTEGER PRIMARY KEY, fk INTEGER, "
                     "type TEXT, value TEXT)")
     insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?)"
+    encoded_columns = {"type": None}
     index_queries = [
         "CREATE INDEX %s_fk ON %s (fk)",
         ]
@@ -518,6 +1104,7 @@ class DicNumberTable(ChildTable):
                     "(id INTEGER PRIMARY KEY, fk INTEGER, "
                     "type TEXT, m_vol TEXT, m_page TEXT, value TEXT)")
     insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?, ?, ?)"
+    encoded_columns = {"type": None}
     index_queries = [
         "CREATE INDEX %s_fk ON %s (fk)",
         ]
@@ -528,8 +1115,10 @@ class QueryCodeTable(ChildTable):
                     "(id INTEGER PRIMARY KEY, fk INTEGER, "
                     "type TEXT, skip_misclass TEXT, value TEXT)")
     insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?, ?)"
+    encoded_columns = {"type": None}
     index_queries = [
         "CREATE INDEX %s_fk ON %s (fk)",
+        "CREATE INDEX %s_type_value ON %s (type, value)",
         ]
 
 
@@ -545,6 +1134,7 @@ class ReadingTable(ChildTable):
                     "(id INTEGER PRIMARY KEY, fk INTEGER, "
                     "type TEXT, on_type TEXT, r_status TEXT, value TEXT)")
     insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?, ?, ?)"
+    encoded_columns = {"type": None, "on_type": None, "r_status": None}
     index_queries = [
         "CREATE INDEX %s_fk ON %s (fk)",
         "CREATE INDEX %s_value ON %s (value)",
@@ -556,9 +1146,10 @@ class MeaningTable(ChildTable):
                     "(id INTEGER PRIMARY KEY, fk INTEGER, "
                     "lang TEXT, value TEXT)")
     insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?)"
+    encoded_columns = {"lang": "lang"}
     index_queries = [
         "CREATE INDEX %s_fk ON %s (fk)",
-        "CREATE INDEX %s_lang_value ON %s (lang, value)",
+        "CREATE INDEX %s_lang_value ON %s (lang, value, fk)",
         ]
 
 
@@ -579,6 +1170,19 @@ class ReadingLookupTable(Table):
         ]
 
 
+class SkipLookupTable(Table):
+    """Maps parsed SKIP codes to character IDs."""
+    # misclass is the skip_misclass attribute, or NULL for the proper code.
+    create_query = ("CREATE TABLE %s "
+                    "(id INTEGER PRIMARY KEY, character_id INTEGER, "
+                    "pattern INTEGER, part1 INTEGER, part2 INTEGER, "
+                    "misclass TEXT)")
+    insert_query = "INSERT INTO %s VALUES (NULL, ?, ?, ?, ?, ?)"
+    index_queries = [
+        "CREATE INDEX %s_code ON %s (pattern, part1, part2, character_id)",
+        ]
+
+
 
 ######################################################################
 
@@ -592,8 +1196,31 @@ def parse_args():
                   help=_("Search for kanji by readings or meanings"))
     op.add_option("-l", "--lookup", action="store_true",
                   help=_("Look up exact character"))
+    op.add_option("-E", "--encode", action="store_true",
+                  help=_("When initializing, store repetitive values "
+                         "as integer codes (smaller database)."))
+    op.add_option("--keep-lang", action="append", dest="langs",
+                  metavar="LANG",
+                  help=_("When initializing, import only meanings in this "
+                         "language (may be repeated)."))
+    op.add_option("-S", "--swap", action="store_true",
+                  help=_("When initializing, build into a temporary file "
+                         "and replace the database only if the new one "
+                         "checks out."))
+    op.add_option("-R", "--resume", action="store_true",
+                  help=_("When initializing, continue an interrupted "
+                         "import of the same file if there is one."))
+    op.add_option("--progress", action="store_true",
+                  help=_("When initializing, show import progress."))
+    op.add_option("--telemetry", metavar="FILE",
+                  help=_("When initializing, write import statistics "
+                         "to FILE as JSON."))
     op.add_option("-L", "--lang",
                   help=_("Specify preferred language for searching."))
+    op.add_option("-C", "--cache", action="store_true",
+                  help=_("Cache search results in <db_filename>.cache."))
+    op.add_option("-P", "--profile", action="store_true",
+                  help=_("Print SQL statement (and cache) statistics when done."))
     op.add_option("-v", "--verbose", action="store_true",
                   help=_("Verbose mode (print debug strings)"))
     options, args = op.parse_args()
@@ -610,11 +1237,40 @@ def main():
     options, args = parse_args()
     db_fname = args[0]
 
+    profiler = QueryProfiler() if options.profile else None
     if options.init_fname is not None:
-        db = Database(db_fname, init_from_file=options.init_fname)
+        telemetry = ImportTelemetry(
+            print_progress if options.progress else None)
+        build_fname = get_build_filename(db_fname) if options.swap \
+            else db_fname
+        db = Database(build_fname, init_from_file=options.init_fname,
+                      profiler=profiler, encode=options.encode,
+                      langs=options.langs, telemetry=telemetry,
+                      resume=options.resume)
+        if options.telemetry is not None:
+            telemetry.write_json(options.telemetry)
+        if options.swap:
+            db.conn.close()
+            try:
+                install_database(Database, build_fname, db_fname)
+            except ValueError as e:
+                print(_("Not replacing %s: %s") % (db_fname, e),
+                      file=sys.stderr)
+                exit(1)
+            db = Database(db_fname, profiler=profiler)
     else:
-        db = Database(db_fname)
+        db = Database(db_fname, profiler=profiler)
+    if options.cache:
+        db.enable_cache()
+
+    run_query(db, options, args)
 
+    if profiler is not None:
+        print(profiler.format_summary(), file=sys.stderr)
+        if db.search_cache is not None:
+            print(db.search_cache.format_stats(), file=sys.stderr)
+
+def run_query(db, options, args):
     results = []
     if len(args) <= 1:
         # No search was requested; we can exit here.
@@ -634,11 +1290,7 @@ def main():
         # Do lookup
         encoding = get_encoding()
         lookup_query = args[1].decode(encoding)
-        results = []
-        for character in lookup_query:
-            result = db.search_by_literal(character)
-            if result is not None:
-                results.append(result)
+        results = db.lookup_literals(lookup_query)
     else:
         # No lookup
         print(_("For searches or lookups, the --search or --lookup flag is "
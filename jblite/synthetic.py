@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""Synthetic JMdict and KANJIDIC2 data.
+
+The real dictionary files are large and cannot be shipped with the
+library, so this module generates deterministic look-alike XML of any
+size.  The output follows the shape of the real files closely enough
+to drive both importers: an internal DTD with ENTITY definitions,
+multiple k_ele/r_ele/sense blocks per entry, glosses in several
+languages, priority markers, rmgroups, query codes and so on.
+
+The same seed and size always produce byte-identical output.
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import gzip, random
+
+
+# First CJK unified ideograph; synthetic kanji are allocated upwards
+# from here so JMdict keb values and KANJIDIC2 literals overlap.
+CJK_BASE = 0x4E00
+
+HIRAGANA = (u"あいうえおかきくけこさしすせそたちつてとなにぬねの"
+            u"はひふへほまみむめもやゆよらりるれろわをん"
+            u"がぎぐげござじずぜぞだぢづでどばびぶべぼぱぴぷぺぽ")
+KATAKANA = u"".join(unichr(ord(c) + 0x60) for c in HIRAGANA)
+
+LATIN_SYLLABLES = ["ka", "to", "ri", "mo", "sen", "da", "ple", "ver",
+                   "an", "ist", "or", "ul", "bre", "in", "ex", "com",
+                   "mar", "ti", "lo", "ne", "su", "ga", "pe", "ro"]
+
+# (entity name, expansion) pairs, as found in the JMdict DTD.
+JMDICT_ENTITIES = [
+    ("n", "noun (common) (futsuumeishi)"),
+    ("v1", "Ichidan verb"),
+    ("v5r", "Godan verb with `ru' ending"),
+    ("vs", "noun or participle which takes the aux. verb suru"),
+    ("adj-i", "adjective (keiyoushi)"),
+    ("adj-na", "adjectival nouns or quasi-adjectives (keiyodoshi)"),
+    ("adv", "adverb (fukushi)"),
+    ("exp", "expressions (phrases, clauses, etc.)"),
+    ("uk", "word usually written using kana alone"),
+    ("col", "colloquialism"),
+    ("arch", "archaism"),
+    ("comp", "computer terminology"),
+    ("med", "medicine, etc. term"),
+    ("ksb", "Kansai-ben"),
+    ("ktb", "Kantou-ben"),
+    ("iK", "word containing irregular kanji usage"),
+    ("ateji", "ateji (phonetic) reading"),
+    ("ik", "word containing irregular kana usage"),
+    ("ok", "out-dated or obsolete kana usage"),
+    ]
+POS_ENTITIES = ["n", "v1", "v5r", "vs", "adj-i", "adj-na", "adv", "exp"]
+MISC_ENTITIES = ["uk", "col", "arch"]
+FIELD_ENTITIES = ["comp", "med"]
+DIAL_ENTITIES = ["ksb", "ktb"]
+KE_INF_ENTITIES = ["iK", "ateji"]
+RE_INF_ENTITIES = ["ik", "ok"]
+
+PRI_MARKERS = ["news1", "news2", "ichi1", "ichi2", "spec1", "spec2",
+               "gai1", "gai2"]
+GLOSS_LANGS = ["eng", "ger", "fre", "rus"]
+MEANING_LANGS = ["fr", "es", "pt"]
+
+
+def _word(rng, min_syl=1, max_syl=3):
+    return "".join(rng.choice(LATIN_SYLLABLES)
+                   for i in xrange(rng.randint(min_syl, max_syl)))
+
+def _kana(rng, alphabet, min_len=1, max_len=4):
+    return u"".join(rng.choice(alphabet)
+                    for i in xrange(rng.randint(min_len, max_len)))
+
+def _kanji(rng, char_count, min_len=1, max_len=3):
+    return u"".join(unichr(CJK_BASE + rng.randrange(char_count))
+                    for i in xrange(rng.randint(min_len, max_len)))
+
+
+######################################################################
+# JMdict
+######################################################################
+
+
+def generate_jmdict(entry_count, seed=0, char_count=2000):
+    """Generates a JMdict-shaped XML document.
+
+    entry_count: number of <entry> elements.
+    seed: random seed; equal seeds give identical output.
+    char_count: size of the kanji pool used for keb values.  Use the
+        same value as the KANJIDIC2 character count to make the two
+        files overlap.
+
+    Returns the document as a UTF-8 encoded byte string.
+
+    """
+    rng = random.Random(seed)
+    parts = [u'<?xml version="1.0" encoding="UTF-8"?>\n',
+             u"<!DOCTYPE JMdict [\n",
+             u"<!ELEMENT JMdict (entry*)>\n"]
+    for name, expansion in JMDICT_ENTITIES:
+        parts.append(u'<!ENTITY %s "%s">\n' % (name, expansion))
+    parts.append(u"]>\n<JMdict>\n")
+
+    headwords = []  # (keb or None, reb) of earlier entries, for xrefs
+    for index in xrange(entry_count):
+        parts.append(_jmdict_entry(rng, 1000000 + index, char_count,
+                                   headwords))
+    parts.append(u"</JMdict>\n")
+    return u"".join(parts).encode("utf-8")
+
+
+def _jmdict_entry(rng, ent_seq, char_count, headwords):
+    parts = [u"<entry>\n<ent_seq>%d</ent_seq>\n" % ent_seq]
+
+    # Roughly a fifth of entries are kana-only.
+    kebs = []
+    if rng.random() < 0.8:
+        for i in xrange(rng.choice([1, 1, 1, 2, 3])):
+            keb = _kanji(rng, char_count)
+            if keb in kebs:
+                continue
+            kebs.append(keb)
+            parts.append(u"<k_ele>\n<keb>%s</keb>\n" % keb)
+            if rng.random() < 0.05:
+                parts.append(u"<ke_inf>&%s;</ke_inf>\n"
+                             % rng.choice(KE_INF_ENTITIES))
+            if rng.random() < 0.3:
+                for pri in rng.sample(PRI_MARKERS, rng.randint(1, 2)):
+                    parts.append(u"<ke_pri>%s</ke_pri>\n" % pri)
+                parts.append(u"<ke_pri>nf%02d</ke_pri>\n"
+                             % rng.randint(1, 48))
+            parts.append(u"</k_ele>\n")
+
+    rebs = []
+    alphabet = HIRAGANA if rng.random() < 0.85 else KATAKANA
+    for i in xrange(rng.choice([1, 1, 2])):
+        reb = _kana(rng, alphabet, 2, 5)
+        if reb in rebs:
+            continue
+        rebs.append(reb)
+        parts.append(u"<r_ele>\n<reb>%s</reb>\n" % reb)
+        if len(kebs) == 0 and rng.random() < 0.1:
+            parts.append(u"<re_nokanji/>\n")
+        if len(kebs) > 1 and rng.random() < 0.5:
+            parts.append(u"<re_restr>%s</re_restr>\n" % kebs[0])
+        if rng.random() < 0.05:
+            parts.append(u"<re_inf>&%s;</re_inf>\n"
+                         % rng.choice(RE_INF_ENTITIES))
+        if rng.random() < 0.3:
+            for pri in rng.sample(PRI_MARKERS, rng.randint(1, 2)):
+                parts.append(u"<re_pri>%s</re_pri>\n" % pri)
+        parts.append(u"</r_ele>\n")
+
+    if rng.random() < 0.1:
+        parts.append(u"<info>\n")
+        if rng.random() < 0.3:
+            parts.append(u"<links>\n<link_tag>%s</link_tag>\n"
+                         u"<link_desc>%s</link_desc>\n"
+                         u"<link_uri>http://example.com/%d</link_uri>\n"
+                         u"</links>\n"
+                         % (_word(rng), _word(rng), ent_seq))
+        parts.append(u"<audit>\n<upd_date>2010-%02d-%02d</upd_date>\n"
+                     u"<upd_detl>Entry amended</upd_detl>\n</audit>\n"
+                     % (rng.randint(1, 12), rng.randint(1, 28)))
+        parts.append(u"</info>\n")
+
+    for i in xrange(rng.choice([1, 1, 2, 2, 3, 4])):
+        parts.append(u"<sense>\n")
+        if len(kebs) > 1 and rng.random() < 0.2:
+            parts.append(u"<stagk>%s</stagk>\n" % kebs[-1])
+        if len(rebs) > 1 and rng.random() < 0.2:
+            parts.append(u"<stagr>%s</stagr>\n" % rebs[-1])
+        for pos in rng.sample(POS_ENTITIES, rng.randint(1, 2)):
+            parts.append(u"<pos>&%s;</pos>\n" % pos)
+        if len(headwords) > 0 and rng.random() < 0.1:
+            keb, reb = rng.choice(headwords)
+            target = reb if keb is None else u"%s・%s" % (keb, reb)
+            parts.append(u"<xref>%s</xref>\n" % target)
+        if len(headwords) > 0 and rng.random() < 0.03:
+            keb, reb = rng.choice(headwords)
+            parts.append(u"<ant>%s</ant>\n" % (keb or reb))
+        if rng.random() < 0.05:
+            parts.append(u"<field>&%s;</field>\n" % rng.choice(FIELD_ENTITIES))
+        if rng.random() < 0.1:
+            parts.append(u"<misc>&%s;</misc>\n" % rng.choice(MISC_ENTITIES))
+        if rng.random() < 0.03:
+            parts.append(u"<s_inf>%s</s_inf>\n" % _word(rng))
+        if rng.random() < 0.05:
+            attrs = u' xml:lang="%s"' % rng.choice(["ger", "fre", "dut"])
+            if rng.random() < 0.3:
+                attrs += u' ls_type="part"'
+            if rng.random() < 0.3:
+                attrs += u' ls_wasei="y"'
+            parts.append(u"<lsource%s>%s</lsource>\n" % (attrs, _word(rng)))
+        if rng.random() < 0.03:
+            parts.append(u"<dial>&%s;</dial>\n" % rng.choice(DIAL_ENTITIES))
+        for lang in GLOSS_LANGS:
+            if lang != "eng" and rng.random() < 0.6:
+                continue
+            lang_attr = u"" if lang == "eng" else u' xml:lang="%s"' % lang
+            for j in xrange(rng.randint(1, 3)):
+                parts.append(u"<gloss%s>%s</gloss>\n"
+                             % (lang_attr, u" ".join(
+                                 _word(rng) for k in xrange(
+                                     rng.randint(1, 3)))))
+        parts.append(u"</sense>\n")
+
+    parts.append(u"</entry>\n")
+    headwords.append((kebs[0] if len(kebs) > 0 else None, rebs[0]))
+    return u"".join(parts)
+
+
+######################################################################
+# KANJIDIC2
+######################################################################
+
+
+def generate_kanjidic2(char_count, seed=0):
+    """Generates a KANJIDIC2-shaped XML document.
+
+    char_count: number of <character> elements.  Literals are
+        allocated consecutively from U+4E00.
+    seed: random seed; equal seeds give identical output.
+
+    Returns the document as a UTF-8 encoded byte string.
+
+    """
+    rng = random.Random(seed)
+    parts = [u'<?xml version="1.0" encoding="UTF-8"?>\n',
+             u"<!DOCTYPE kanjidic2 [\n",
+             u"<!ELEMENT kanjidic2 (header,character*)>\n",
+             u"]>\n<kanjidic2>\n",
+             u"<header>\n<file_version>4</file_version>\n"
+             u"<database_version>synthetic-%d-%d</database_version>\n"
+             u"<date_of_creation>2010-01-01</date_of_creation>\n"
+             u"</header>\n" % (seed, char_count)]
+    for index in xrange(char_count):
+        parts.append(_kanjidic2_character(rng, index))
+    parts.append(u"</kanjidic2>\n")
+    return u"".join(parts).encode("utf-8")
+
+
+def _kanjidic2_character(rng, index):
+    code = CJK_BASE + index
+    parts = [u"<character>\n<literal>%s</literal>\n" % unichr(code),
+             u"<codepoint>\n"
+             u'<cp_value cp_type="ucs">%x</cp_value>\n'
+             u'<cp_value cp_type="jis208">%d-%d</cp_value>\n'
+             u"</codepoint>\n"
+             % (code, 16 + index // 94, 1 + index % 94)]
+
+    parts.append(u"<radical>\n")
+    parts.append(u'<rad_value rad_type="classical">%d</rad_value>\n'
+                 % rng.randint(1, 214))
+    if rng.random() < 0.1:
+        parts.append(u'<rad_value rad_type="nelson_c">%d</rad_value>\n'
+                     % rng.randint(1, 214))
+    parts.append(u"</radical>\n")
+
+    parts.append(u"<misc>\n")
+    if rng.random() < 0.25:
+        parts.append(u"<grade>%d</grade>\n" % rng.choice([1, 2, 3, 4, 5,
+                                                          6, 8, 9, 10]))
+    strokes = rng.randint(1, 24)
+    parts.append(u"<stroke_count>%d</stroke_count>\n" % strokes)
+    if rng.random() < 0.05:
+        parts.append(u"<stroke_count>%d</stroke_count>\n"
+                     % max(1, strokes + rng.choice([-1, 1])))
+    if rng.random() < 0.05:
+        parts.append(u'<variant var_type="jis208">%d-%d</variant>\n'
+                     % (rng.randint(16, 84), rng.randint(1, 94)))
+    if rng.random() < 0.2:
+        parts.append(u"<freq>%d</freq>\n" % rng.randint(1, 2500))
+    if rng.random() < 0.01:
+        parts.append(u"<rad_name>%s</rad_name>\n" % _kana(rng, HIRAGANA))
+    if rng.random() < 0.2:
+        parts.append(u"<jlpt>%d</jlpt>\n" % rng.randint(1, 4))
+    parts.append(u"</misc>\n")
+
+    parts.append(u"<dic_number>\n")
+    parts.append(u'<dic_ref dr_type="nelson_c">%d</dic_ref>\n'
+                 % rng.randint(1, 5000))
+    if rng.random() < 0.5:
+        parts.append(u'<dic_ref dr_type="moro" m_vol="%d" m_page="%04d">'
+                     u"%d</dic_ref>\n"
+                     % (rng.randint(1, 13), rng.randint(1, 999),
+                        rng.randint(1, 50000)))
+    parts.append(u"</dic_number>\n")
+
+    parts.append(u"<query_code>\n")
+    parts.append(u'<q_code qc_type="skip">%d-%d-%d</q_code>\n'
+                 % (rng.randint(1, 4), rng.randint(1, 12),
+                    rng.randint(1, 12)))
+    if rng.random() < 0.05:
+        parts.append(u'<q_code qc_type="skip" skip_misclass="posn">'
+                     u"%d-%d-%d</q_code>\n"
+                     % (rng.randint(1, 4), rng.randint(1, 12),
+                        rng.randint(1, 12)))
+    parts.append(u'<q_code qc_type="sh_desc">%d%s%d.%d</q_code>\n'
+                 % (rng.randint(1, 12), rng.choice(u"abcdefghijklmnopqrs"),
+                    rng.randint(0, 12), rng.randint(1, 9)))
+    parts.append(u'<q_code qc_type="four_corner">%04d.%d</q_code>\n'
+                 % (rng.randint(0, 9999), rng.randint(0, 9)))
+    if rng.random() < 0.7:
+        parts.append(u'<q_code qc_type="deroo">%d</q_code>\n'
+                     % rng.randint(1000, 3999))
+    parts.append(u"</query_code>\n")
+
+    if rng.random() < 0.95:
+        parts.append(u"<reading_meaning>\n<rmgroup>\n")
+        parts.append(u'<reading r_type="pinyin">%s%d</reading>\n'
+                     % (_word(rng, 1, 1), rng.randint(1, 4)))
+        for i in xrange(rng.randint(1, 2)):
+            parts.append(u'<reading r_type="ja_on">%s</reading>\n'
+                         % _kana(rng, KATAKANA, 1, 3))
+        for i in xrange(rng.randint(0, 3)):
+            kun = _kana(rng, HIRAGANA, 1, 3)
+            if rng.random() < 0.5:
+                kun += u"." + _kana(rng, HIRAGANA, 1, 2)
+            if rng.random() < 0.1:
+                kun = u"-" + kun
+            parts.append(u'<reading r_type="ja_kun">%s</reading>\n' % kun)
+        for i in xrange(rng.randint(1, 3)):
+            parts.append(u"<meaning>%s</meaning>\n" % _word(rng))
+        for lang in MEANING_LANGS:
+            if rng.random() < 0.5:
+                parts.append(u'<meaning m_lang="%s">%s</meaning>\n'
+                             % (lang, _word(rng)))
+        parts.append(u"</rmgroup>\n")
+        if rng.random() < 0.2:
+            parts.append(u"<nanori>%s</nanori>\n" % _kana(rng, HIRAGANA))
+        parts.append(u"</reading_meaning>\n")
+
+    parts.append(u"</character>\n")
+    return u"".join(parts)
+
+
+######################################################################
+
+
+def write_file(fname, data, compress=False):
+    """Writes generated data to disk, gzipped if compress is True."""
+    if compress:
+        outfile = gzip.open(fname, "wb")
+    else:
+        outfile = open(fname, "wb")
+    try:
+        outfile.write(data)
+    finally:
+        outfile.close()
@@ -1,8 +1,20 @@
 # -*- coding: utf-8 -*-
 
+import re, json
 from pprint import pformat
 
 
+# Maximum number of parameters bound in one IN (...) list; SQLite's
+# default limit is 999.
+MAX_IN_ARGS = 500
+
+
+def iter_chunks(values, size=MAX_IN_ARGS):
+    """Splits a list into lists of at most size items."""
+    for start in xrange(0, len(values), size):
+        yield values[start:start + size]
+
+
 class Record(object):
 
     """Represents a row in a table, plus all data it is a 'parent' of.
@@ -75,21 +87,40 @@ class Table(object):
     where %s is a placeholder for the table name (note that it's used
     twice), and XXX/YYY are replaced as desired.
 
+    encoded_columns maps TEXT columns holding a small set of repeated
+    values to a code domain (None for a domain private to the table).
+    When a Codebook is attached (see Database._setup_codebook()), such
+    columns are created as INTEGER and hold codes instead: importers
+    pass values through encode(), queries compare against
+    get_code(), and the lookup methods decode rows transparently.
+
     """
 
     create_query = None
     insert_query = None
     index_queries = []
+    encoded_columns = {}
 
-    def __init__(self, cursor, name):
+    def __init__(self, cursor, name, codebook=None):
         self.cursor = cursor
         self.name = name
+        self.codebook = codebook
+
+    def create(self, indexes=True):
+        """Creates table, plus indices if supplied in class definition.
+
+        With indexes=False, indices are left for a later call to
+        create_indexes(); bulk inserts are faster without them.
 
-    def create(self):
-        """Creates table, plus indices if supplied in class definition."""
+        """
         query = self._get_create_query()
         #print(query)
         self.cursor.execute(query)
+        if indexes:
+            self.create_indexes()
+
+    def create_indexes(self):
+        """Creates the indices from the class definition."""
         index_queries = self._get_index_queries()
         for query in index_queries:
             #print(query)
@@ -132,7 +163,12 @@ class Table(object):
         if self.name is None:
             raise ValueError(
                 "name must be specified in class definition")
-        return self.create_query % self.name
+        query = self.create_query % self.name
+        if self.is_encoded():
+            for column in self.encoded_columns:
+                query = re.sub(r"\b%s TEXT\b" % column,
+                               "%s INTEGER" % column, query)
+        return query
 
     def _get_insert_query(self):
         if self.name is None:
@@ -154,6 +190,60 @@ class Table(object):
                        for q in self.index_queries]
             return queries
 
+    def is_encoded(self):
+        """Checks whether this table stores codes in encoded_columns."""
+        return self.codebook is not None and len(self.encoded_columns) > 0
+
+    def _get_domain(self, column):
+        domain = self.encoded_columns[column]
+        if domain is None:
+            domain = "%s.%s" % (self.name, column)
+        return domain
+
+    def encode(self, column, value):
+        """Converts a value to be inserted into column.
+
+        Returns the value's code (allocating a new one if needed) if
+        the column is encoded, or the value itself otherwise.
+
+        """
+        if not self.is_encoded() or column not in self.encoded_columns:
+            return value
+        return self.codebook.encode(self._get_domain(column), value)
+
+    def get_code(self, column, value):
+        """Converts a value to compare column against in a query.
+
+        Like encode(), but never allocates codes: values which do not
+        occur in the column map to None, which matches nothing.
+
+        """
+        if not self.is_encoded() or column not in self.encoded_columns:
+            return value
+        return self.codebook.get_code(self._get_domain(column), value)
+
+    def decode_row(self, names, row):
+        """Decodes the encoded columns of a row.
+
+        names: column names, in the order of the values in row.
+
+        Returns a list of values.
+
+        """
+        values = list(row)
+        if self.is_encoded():
+            for position, name in enumerate(names):
+                if name in self.encoded_columns:
+                    values[position] = self.codebook.decode(values[position])
+        return values
+
+    def _decode_rows(self, rows):
+        if not self.is_encoded() or len(rows) == 0:
+            return rows
+        names = rows[0].keys()
+        return [dict(zip(names, self.decode_row(names, row)))
+                for row in rows]
+
     def lookup_by_id(self, id):
         """Retrieves the row matching the id.
 
@@ -163,8 +253,26 @@ class Table(object):
         query = "SELECT * FROM %s WHERE id = ?" % self.name
         self.cursor.execute(query, (id,))
         row = self.cursor.fetchone()
+        if row is not None and self.is_encoded():
+            row = self._decode_rows([row])[0]
         return row
 
+    def lookup_by_ids(self, ids):
+        """Retrieves the rows matching a list of ids.
+
+        Returns a dictionary of id to row; ids without a row are
+        left out.
+
+        """
+        results = {}
+        for chunk in iter_chunks(list(ids)):
+            query = "SELECT * FROM %s WHERE id IN (%s)" % (
+                self.name, ", ".join(["?"] * len(chunk)))
+            self.cursor.execute(query, chunk)
+            for row in self._decode_rows(self.cursor.fetchall()):
+                results[row["id"]] = row
+        return results
+
 
 class ChildTable(Table):
 
@@ -180,7 +288,23 @@ class ChildTable(Table):
         query = "SELECT * FROM %s WHERE fk = ?" % self.name
         self.cursor.execute(query, (fk,))
         rows = self.cursor.fetchall()
-        return rows
+        return self._decode_rows(rows)
+
+    def lookup_by_fks(self, fks):
+        """Retrieves all rows whose foreign key is in a list.
+
+        Returns a dictionary of foreign key to list of rows, in the
+        same order as lookup_by_fk().  Keys without rows are left out.
+
+        """
+        results = {}
+        for chunk in iter_chunks(list(fks)):
+            query = "SELECT * FROM %s WHERE fk IN (%s) ORDER BY fk, id" % (
+                self.name, ", ".join(["?"] * len(chunk)))
+            self.cursor.execute(query, chunk)
+            for row in self._decode_rows(self.cursor.fetchall()):
+                results.setdefault(row["fk"], []).append(row)
+        return results
 
 
 class KeyValueTable(ChildTable):
@@ -191,3 +315,90 @@ class KeyValueTable(ChildTable):
     index_queries = [
         "CREATE INDEX %s_fk ON %s (fk)",
         ]
+
+
+class CodeTable(Table):
+    """Lookup table for dictionary-encoded columns.
+
+    Each distinct (domain, value) pair is stored once; encoded
+    columns refer to it by id.
+
+    """
+    create_query = ("CREATE TABLE %s "
+                    "(id INTEGER PRIMARY KEY, domain TEXT, value TEXT)")
+    insert_query = "INSERT INTO %s VALUES (NULL, ?, ?)"
+    index_queries = [
+        "CREATE UNIQUE INDEX %s_domain_value ON %s (domain, value)",
+        ]
+
+
+class MetadataTable(Table):
+    """Database-level settings and state, as JSON values by key."""
+    create_query = ("CREATE TABLE IF NOT EXISTS %s "
+                    "(key TEXT PRIMARY KEY, value TEXT)")
+    insert_query = "INSERT OR REPLACE INTO %s VALUES (?, ?)"
+
+    def exists(self):
+        self.cursor.execute("SELECT 1 FROM sqlite_master "
+                            "WHERE type = 'table' AND name = ?", (self.name,))
+        return self.cursor.fetchone() is not None
+
+    def get(self, key, default=None):
+        """Returns the value stored under key, or default."""
+        if not self.exists():
+            return default
+        self.cursor.execute("SELECT value FROM %s WHERE key = ?" % self.name,
+                            (key,))
+        row = self.cursor.fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+    def set(self, key, value):
+        self.insert(key, json.dumps(value, sort_keys=True))
+
+    def delete(self, key):
+        if self.exists():
+            self.cursor.execute("DELETE FROM %s WHERE key = ?" % self.name,
+                                (key,))
+
+
+class Codebook(object):
+
+    """In-memory copy of a CodeTable, mapping values to codes and back.
+
+    NULL values are never encoded; they remain NULL.
+
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.codes = {}   # (domain, value) -> code
+        self.values = {}  # code -> value
+
+    def load(self):
+        """Reads all codes from the table."""
+        self.table.cursor.execute(
+            "SELECT id, domain, value FROM %s" % self.table.name)
+        for code, domain, value in self.table.cursor.fetchall():
+            self.codes[(domain, value)] = code
+            self.values[code] = value
+
+    def encode(self, domain, value):
+        if value is None:
+            return None
+        code = self.codes.get((domain, value))
+        if code is None:
+            code = self.table.insert(domain, value)
+            self.codes[(domain, value)] = code
+            self.values[code] = value
+        return code
+
+    def get_code(self, domain, value):
+        if value is None:
+            return None
+        return self.codes.get((domain, value))
+
+    def decode(self, code):
+        if code is None:
+            return None
+        return self.values[code]
+
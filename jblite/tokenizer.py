@@ -0,0 +1,519 @@
+# -*- coding: utf-8 -*-
+"""Dictionary-based segmentation of Japanese text.
+
+All JMdict headwords (keb and reb values) are compiled into a
+double-array trie, which finds every headword starting at a position
+of the text in a single left-to-right walk.  The trie is built once
+from the database and saved next to it, so later runs only need to
+read a few arrays:
+
+    python -m jblite.tokenizer -b <jmdict.db>
+    python -m jblite.tokenizer <jmdict.db> [input.txt]
+
+Text is segmented either greedily by longest match, or by a lattice
+search choosing the split with the fewest tokens (unknown characters
+count double).  Each token carries the IDs of the matching entries.
+
+"""
+
+from __future__ import print_function
+from __future__ import with_statement
+
+import os, sys, json, codecs, sqlite3
+from array import array
+from collections import namedtuple
+
+from kanjiwords import get_entry_priorities
+
+import gettext
+#t = gettext.translation("jblite")
+#_ = t.ugettext
+gettext.install("jblite")
+
+
+MAGIC = "JBLTRIE\x01"
+
+# Cost of an unknown character in lattice mode, relative to one
+# dictionary token.
+UNKNOWN_COST = 2
+
+# Longest input line handled in one piece by tokenize_stream().
+MAX_LINE_LENGTH = 1 << 16
+
+
+Token = namedtuple("Token", "surface start end entry_ids")
+
+
+def get_trie_filename(db_fname):
+    """Returns the file name the trie for a database is stored under."""
+    return db_fname + ".trie"
+
+
+######################################################################
+# Double-array trie
+######################################################################
+
+
+class Trie(object):
+
+    """Double-array trie mapping strings to lists of integers.
+
+    Characters are first mapped to small codes (1 for the most
+    frequent character, and so on; 0 terminates a key).  The child of
+    node s for code c is node t = base[s] + c, valid if check[t] == s.
+    A key ends at s if its terminator child exists; that child's base
+    is -(key index + 1), and the key's values are
+    values[offsets[i]:offsets[i + 1]].
+
+    """
+
+    def __init__(self, alphabet, base, check, offsets, values,
+                 max_key_length):
+        self.alphabet = alphabet
+        self.codes = dict((char, code + 1)
+                          for code, char in enumerate(alphabet))
+        self.base = base
+        self.check = check
+        self.offsets = offsets
+        self.values = values
+        self.max_key_length = max_key_length
+
+    @classmethod
+    def build(cls, items):
+        """Builds a trie from a dictionary of key to list of values."""
+        frequency = {}
+        for key in items:
+            for char in key:
+                frequency[char] = frequency.get(char, 0) + 1
+        alphabet = u"".join(sorted(frequency,
+                                   key=lambda c: (-frequency[c], c)))
+        codes = dict((char, code + 1) for code, char in enumerate(alphabet))
+
+        keys = sorted(tuple(codes[char] for char in key) + (0,)
+                      for key in items if len(key) > 0)
+        by_codes = dict((tuple(codes[char] for char in key), key)
+                        for key in items)
+        offsets = array("I", [0])
+        values = array("i")
+        for key in keys:
+            values.extend(items[by_codes[key[:-1]]])
+            offsets.append(len(values))
+
+        base, check = _build_double_array(keys, len(alphabet) + 1)
+        max_key_length = max([len(key) - 1 for key in keys] or [0])
+        return cls(alphabet, base, check, offsets, values, max_key_length)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _get_values(self, index):
+        return self.values[self.offsets[index]:self.offsets[index + 1]]
+
+    def lookup(self, key):
+        """Returns the values for key, or an empty list."""
+        base, check, codes = self.base, self.check, self.codes
+        s = 0
+        for char in key:
+            code = codes.get(char)
+            if code is None:
+                return []
+            t = base[s] + code
+            if check[t] != s:
+                return []
+            s = t
+        t = base[s]
+        if check[t] != s:
+            return []
+        return self._get_values(-base[t] - 1).tolist()
+
+    def prefixes(self, text, start=0):
+        """Finds all keys which text[start:] begins with.
+
+        Returns a list of (end, key index) pairs, shortest first.
+
+        """
+        base, check, codes = self.base, self.check, self.codes
+        results = []
+        s = 0
+        for end in xrange(start, min(len(text),
+                                     start + self.max_key_length)):
+            code = codes.get(text[end])
+            if code is None:
+                break
+            t = base[s] + code
+            if check[t] != s:
+                break
+            s = t
+            t = base[s]
+            if check[t] == s:
+                results.append((end + 1, -base[t] - 1))
+        return results
+
+    def save(self, fname, source_info=None):
+        """Writes the trie to a file.
+
+        source_info: JSON-serializable description of the data the
+            trie was built from; returned by read_source_info().
+
+        """
+        arrays = [self.base, self.check, self.offsets, self.values]
+        header = json.dumps({
+            "alphabet": self.alphabet,
+            "max_key_length": self.max_key_length,
+            "lengths": [len(arr) for arr in arrays],
+            "source": source_info,
+            })
+        with open(fname, "wb") as outfile:
+            outfile.write(MAGIC)
+            outfile.write(array("I", [len(header)]).tostring())
+            outfile.write(header)
+            for arr in arrays:
+                if sys.byteorder != "little":
+                    arr = array(arr.typecode, arr)
+                    arr.byteswap()
+                arr.tofile(outfile)
+
+    @classmethod
+    def load(cls, fname):
+        with open(fname, "rb") as infile:
+            header = _read_header(infile)
+            arrays = []
+            for typecode, length in zip("iiIi", header["lengths"]):
+                arr = array(typecode)
+                arr.fromfile(infile, length)
+                if sys.byteorder != "little":
+                    arr.byteswap()
+                arrays.append(arr)
+        return cls(header["alphabet"], arrays[0], arrays[1], arrays[2],
+                   arrays[3], header["max_key_length"])
+
+    @staticmethod
+    def read_source_info(fname):
+        """Returns the source_info a trie file was saved with."""
+        with open(fname, "rb") as infile:
+            return _read_header(infile)["source"]
+
+
+def _read_header(infile):
+    if infile.read(len(MAGIC)) != MAGIC:
+        raise ValueError("Not a jblite trie file")
+    length = array("I")
+    length.fromstring(infile.read(length.itemsize))
+    if sys.byteorder != "little":
+        length.byteswap()
+    return json.loads(infile.read(length[0]))
+
+
+def _build_double_array(keys, alphabet_size):
+    """Lays out sorted, 0-terminated code tuples as base/check arrays.
+
+    Returns (base, check).  Key i ends in a leaf with base -(i + 1).
+    Both arrays are padded so that base[s] + code never runs past
+    the end, sparing lookups a bounds check.
+
+    """
+    size = max(alphabet_size * 2, 1024)
+    base = array("i", [0]) * size
+    check = array("i", [-1]) * size
+    check[0] = 0  # Root; never free.
+    next_free = 1
+    highest = 0
+
+    stack = [(0, 0, len(keys), 0)]  # (node, first key, end key, depth)
+    while stack:
+        node, low, high, depth = stack.pop()
+        labels = []
+        ranges = []
+        i = low
+        while i < high:
+            label = keys[i][depth]
+            j = i + 1
+            while j < high and keys[j][depth] == label:
+                j += 1
+            labels.append(label)
+            ranges.append((i, j))
+            i = j
+
+        # Find the lowest base for which all child slots are free.
+        position = next_free
+        while True:
+            b = position - labels[0]
+            if b >= 1:
+                while b + labels[-1] + alphabet_size >= size:
+                    base.extend(array("i", [0]) * size)
+                    check.extend(array("i", [-1]) * size)
+                    size *= 2
+                for label in labels:
+                    if check[b + label] != -1:
+                        break
+                else:
+                    break
+            position += 1
+            while check[position] != -1:
+                position += 1
+
+        base[node] = b
+        for label, (i, j) in zip(labels, ranges):
+            t = b + label
+            check[t] = node
+            if label == 0:
+                base[t] = -(i + 1)
+            else:
+                stack.append((t, i, j, depth + 1))
+        highest = max(highest, b + labels[-1])
+        while check[next_free] != -1:
+            next_free += 1
+
+    # Trim, keeping room for one more code past the highest node.
+    del base[highest + alphabet_size + 1:]
+    del check[highest + alphabet_size + 1:]
+    return base, check
+
+
+######################################################################
+# Segmentation
+######################################################################
+
+
+class Tokenizer(object):
+
+    """Segments text into JMdict headwords.
+
+    Characters not covered by any headword are grouped into runs and
+    returned as tokens with no entry IDs.
+
+    """
+
+    def __init__(self, trie):
+        self.trie = trie
+
+    def tokenize(self, text, mode="longest", offset=0):
+        """Yields the Tokens of text.
+
+        mode: "longest" takes the longest headword at each position;
+            "lattice" picks the segmentation with the fewest tokens,
+            which avoids greedy matches that strand the following
+            characters.
+        offset: added to token start/end positions.
+
+        """
+        if mode == "longest":
+            pieces = self._longest_match(text)
+        elif mode == "lattice":
+            pieces = self._lattice(text)
+        else:
+            raise ValueError("Unknown tokenizer mode: %r" % mode)
+
+        trie = self.trie
+        unknown_start = None
+        for start, end, key_index in pieces:
+            if key_index is None:
+                if unknown_start is None:
+                    unknown_start = start
+                continue
+            if unknown_start is not None:
+                yield Token(text[unknown_start:start], unknown_start + offset,
+                            start + offset, [])
+                unknown_start = None
+            yield Token(text[start:end], start + offset, end + offset,
+                        trie._get_values(key_index).tolist())
+        if unknown_start is not None:
+            yield Token(text[unknown_start:], unknown_start + offset,
+                        len(text) + offset, [])
+
+    def _longest_match(self, text):
+        prefixes = self.trie.prefixes
+        position = 0
+        length = len(text)
+        while position < length:
+            matches = prefixes(text, position)
+            if len(matches) > 0:
+                end, key_index = matches[-1]
+                yield (position, end, key_index)
+                position = end
+            else:
+                yield (position, position + 1, None)
+                position += 1
+
+    def _lattice(self, text):
+        prefixes = self.trie.prefixes
+        length = len(text)
+        # cost[i]: cheapest segmentation of text[:i]; back[i]: the
+        # (start, key index) of its last piece.
+        cost = [0] + [None] * length
+        back = [None] * (length + 1)
+        for start in xrange(length):
+            here = cost[start]
+            unknown = here + UNKNOWN_COST
+            if cost[start + 1] is None or unknown < cost[start + 1]:
+                cost[start + 1] = unknown
+                back[start + 1] = (start, None)
+            for end, key_index in prefixes(text, start):
+                if cost[end] is None or here + 1 < cost[end]:
+                    # Starts are visited in order, so on ties the
+                    # longer last token is kept.
+                    cost[end] = here + 1
+                    back[end] = (start, key_index)
+        pieces = []
+        end = length
+        while end > 0:
+            start, key_index = back[end]
+            pieces.append((start, end, key_index))
+            end = start
+        pieces.reverse()
+        return pieces
+
+    def tokenize_stream(self, chunks, mode="longest"):
+        """Yields the Tokens of text read piecewise.
+
+        chunks: an iterable of unicode strings, such as a file opened
+            with codecs.open().  Token positions are relative to the
+            start of the whole stream.
+
+        Text is segmented one line at a time, so memory use is bounded
+        by the longest line.  Lines longer than MAX_LINE_LENGTH are
+        split where no headword crosses, which gives the same
+        dictionary tokens as segmenting the line whole.
+
+        """
+        buf = u""
+        offset = 0
+        for chunk in chunks:
+            buf += chunk
+            while True:
+                cut = buf.rfind(u"\n") + 1
+                if cut == 0 and len(buf) > MAX_LINE_LENGTH:
+                    cut = self._find_safe_cut(buf)
+                if cut <= 0:
+                    break
+                for token in self.tokenize(buf[:cut], mode, offset):
+                    yield token
+                offset += cut
+                buf = buf[cut:]
+                if len(buf) <= MAX_LINE_LENGTH:
+                    break
+        if len(buf) > 0:
+            for token in self.tokenize(buf, mode, offset):
+                yield token
+
+    def _find_safe_cut(self, text):
+        """Finds a position in text which no headword match crosses.
+
+        Only positions where every match starting before them is fully
+        inside text are considered.  Returns 0 if there is none.
+
+        """
+        limit = len(text) - self.trie.max_key_length
+        reach = 0
+        cut = 0
+        for position in xrange(limit):
+            if reach <= position:
+                cut = position
+            matches = self.trie.prefixes(text, position)
+            if len(matches) > 0:
+                reach = max(reach, matches[-1][0])
+        if reach <= limit:
+            cut = limit
+        return cut
+
+
+######################################################################
+# Building from a database
+######################################################################
+
+
+def get_source_info(db_fname):
+    """Describes the state of a database file, to detect stale tries."""
+    stat = os.stat(db_fname)
+    return {"size": stat.st_size, "mtime": stat.st_mtime}
+
+
+def build_trie(db_fname):
+    """Builds a Trie of all keb and reb values of a JMdict database.
+
+    Each headword maps to its entry IDs, most common entries first.
+
+    """
+    conn = sqlite3.connect(db_fname)
+    cursor = conn.cursor()
+    try:
+        priorities = get_entry_priorities(cursor)
+        cursor.execute("SELECT value, fk FROM k_ele "
+                       "UNION SELECT value, fk FROM r_ele")
+        items = {}
+        for value, entry_id in cursor.fetchall():
+            if value:
+                items.setdefault(value, []).append(entry_id)
+    finally:
+        cursor.close()
+        conn.close()
+    for entry_ids in items.itervalues():
+        entry_ids.sort(key=lambda entry_id: (-priorities.get(entry_id, 0),
+                                             entry_id))
+    return Trie.build(items)
+
+
+def load_tokenizer(db_fname, rebuild=False):
+    """Returns a Tokenizer for a JMdict database.
+
+    The trie is read from the file next to the database, or built and
+    saved there if it is missing, out of date or rebuild is True.
+
+    """
+    trie_fname = get_trie_filename(db_fname)
+    source_info = get_source_info(db_fname)
+    if not rebuild and os.path.exists(trie_fname):
+        try:
+            if Trie.read_source_info(trie_fname) == source_info:
+                return Tokenizer(Trie.load(trie_fname))
+        except ValueError:
+            pass  # Corrupt or foreign file; rebuild it.
+    trie = build_trie(db_fname)
+    trie.save(trie_fname, source_info)
+    return Tokenizer(trie)
+
+
+######################################################################
+
+def parse_args():
+    from optparse import OptionParser
+    op = OptionParser(usage="%prog [options] <jmdict_db> [input_file]")
+    op.add_option("-b", "--build", action="store_true",
+                  help=_("(Re)build the trie file and exit."))
+    op.add_option("-m", "--mode", choices=["longest", "lattice"],
+                  default="longest",
+                  help=_("Segmentation mode: longest or lattice "
+                         "(default: %default)"))
+    op.add_option("-e", "--encoding", default="utf-8",
+                  help=_("Encoding of the input (default: %default)"))
+    options, args = op.parse_args()
+    if len(args) < 1:
+        op.print_help()
+        exit(-1)
+    return (options, args)
+
+def main():
+    options, args = parse_args()
+    db_fname = args[0]
+    tokenizer = load_tokenizer(db_fname, rebuild=options.build)
+    if options.build:
+        print(_("Indexed %d headwords.") % len(tokenizer.trie))
+        return
+
+    if len(args) > 1:
+        infile = codecs.open(args[1], "r", options.encoding)
+    else:
+        infile = codecs.getreader(options.encoding)(sys.stdin)
+    out = codecs.getwriter("utf-8")(sys.stdout)
+    try:
+        for token in tokenizer.tokenize_stream(infile, options.mode):
+            if token.surface == u"\n":
+                continue
+            out.write(u"%s\t%d\t%s\n" % (
+                token.surface.replace(u"\n", u"\\n"), token.start,
+                u",".join(map(unicode, token.entry_ids))))
+    finally:
+        infile.close()
+
+if __name__ == "__main__":
+    main()